@@ -0,0 +1,321 @@
+# -*- coding: utf8 -*-
+'''
+The build agent started with ``flux-ci agent``. It runs builds on a host
+that has no access to the Flux CI database and talks to the server with
+the protocol described in :mod:`flux.agents`.
+
+The agent runs up to *capacity* builds in parallel. Every build thread
+long-polls the server for a build, runs it in the agent's work directory
+with the same steps as a local build (see :func:`runner.do_build_`),
+streams the log to the server while the build runs and uploads the
+artifact when it finished. A heartbeat thread keeps the agent alive on
+the server and terminates builds that have been stopped in the web
+interface.
+
+The SSH key of a repository that has its own keypair is downloaded for
+every build and deleted when the build finished, thus an agent never
+keeps the keys of the repositories.
+
+This module must not import :mod:`flux.models`.
+'''
+
+from flux import config, overrides, resources, utils
+from flux.runner import do_build_
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+
+import contextlib
+import json
+import logging
+import os
+import traceback
+import urllib.error
+import urllib.request
+import uuid
+import zipfile
+
+#: The number of seconds between two uploads of the build log.
+LOG_INTERVAL = 2.0
+
+log = logging.getLogger(__name__)
+
+
+class AgentClient(object):
+  ''' HTTP client for the agent API of the Flux CI server at *url*. The
+  client identifies this process with a random :attr:`instance` ID, thus
+  the server can tell agents with the same name apart. '''
+
+  def __init__(self, url, name, secret):
+    self.url = url.rstrip('/')
+    self.name = name
+    self.secret = secret
+    self.instance = uuid.uuid4().hex
+
+  def request(self, path, data=None, content_type='application/json', timeout=60,
+              length=None):
+    ''' Sends a request (a POST request if *data* is not None) and returns
+    the response body. Raises :class:`urllib.error.HTTPError` for error
+    responses. *data* may be a dictionary, which is sent as JSON, or a
+    file object that is streamed to the server, in which case its
+    *length* in bytes must be specified. '''
+
+    if isinstance(data, dict):
+      data = json.dumps(data).encode('utf8')
+    req = urllib.request.Request(self.url + path, data=data)
+    req.add_header('Authorization', 'Bearer ' + self.secret)
+    req.add_header('X-Flux-Agent', self.name)
+    req.add_header('X-Flux-Agent-Instance', self.instance)
+    if data is not None:
+      req.add_header('Content-Type', content_type)
+    if length is not None:
+      req.add_header('Content-Length', str(length))
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+      return response.read()
+
+  def call(self, path, data=None, timeout=60):
+    ''' Like :meth:`request`, but returns the decoded JSON response. '''
+
+    body = self.request(path, data, timeout=timeout)
+    return json.loads(body.decode('utf8')) if body else {}
+
+
+class BuildAgent(object):
+
+  def __init__(self, client, labels, capacity, work_dir):
+    self.client = client
+    self.labels = sorted(set(labels))
+    self.capacity = capacity
+    self.work_dir = work_dir
+    self.heartbeat_interval = config.agent_heartbeat_interval
+    self._lock = Lock()
+    self._stopped = Event()
+    self._terminate_events = {}
+
+  def register(self):
+    data = {'labels': self.labels, 'capacity': self.capacity}
+    response = self.client.call('/api/agent/register', data)
+    self.heartbeat_interval = response.get('heartbeat_interval', self.heartbeat_interval)
+    log.info('Registered at {} as {!r}'.format(self.client.url, self.client.name))
+
+  def call(self, path, data=None, timeout=60):
+    ''' Calls the server and registers again if the server does not know
+    the agent (eg. because its database has been reset) or if another
+    process registered with its name. '''
+
+    try:
+      return self.client.call(path, data, timeout)
+    except urllib.error.HTTPError as exc:
+      if exc.code not in (404, 409) or path == '/api/agent/register':
+        raise
+    self.register()
+    return self.client.call(path, data, timeout)
+
+  def run(self):
+    ''' Runs the agent until :meth:`stop` is called. '''
+
+    utils.makedirs(self.work_dir)
+    while not self._stopped.is_set():
+      try:
+        self.register()
+        break
+      except (OSError, ValueError) as exc:
+        log.error('Could not register: {}'.format(exc))
+        self._stopped.wait(self.heartbeat_interval)
+
+    threads = [Thread(target=self._heartbeat)]
+    threads += [Thread(target=self._worker, args=[i]) for i in range(self.capacity)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+  def stop(self):
+    with self._lock:
+      self._stopped.set()
+      for event in self._terminate_events.values():
+        event.set()
+
+  def _heartbeat(self):
+    while not self._stopped.wait(self.heartbeat_interval):
+      with self._lock:
+        build_ids = list(self._terminate_events)
+      try:
+        response = self.call('/api/agent/heartbeat', {'builds': build_ids})
+      except (OSError, ValueError) as exc:
+        log.error('Heartbeat failed: {}'.format(exc))
+        continue
+      with self._lock:
+        for build_id in response.get('stop', []):
+          if build_id in self._terminate_events:
+            self._terminate_events[build_id].set()
+
+  def _worker(self, slot):
+    cpus = resources.get_slot_cpus(slot, self.capacity)
+    while not self._stopped.is_set():
+      try:
+        # The request must outlive the server's long-polling timeout.
+        wait = config.agent_poll_timeout
+        job = self.call('/api/agent/claim', {'wait': wait}, timeout=wait + 30).get('build')
+      except (OSError, ValueError) as exc:
+        log.error('Could not claim a build: {}'.format(exc))
+        self._stopped.wait(self.heartbeat_interval)
+        continue
+      if not job:
+        continue
+      with self._lock:
+        terminate_event = self._terminate_events[job['id']] = Event()
+        if self._stopped.is_set():
+          terminate_event.set()
+      try:
+        self.run_build(job, terminate_event, cpus)
+      except BaseException:
+        traceback.print_exc()
+      finally:
+        with self._lock:
+          self._terminate_events.pop(job['id'])
+
+  def run_build(self, job, terminate_event, cpus=None):
+    ''' Runs the build described by the JSON object *job* that has been
+    returned by the server and reports the result. The build script is
+    pinned to the set of *cpus*, if any. '''
+
+    build_id = job['id']
+    build = SimpleNamespace(id=build_id, num=job['num'], ref=job['ref'],
+      commit_sha=job['commit_sha'], repo=SimpleNamespace(**job['repo']))
+    prefix = '/api/agent/build/{}'.format(build_id)
+    build_path = os.path.join(self.work_dir, str(build_id))
+    override_path = build_path + '.overrides'
+    key_path = build_path + '.key'
+    log_path = build_path + '.log'
+    for path in (build_path, override_path):
+      if os.path.exists(path):
+        utils.rmtree(path, remove_write_protection=True)
+
+    log.info('Build {}#{} started'.format(build.repo.name, build.num))
+    resolved = {}
+    status = 'error'
+    work_path = build_path
+    with open(log_path, 'w') as logfile, contextlib.ExitStack() as stack:
+      logger = utils.create_logger(logfile)
+      streamer = LogStreamer(self.client, prefix + '/log', log_path, terminate_event)
+      streamer.start()
+      try:
+        logger.info('[Flux]: running on agent {}'.format(self.client.name))
+        if job.get('has_overrides'):
+          self.download_overrides(prefix, override_path)
+        if job.get('has_deploy_key'):
+          build.repo.private_key_path = self.download_deploy_key(prefix, key_path)
+        work_path = stack.enter_context(resources.workspace(build, build_path, logger))
+        if do_build_(build, work_path, override_path, logger, logfile,
+                     terminate_event, lambda **kw: resolved.update(kw), cpus):
+          status = 'success'
+        elif terminate_event.is_set():
+          status = 'stopped'
+      except BaseException as exc:
+        logger.exception(exc)
+      finally:
+        if os.path.exists(key_path):
+          os.remove(key_path)
+        if os.path.isdir(work_path):
+          logger.info('[Flux]: Zipping build directory...')
+          utils.zipdir(work_path, build_path + '.zip')
+          utils.rmtree(work_path, remove_write_protection=True)
+          logger.info('[Flux]: Done')
+        logfile.flush()
+        streamer.stop()
+
+    try:
+      if os.path.isfile(build_path + '.zip'):
+        with open(build_path + '.zip', 'rb') as fp:
+          self.client.request(prefix + '/artifact', fp,
+            content_type='application/zip', timeout=None,
+            length=os.fstat(fp.fileno()).st_size)
+      data = dict(resolved, status=status)
+      self.client.call(prefix + '/finish', data)
+    except urllib.error.HTTPError as exc:
+      if exc.code != 409:
+        raise
+      log.warning('Build {} has been taken away from this agent'.format(build_id))
+    finally:
+      for path in (build_path + '.zip', log_path, override_path):
+        if os.path.isdir(path):
+          utils.rmtree(path, remove_write_protection=True)
+        elif os.path.exists(path):
+          os.remove(path)
+      overrides.remove(override_path)
+    log.info('Build {}#{} finished ({})'.format(build.repo.name, build.num, status))
+
+  def download_overrides(self, prefix, override_path):
+    data = self.client.request(prefix + '/overrides')
+    if data:
+      zip_path = override_path + '.zip'
+      with open(zip_path, 'wb') as fp:
+        fp.write(data)
+      with zipfile.ZipFile(zip_path) as zipf:
+        zipf.extractall(override_path)
+      os.remove(zip_path)
+
+  def download_deploy_key(self, prefix, key_path):
+    ''' Saves the SSH key of the repository at *key_path*, which is only
+    readable by the owner. Returns *key_path*, or None if the repository
+    has no key (anymore). '''
+
+    data = self.client.request(prefix + '/deploy-key')
+    if not data:
+      return None
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'wb') as fp:
+      fp.write(data)
+    return key_path
+
+
+class LogStreamer(object):
+  ''' Sends the content that has been appended to the log file at *path*
+  to the server every :data:`LOG_INTERVAL` seconds. Sets the
+  *terminate_event* if the server responds that the build has been
+  stopped. '''
+
+  def __init__(self, client, url_path, path, terminate_event):
+    self.client = client
+    self.url_path = url_path
+    self.path = path
+    self.terminate_event = terminate_event
+    self._offset = 0
+    self._stopped = Event()
+    self._thread = Thread(target=self._run)
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    ''' Stops the thread and sends the remaining content. '''
+
+    self._stopped.set()
+    self._thread.join()
+    try:
+      self.flush()
+    except (OSError, ValueError) as exc:
+      log.error('Could not send the build log: {}'.format(exc))
+
+  def flush(self):
+    with open(self.path, 'rb') as fp:
+      fp.seek(self._offset)
+      data = fp.read()
+    if not data:
+      return
+    response = json.loads(self.client.request(self.url_path, data,
+      content_type='application/octet-stream').decode('utf8'))
+    self._offset += len(data)
+    if response.get('stop'):
+      self.terminate_event.set()
+
+  def _run(self):
+    while not self._stopped.wait(LOG_INTERVAL):
+      try:
+        self.flush()
+      except urllib.error.HTTPError as exc:
+        if exc.code == 409:
+          # The build has been taken away from this agent.
+          self.terminate_event.set()
+          return
+        log.error('Could not send the build log: {}'.format(exc))
+      except (OSError, ValueError) as exc:
+        log.error('Could not send the build log: {}'.format(exc))
@@ -0,0 +1,376 @@
+# -*- coding: utf8 -*-
+'''
+Server side of the build agent protocol. Build agents (see
+:mod:`flux.agent_runner`) run builds on other hosts without access to
+the database. They register with their labels and capacity, long-poll
+for queued builds of repositories whose agent labels they all have,
+stream the build log back while the build runs and upload the artifact
+when it finished.
+
+The agent API is only available if ``agent_secret`` is set. Every request
+must carry the secret as a bearer token, the agent name in the
+``X-Flux-Agent`` header and a random ID of the agent process in the
+``X-Flux-Agent-Instance`` header. Requests and responses are JSON unless
+noted:
+
+* ``POST /api/agent/register``: ``{labels, capacity}``. Responds with 409
+  while another live agent process has the same name. The builds that a
+  previous process with the name left behind are queued again.
+* ``POST /api/agent/heartbeat``: ``{builds}`` returns the IDs of the
+  builds that the agent must terminate as ``{stop}``
+* ``POST /api/agent/claim``: ``{wait}`` returns ``{build}``, which is
+  None if no build could be claimed within *wait* seconds
+* ``GET /api/agent/build/<id>/overrides``: ZIP of the override files
+* ``GET /api/agent/build/<id>/deploy-key``: The private SSH key of the
+  repository (see ``has_deploy_key``), only while the build is running.
+  The agent deletes it when the build finished.
+* ``POST /api/agent/build/<id>/log``: Appends the raw request body to the
+  build log and returns ``{stop}``
+* ``POST /api/agent/build/<id>/artifact``: The ZIP file of the build
+* ``POST /api/agent/build/<id>/finish``: ``{status, commit_sha, ref}`` and
+  the fields of :class:`resources.Usage`
+
+An agent that did not send a request for ``agent_timeout`` seconds is
+considered dead. Its builds are queued again by the :class:`AgentMonitor`.
+'''
+
+from flux import app, config, models, resources, utils
+from flux.build import claim_queued, enqueue
+from flux.models import select, Agent, Build
+from flask import request, abort, jsonify, send_file
+from datetime import datetime, timedelta
+from threading import Event, Thread
+
+import functools
+import hmac
+import io
+import os
+import time
+import traceback
+
+#: The number of seconds between two attempts to claim a build while an
+#: agent is long-polling.
+CLAIM_POLL_INTERVAL = 1.0
+
+
+def requires_agent(func):
+  ''' Decorator for the agent API views. Checks the ``agent_secret`` and
+  passes the name of the agent as the first argument. '''
+
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if not config.agent_secret:
+      return abort(404)
+    expected = 'Bearer ' + config.agent_secret
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+      return abort(401)
+    name = request.headers.get('X-Flux-Agent', '').strip()
+    if not name or not request.headers.get('X-Flux-Agent-Instance'):
+      return abort(400)
+    return func(name, *args, **kwargs)
+
+  return wrapper
+
+
+def get_agent(name):
+  ''' Returns the :class:`Agent` with the specified *name* and records that
+  it has been seen. Responds with 404 if the agent is not registered and
+  with 409 if another process registered with the name, the agent
+  registers again in both cases. '''
+
+  agent = Agent.get(name=name)
+  if not agent:
+    abort(404)
+  if agent.instance != request.headers.get('X-Flux-Agent-Instance'):
+    abort(409)
+  agent.last_seen = datetime.now()
+  return agent
+
+
+def get_agent_build(agent, build_id):
+  ''' Returns the build with the specified ID if it has been claimed by
+  *agent*. Responds with 409 otherwise (eg. if the agent was considered
+  dead and the build has been queued again). '''
+
+  build = Build.get(id=build_id)
+  if not build:
+    abort(404)
+  if build.worker != agent.worker_name:
+    abort(409)
+  return build
+
+
+def build_to_json(build):
+  override_path = build.path(Build.Data_OverrideDir)
+  return {
+    'id': build.id,
+    'num': build.num,
+    'ref': build.ref,
+    'commit_sha': build.commit_sha,
+    'repo': {
+      'name': build.repo.name,
+      'clone_url': build.repo.clone_url,
+      'limit_cpu': build.repo.limit_cpu,
+      'limit_memory': build.repo.limit_memory,
+      'limit_pids': build.repo.limit_pids,
+      'ram_workspace': build.repo.ram_workspace,
+    },
+    'has_overrides': os.path.isdir(override_path) and bool(os.listdir(override_path)),
+    'has_deploy_key': os.path.isfile(utils.get_repo_private_key_path(build.repo)),
+  }
+
+
+def claim_build(name):
+  ''' Claims a queued build that the agent with the specified *name*
+  accepts (see :func:`build.claim_queued`), unless it already runs as many
+  builds as its capacity. Returns the JSON representation of the build
+  or None. '''
+
+  with models.session():
+    agent = get_agent(name)
+    if agent.running_builds().count() >= agent.capacity:
+      return None
+    # Only the repositories that have queued builds are checked.
+    repos = select(x.repo for x in Build if x.status == Build.Status_Queued)
+    repo_ids = [x.id for x in repos if agent.accepts(x)]
+    if not repo_ids:
+      return None
+    query = select(x for x in Build if x.status == Build.Status_Queued
+                   and x.repo.id in repo_ids)
+    build = claim_queued(agent.worker_name, query)
+    if not build:
+      return None
+    app.logger.info('Build {}#{} claimed by agent {}'.format(build.repo.name, build.num, name))
+    return build_to_json(build)
+
+
+@app.route('/api/agent/register', methods=['POST'])
+@requires_agent
+@models.session
+def agent_register(name):
+  data = request.get_json(force=True, silent=True) or {}
+  labels = data.get('labels', [])
+  capacity = data.get('capacity', 1)
+  if not isinstance(labels, list) or not all(isinstance(x, str) for x in labels):
+    return abort(400)
+  if not isinstance(capacity, int) or capacity < 1:
+    return abort(400)
+
+  instance = request.headers['X-Flux-Agent-Instance']
+  agent = Agent.get(name=name)
+  if not agent:
+    agent = Agent(name=name, instance=instance)
+  elif agent.instance != instance:
+    if agent.is_alive():
+      app.logger.warning('Agent {} is already registered by another process'.format(name))
+      return abort(409)
+    requeue_builds(agent)
+    agent.instance = instance
+  agent.labels = ' '.join(sorted(set(labels)))
+  agent.capacity = capacity
+  agent.registered = agent.last_seen = datetime.now()
+  app.logger.info('Agent {} registered (labels: {}, capacity: {})'
+    .format(name, agent.labels or '-', capacity))
+  return jsonify({'heartbeat_interval': config.agent_heartbeat_interval})
+
+
+@app.route('/api/agent/heartbeat', methods=['POST'])
+@requires_agent
+@models.session
+def agent_heartbeat(name):
+  data = request.get_json(force=True, silent=True) or {}
+  build_ids = [x for x in data.get('builds', []) if isinstance(x, int)]
+  agent = get_agent(name)
+  running = set(select(x.id for x in agent.running_builds()))
+  return jsonify({'stop': [x for x in build_ids if x not in running]})
+
+
+@app.route('/api/agent/claim', methods=['POST'])
+@requires_agent
+def agent_claim(name):
+  data = request.get_json(force=True, silent=True) or {}
+  try:
+    wait = min(float(data.get('wait', 0)), config.agent_poll_timeout)
+  except (TypeError, ValueError):
+    return abort(400)
+
+  # No database session is held while waiting.
+  deadline = time.monotonic() + wait
+  while True:
+    build = claim_build(name)
+    if build or time.monotonic() >= deadline:
+      break
+    time.sleep(CLAIM_POLL_INTERVAL)
+  return jsonify({'build': build})
+
+
+@app.route('/api/agent/build/<int:build_id>/overrides')
+@requires_agent
+@models.session
+def agent_overrides(name, build_id):
+  build = get_agent_build(get_agent(name), build_id)
+  override_path = build.path(Build.Data_OverrideDir)
+  if not os.path.isdir(override_path):
+    return '', 204
+  fp = io.BytesIO()
+  utils.zipdir(override_path, fp)
+  fp.seek(0)
+  return send_file(fp, mimetype='application/zip')
+
+
+@app.route('/api/agent/build/<int:build_id>/deploy-key')
+@requires_agent
+@models.session
+def agent_deploy_key(name, build_id):
+  build = get_agent_build(get_agent(name), build_id)
+  if build.status != Build.Status_Building:
+    return abort(409)
+  key_path = utils.get_repo_private_key_path(build.repo)
+  if not os.path.isfile(key_path):
+    return '', 204
+  return send_file(key_path, mimetype='text/plain')
+
+
+@app.route('/api/agent/build/<int:build_id>/log', methods=['POST'])
+@requires_agent
+@models.session
+def agent_log(name, build_id):
+  build = get_agent_build(get_agent(name), build_id)
+  if build.status not in (Build.Status_Building, Build.Status_Stopped):
+    return abort(409)
+  utils.makedirs(os.path.dirname(build.path(Build.Data_Log)))
+  with open(build.path(Build.Data_Log), 'ab') as fp:
+    fp.write(request.get_data())
+  return jsonify({'stop': build.status == Build.Status_Stopped})
+
+
+@app.route('/api/agent/build/<int:build_id>/artifact', methods=['POST'])
+@requires_agent
+@models.session
+def agent_artifact(name, build_id):
+  build = get_agent_build(get_agent(name), build_id)
+  if build.status not in (Build.Status_Building, Build.Status_Stopped):
+    return abort(409)
+  filename = build.path(Build.Data_Artifact)
+  utils.makedirs(os.path.dirname(filename))
+  with open(filename + '.part', 'wb') as fp:
+    while True:
+      chunk = request.stream.read(64 * 1024)
+      if not chunk:
+        break
+      fp.write(chunk)
+  os.replace(filename + '.part', filename)
+  return jsonify({})
+
+
+@app.route('/api/agent/build/<int:build_id>/finish', methods=['POST'])
+@requires_agent
+@models.session
+def agent_finish(name, build_id):
+  data = request.get_json(force=True, silent=True) or {}
+  status = data.get('status')
+  if status not in (Build.Status_Success, Build.Status_Error, Build.Status_Stopped):
+    return abort(400)
+  build = get_agent_build(get_agent(name), build_id)
+  if build.status not in (Build.Status_Building, Build.Status_Stopped):
+    return abort(409)
+  if build.status != Build.Status_Stopped:
+    build.status = status
+  if data.get('commit_sha'):
+    build.commit_sha = data['commit_sha']
+  if data.get('ref'):
+    build.ref = data['ref']
+  for key in resources.Usage._fields:
+    if isinstance(data.get(key), int):
+      build.set(**{key: data[key]})
+  build.date_finished = datetime.now()
+  app.logger.info('Build {}#{} finished by agent {} ({})'
+    .format(build.repo.name, build.num, name, build.status))
+  return jsonify({})
+
+
+@app.route('/api/agents')
+@models.session
+@utils.requires_api_auth
+def api_agents():
+  ''' Lists the registered build agents. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  result = []
+  for agent in select(x for x in Agent).order_by(Agent.name):
+    result.append({
+      'name': agent.name,
+      'labels': sorted(agent.get_labels()),
+      'capacity': agent.capacity,
+      'alive': agent.is_alive(),
+      'last_seen': agent.last_seen.isoformat(),
+      'builds': sorted(select(x.id for x in agent.running_builds())),
+    })
+  return jsonify({'agents': result})
+
+
+def requeue_dead_agents():
+  ''' Queues the builds of agents that have not been seen for
+  ``agent_timeout`` seconds again. Returns the number of builds. '''
+
+  limit = datetime.now() - timedelta(seconds=config.agent_timeout)
+  with models.session():
+    return sum(requeue_builds(x) for x in select(x for x in Agent if x.last_seen < limit))
+
+
+def requeue_builds(agent):
+  ''' Queues the running builds of the dead *agent* again. Returns the
+  number of builds. Must be called inside a database session. '''
+
+  builds = []
+  for build in agent.running_builds():
+    app.logger.warning('Agent {} is dead, queueing build {}#{} again'
+      .format(agent.name, build.repo.name, build.num))
+    build.status = Build.Status_Queued
+    build.worker = ''
+    build.date_started = None
+    for data in (Build.Data_Log, Build.Data_Artifact):
+      if build.exists(data):
+        os.remove(build.path(data))
+    builds.append(build)
+  if builds:
+    models.commit()
+    for build in builds:
+      enqueue(build)
+  return len(builds)
+
+
+class AgentMonitor(object):
+  ''' Runs :func:`requeue_dead_agents` periodically in a background thread. '''
+
+  def __init__(self):
+    self._stopped = Event()
+    self._thread = None
+
+  def start(self):
+    if self._thread:
+      raise RuntimeError('already running')
+    self._stopped.clear()
+    self._thread = Thread(target=self._run)
+    self._thread.start()
+
+  def stop(self, join=True):
+    if not self._thread:
+      return
+    self._stopped.set()
+    if join:
+      self._thread.join()
+    self._thread = None
+
+  def _run(self):
+    while not self._stopped.wait(max(1, config.agent_timeout / 2)):
+      try:
+        requeue_dead_agents()
+      except BaseException:
+        traceback.print_exc()
+
+
+_monitor = AgentMonitor()
+run_monitor = _monitor.start
+stop_monitor = _monitor.stop
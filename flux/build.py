@@ -20,109 +20,313 @@
 '''
 This module implements the Flux worker queue. Flux will start one or
 more threads (based on the ``parallel_builds`` configuration value)
-that will process the queue.
+that will process the queue, either in the web process or in separate
+``flux-ci worker`` processes.
 '''
 
-from flux import app, config, utils, models
-from flux.enums import GitFolderHandling
+from flux import app, config, mirror, resources, utils, models
 from flux.models import select, Build
-from collections import deque
+from flux.runner import do_build_
 from threading import Event, Condition, Thread
-from datetime import datetime
-from distutils import dir_util
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 
+import collections
 import contextlib
+import functools
 import os
-import shlex
 import shutil
-import stat
-import subprocess
-import time
 import traceback
 
 
 class BuildConsumer(object):
   ''' This class can start a number of threads that consume
-  :class:`Build` objects and execute them. '''
+  :class:`Build` objects and execute them.
 
-  def __init__(self):
+  Queued builds are claimed from the database with a row lock, thus any
+  number of consumers (the web process and ``flux-ci worker`` processes,
+  possibly on other hosts sharing the database) can run at the same time.
+  Every consumer has a unique *name* that is recorded in the builds it
+  claims. Builds stopped by other processes are picked up by :meth:`sync`. '''
+
+  def __init__(self, name=None):
+    self.name = name
     self._cond = Condition()
     self._running = False
-    self._queue = deque()
     self._terminate_events = {}
-    self._threads = []
+    self._threads = {}
+    self._size = 0
+    self._sync_interval = 5
+    self._stopped = Event()
+    self._jobs = collections.deque()
+    self.admission = None
 
   def put(self, build):
+    ''' Wakes up an idle build thread to claim the queued *build*. The
+    build must be committed to the database. '''
+
     if not isinstance(build, Build):
       raise TypeError('expected Build instance')
     assert build.id is not None
-    # TODO: Check if the build is commited to the database, we should'nt
-    #       enqueue it before it is.
     if build.status != Build.Status_Queued:
       raise TypeError('build status must be {!r}'.format(Build.Status_Queued))
+    if not build.repo.agent_labels:
+      prefetch_build(build)
     with self._cond:
-      if build.id not in self._queue:
-        self._queue.append(build.id)
-        self._cond.notify()
+      self._cond.notify()
 
   def terminate(self, build):
     ''' Given a :class:`Build` object, terminates the ongoing build
     process or removes the build from the queue and sets its status
-    to "stopped". '''
+    to "stopped". Builds that run in another process are terminated by
+    that process' :meth:`sync`. '''
 
     if not isinstance(build, Build):
       raise TypeError('expected Build instance')
     with self._cond:
       if build.id in self._terminate_events:
         self._terminate_events[build.id].set()
-      elif build.id in self._queue:
-        self._queue.remove(build.id)
       build.status = build.Status_Stopped
 
+  def queued(self):
+    ''' Returns a query of the queued builds that this consumer may take.
+    Must be called inside a database session. '''
+
+    # Builds that require agent labels are only claimed by agents.
+    return select(x for x in Build if x.status == Build.Status_Queued
+                  and x.repo.agent_labels == '')
+
+  def claim(self):
+    ''' Claims a queued build (see :func:`claim_queued`) and marks it as
+    building. Returns the ID of the build, or None if there is no queued
+    build that this consumer may take. '''
+
+    with models.session():
+      build = claim_queued(self.name, self.queued())
+      return build.id if build else None
+
+  def prefetch(self):
+    ''' Prefetches the oldest queued builds that this consumer may take,
+    including those that have been queued by other processes. '''
+
+    if not mirror.is_prefetching():
+      return
+    with models.session():
+      query = self.queued().order_by(Build.date_queued, Build.id)
+      for build in query[:config.affinity_candidates]:
+        prefetch_build(build)
+
+  def sync(self):
+    ''' Terminates the running builds that have been stopped by other
+    processes. '''
+
+    with self._cond:
+      running = list(self._terminate_events)
+    if not running:
+      return
+    with models.session():
+      stopped = select(x.id for x in Build
+        if x.id in running and x.status == Build.Status_Stopped)[:]
+    with self._cond:
+      for build_id in stopped:
+        if build_id in self._terminate_events:
+          self._terminate_events[build_id].set()
+
+  def report(self, initial=False):
+    ''' Records the state of this consumer in its :class:`models.Worker`
+    and resizes the pool if its number of threads has been changed. The
+    *initial* report when the consumer starts replaces the row that a
+    previous process with the same name may have left (eg. if it crashed)
+    with the configured number of threads. '''
+
+    with self._cond:
+      size, running, admission = self._size, len(self._terminate_events), self.admission
+    with models.session():
+      worker = models.Worker.get(name=self.name)
+      if not worker:
+        worker = models.Worker(name=self.name, threads=size)
+      elif initial:
+        worker.set(threads=size, started=datetime.now())
+      elif worker.threads != size and worker.threads >= 1:
+        app.logger.info('Resizing build consumer {} to {} thread(s)'
+          .format(self.name, worker.threads))
+        size = worker.threads
+      worker.running = running
+      worker.admission = admission or ''
+      worker.last_seen = datetime.now()
+    with self._cond:
+      resize = self._running and size != self._size
+    if resize:
+      self.resize(size)
+
   def stop(self, join=True):
     with self._cond:
       for event in self._terminate_events.values():
         event.set()
       self._running = False
-      self._cond.notify()
+      self._stopped.set()
+      self._cond.notify_all()
+      threads = list(self._threads.values())
     if join:
-      [t.join() for t in self._threads]
+      [t.join() for t in threads]
+      with models.session():
+        models.Worker.select(lambda x: x.name == self.name).delete(bulk=True)
 
-  def start(self, num_threads=1):
-    def worker():
-      while True:
-        with self._cond:
-          while not self._queue and self._running:
-            self._cond.wait()
-          if not self._running:
-            break
-          build_id = self._queue.popleft()
-        with models.session():
-          build = Build.get(id=build_id)
-          if not build or build.status != Build.Status_Queued:
-            continue
-        with self._cond:
-          do_terminate = self._terminate_events[build_id] = Event()
+  def start(self, num_threads=1, sync_interval=5):
+    ''' Starts *num_threads* build threads and one thread that calls
+    :meth:`sync` and :meth:`report`. Idle build threads check for queued
+    builds every *sync_interval* seconds (or when they are woken up by
+    :meth:`put`). The number of build threads can be changed with
+    :meth:`resize` while the consumer is running. '''
+
+    def syncer():
+      while not self._stopped.wait(self._sync_interval):
         try:
-          do_build(build_id, do_terminate)
+          self.sync()
+          self.report()
+          self.prefetch()
         except BaseException as exc:
           traceback.print_exc()
-        finally:
-          with self._cond:
-            self._terminate_events.pop(build_id)
 
     if num_threads < 1:
       raise ValueError('num_threads must be >= 1')
+    if not self.name:
+      raise RuntimeError('BuildConsumer.name is not set')
     with self._cond:
       if self._running:
         raise RuntimeError('already running')
       self._running = True
-      self._threads = [Thread(target=worker) for i in range(num_threads)]
-      [t.start() for t in self._threads]
+      self._stopped.clear()
+      self._sync_interval = sync_interval
+      self._threads = {'syncer': Thread(target=syncer)}
+      self._threads['syncer'].start()
+    self.resize(num_threads)
+    self.report(initial=True)
+
+  def resize(self, num_threads):
+    ''' Changes the number of build threads. Surplus threads exit once
+    their current build is finished. '''
+
+    if num_threads < 1:
+      raise ValueError('num_threads must be >= 1')
+    with self._cond:
+      if not self._running:
+        raise RuntimeError('not running')
+      self._size = num_threads
+      for slot in range(num_threads):
+        if slot not in self._threads:
+          self._threads[slot] = Thread(target=self._worker, args=[slot])
+          self._threads[slot].start()
+      self._cond.notify_all()
+
+  def run_jobs(self, build_id, slot, jobs, run):
+    """
+    Runs the *jobs* (of a build matrix or the stages of a pipeline) of the
+    build with the specified ID on the free build threads of this consumer.
+    Used as the `run_jobs` argument of #runner.do_build_() by the thread in
+    *slot* that runs the build, which runs the jobs that no other thread
+    took until all of them finished. Returns the status of every job.
+    """
+
+    with models.session():
+      build = Build.get(id=build_id)
+      for job in jobs:
+        row = models.BuildJob.get(build=build, num=job.num)
+        if row:
+          row.set(name=job.name, status=Build.Status_Queued, worker='',
+            date_started=None, date_finished=None)
+        else:
+          models.BuildJob(build=build, num=job.num, name=job.name)
+    tasks = [JobTask(build_id, job, run) for job in jobs]
+    with self._cond:
+      self._jobs.extend(tasks)
+      self._cond.notify_all()
+    while True:
+      with self._cond:
+        task = next((x for x in self._jobs if x.build_id == build_id), None)
+        if task:
+          self._jobs.remove(task)
+        elif all(x.status for x in tasks):
+          break
+        else:
+          self._cond.wait()
+          continue
+      self._run_job(task, slot)
+    return [x.status for x in tasks]
+
+  def _run_job(self, task, slot):
+    update_job(task.build_id, task.job.num, status=Build.Status_Building,
+      worker=self.name, date_started=datetime.now())
+    with self._cond:
+      cpus = resources.get_slot_cpus(slot, self._size)
+    status = Build.Status_Error
+    try:
+      status = task.run(task.job, cpus)
+    except BaseException as exc:
+      traceback.print_exc()
+    finally:
+      try:
+        update_job(task.build_id, task.job.num, status=status, date_finished=datetime.now())
+      finally:
+        with self._cond:
+          task.status = status
+          self._cond.notify_all()
+
+  def _worker(self, slot):
+    while True:
+      with self._cond:
+        if not self._running or slot >= self._size:
+          self._threads.pop(slot, None)
+          break
+      admission = check_admission()
+      with self._cond:
+        if admission != self.admission:
+          if admission:
+            app.logger.info('Build consumer {} is not starting new builds: {}'
+              .format(self.name, admission))
+          self.admission = admission
+        # Jobs of running builds are taken before new builds.
+        task = self._jobs.popleft() if self._jobs and not admission else None
+      if task:
+        self._run_job(task, slot)
+        continue
+      build_id = None
+      if not admission:
+        try:
+          build_id = self.claim()
+        except BaseException as exc:
+          traceback.print_exc()
+      if build_id is None:
+        with self._cond:
+          if self._running:
+            self._cond.wait(self._sync_interval)
+        continue
+      with self._cond:
+        do_terminate = self._terminate_events[build_id] = Event()
+        cpus = resources.get_slot_cpus(slot, self._size)
+      try:
+        run_jobs = functools.partial(self.run_jobs, build_id, slot)
+        do_build(build_id, do_terminate, cpus, run_jobs)
+      except BaseException as exc:
+        traceback.print_exc()
+      finally:
+        with self._cond:
+          self._terminate_events.pop(build_id)
 
   def is_running(self, build):
     with self._cond:
-      return build.id in self._queue
+      return build.id in self._terminate_events
+
+
+class JobTask(object):
+  ''' A matrix job of a build that waits for a build thread, see
+  :meth:`BuildConsumer.run_jobs`. *status* is set when it finished. '''
+
+  def __init__(self, build_id, job, run):
+    self.build_id = build_id
+    self.job = job
+    self.run = run
+    self.status = None
 
 
 _consumer = BuildConsumer()
@@ -130,33 +334,156 @@ enqueue = _consumer.put
 terminate_build = _consumer.terminate
 run_consumers = _consumer.start
 stop_consumers = _consumer.stop
+resize_consumers = _consumer.resize
+
+
+def claim_queued(worker, query):
+  ''' Claims a build from *query*, a query of queued builds, for the
+  consumer or agent named *worker* and marks it as building. Returns the
+  build or None. Must be called inside a database session.
+
+  Builds are assigned with cache affinity: each repository and ref
+  remembers the worker that built it last (see
+  :class:`models.BuildAffinity`), because its workspace, mirror and
+  dependency caches are warm there. Other workers leave such a build to
+  that worker for up to ``affinity_wait`` seconds after it has been
+  queued, after which any worker takes it. Whether a build went to its
+  preferred worker is recorded in :attr:`Build.affinity`. '''
+
+  query = query.order_by(Build.date_queued, Build.id)
+  candidates = list(query.for_update(skip_locked=True)[:config.affinity_candidates])
+  if not candidates:
+    return None
+
+  preferred = models.BuildAffinity.lookup(candidates)
+  deadline = datetime.now() - timedelta(seconds=config.affinity_wait)
+  build = next((x for x in candidates if preferred.get(x) == worker), None)
+  if build is None:
+    for x in candidates:
+      other = preferred.get(x)
+      if not other or x.date_queued <= deadline or not worker_is_alive(other):
+        build = x
+        break
+  if build is None:
+    return None
+
+  other = preferred.get(build)
+  if not other:
+    build.affinity = Build.Affinity_None
+  elif other == worker:
+    build.affinity = Build.Affinity_Hit
+  else:
+    build.affinity = Build.Affinity_Miss
+  build.status = Build.Status_Building
+  build.date_started = datetime.now()
+  build.worker = worker
+  models.BuildAffinity.record(build)
+  return build
+
+
+def prefetch_build(build):
+  ''' Fetches the commit of the queued *build* into the mirror of its
+  repository in the background, see :mod:`flux.mirror`. '''
+
+  commit_sha = None if build.commit_sha == '0' * 32 else build.commit_sha
+  repo = SimpleNamespace(name=build.repo.name, clone_url=build.repo.clone_url)
+  mirror.prefetch(build.id, repo, commit_sha)
+
+
+def check_admission():
+  ''' Checks the host against the ``admission_max_load``,
+  ``admission_min_free_memory`` and ``admission_min_free_disk`` thresholds.
+  Returns None if a new build may be started, otherwise the reason why
+  not. Thresholds that are None and values that the host does not report
+  are not checked. '''
+
+  if config.admission_max_load is not None and hasattr(os, 'getloadavg'):
+    load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    if load > config.admission_max_load:
+      return 'load average {:.2f} per CPU'.format(load)
+  if config.admission_min_free_memory is not None:
+    free = utils.get_available_memory()
+    if free is not None and free < config.admission_min_free_memory * 1024 ** 2:
+      return '{} MiB of memory available'.format(free // 1024 ** 2)
+  if config.admission_min_free_disk is not None:
+    try:
+      free = shutil.disk_usage(config.build_dir).free
+    except OSError:
+      free = None
+    if free is not None and free < config.admission_min_free_disk * 1024 ** 2:
+      return '{} MiB of disk space free'.format(free // 1024 ** 2)
+  return None
+
+
+def worker_is_alive(worker):
+  ''' Returns False if *worker* is a build agent that is known to be dead.
+  Other consumers are assumed to be alive. '''
+
+  if worker.startswith('agent:'):
+    agent = models.Agent.get(name=worker[len('agent:'):])
+    return agent is not None and agent.is_alive()
+  return True
+
+
+def set_worker_name(name):
+  ''' Sets the name of this process' build consumer. It must be unique
+  among all processes that run builds. '''
+
+  _consumer.name = name
 
 
 def update_queue(consumer=None):
-  ''' Make sure all builds in the database that are still queued
-  are actually queued in the BuildConsumer. '''
+  ''' Marks the builds that this consumer claimed but that are no
+  longer running (eg. because the process was killed) as stopped. '''
 
   if consumer is None:
     consumer = _consumer
   with models.session():
-    for build in select(x for x in Build if x.status == Build.Status_Queued):
-      enqueue(build)
-    for build in select(x for x in Build if x.status == Build.Status_Building):
+    for build in select(x for x in Build if x.status == Build.Status_Building
+                        and (x.worker == consumer.name or x.worker == '')):
       if not consumer.is_running(build):
         build.status = Build.Status_Stopped
+        for job in build.jobs:
+          if job.status in (Build.Status_Queued, Build.Status_Building):
+            job.status = Build.Status_Stopped
+
+def queue_is_full():
+  ''' Returns True if the number of queued builds reached the
+  ``max_queued_builds`` configuration value. Must be called inside
+  a database session. '''
+
+  if config.max_queued_builds is None:
+    return False
+  count = select(x for x in Build if x.status == Build.Status_Queued).count()
+  return count >= config.max_queued_builds
+
+def update_build(build_id, **fields):
+  ''' Sets the *fields* of the build with the specified ID. '''
 
-def deleteGitFolder(build_path):
-  shutil.rmtree(os.path.join(build_path, '.git'))
+  with models.session():
+    build = Build.get(id=build_id)
+    for key, value in fields.items():
+      setattr(build, key, value)
 
-def do_build(build_id, terminate_event):
+def update_job(build_id, num, **fields):
+  ''' Sets the *fields* of the matrix job *num* of a build. '''
+
+  with models.session():
+    job = models.BuildJob.get(build=build_id, num=num)
+    if job:
+      job.set(**fields)
+
+def do_build(build_id, terminate_event, cpus=None, run_jobs=None):
   """
   Performs the build step for the build in the database with the specified
-  *build_id*.
+  *build_id*. The build script is pinned to the set of *cpus*, if any. The
+  jobs of a build matrix are run with *run_jobs*, see #runner.do_build_().
   """
 
   logfile = None
   logger = None
   status = None
+  work_path = None
 
   with contextlib.ExitStack() as stack:
     try:
@@ -166,21 +493,22 @@ def do_build(build_id, terminate_event):
           build = Build.get(id=build_id)
           app.logger.info('Build {}#{} started.'.format(build.repo.name, build.num))
 
-          build.status = Build.Status_Building
-          build.date_started = datetime.now()
-
           build_path = build.path()
           override_path = build.path(Build.Data_OverrideDir)
+          stage_cache = build.path(Build.Data_StageCache)
           utils.makedirs(os.path.dirname(build_path))
           logfile = stack.enter_context(open(build.path(build.Data_Log), 'w'))
           logger = utils.create_logger(logfile)
 
           # Prefetch the repository member as it is required in do_build_().
           build.repo
+          work_path = stack.enter_context(resources.workspace(build, build_path, logger))
 
         # Execute the actual build process (must not perform writes to the
         # 'build' object as the DB session is over).
-        if do_build_(build, build_path, override_path, logger, logfile, terminate_event):
+        update = functools.partial(update_build, build_id)
+        if do_build_(build, work_path, override_path, logger, logfile, terminate_event,
+                     update, cpus, run_jobs, stage_cache):
           status = Build.Status_Success
         else:
           if terminate_event.is_set():
@@ -190,10 +518,10 @@ def do_build(build_id, terminate_event):
 
       finally:
         # Create a ZIP from the build directory.
-        if os.path.isdir(build_path):
+        if work_path and os.path.isdir(work_path):
           logger.info('[Flux]: Zipping build directory...')
-          utils.zipdir(build_path, build_path + '.zip')
-          utils.rmtree(build_path, remove_write_protection=True)
+          utils.zipdir(work_path, build_path + '.zip')
+          utils.rmtree(work_path, remove_write_protection=True)
           logger.info('[Flux]: Done')
 
     except BaseException as exc:
@@ -213,119 +541,3 @@ def do_build(build_id, terminate_event):
         build.date_finished = datetime.now()
 
   return status == Build.Status_Success
-
-
-def do_build_(build, build_path, override_path, logger, logfile, terminate_event):
-  logger.info('[Flux]: build {}#{} started'.format(build.repo.name, build.num))
-
-  # Clone the repository.
-  if build.repo and os.path.isfile(utils.get_repo_private_key_path(build.repo)):
-    identity_file = utils.get_repo_private_key_path(build.repo)
-  else:
-    identity_file = config.ssh_identity_file
-
-  ssh_command = utils.ssh_command(None, identity_file=identity_file)  # Enables batch mode
-  env = {'GIT_SSH_COMMAND': ' '.join(map(shlex.quote, ssh_command))}
-  logger.info('[Flux]: GIT_SSH_COMMAND={!r}'.format(env['GIT_SSH_COMMAND']))
-  clone_cmd = ['git', 'clone', build.repo.clone_url, build_path, '--recursive']
-  res = utils.run(clone_cmd, logger, env=env)
-  if res != 0:
-    logger.error('[Flux]: unable to clone repository')
-    return False
-
-  if terminate_event.is_set():
-    logger.info('[Flux]: build stopped')
-    return False
-
-  if build.ref and build.commit_sha == ("0" * 32):
-    build_start_point = build.ref
-    is_ref_build = True
-  else:
-    build_start_point = build.commit_sha
-    is_ref_build = False
-
-  # Checkout the correct build_start_point.
-  checkout_cmd = ['git', 'checkout', '-q', build_start_point]
-  res = utils.run(checkout_cmd, logger, cwd=build_path)
-  if res != 0:
-    logger.error('[Flux]: failed to checkout {!r}'.format(build_start_point))
-    return False
-
-  # If checkout was initiated by Start build, update commit_sha and ref of build
-  if is_ref_build:
-    # update commit sha
-    get_ref_sha_cmd = ['git', 'rev-parse', 'HEAD']
-    res_ref_sha, res_ref_sha_stdout = utils.run(get_ref_sha_cmd, logger, cwd=build_path, return_stdout=True)
-    if res_ref_sha == 0 and res_ref_sha_stdout != None:
-      with models.session():
-        Build.get(id=build.id).commit_sha = res_ref_sha_stdout.strip()
-    else:
-      logger.error('[Flux]: failed to read current sha')
-      return False
-    # update ref; user could enter just branch name, e.g 'master'
-    get_ref_cmd = ['git', 'rev-parse', '--symbolic-full-name', build_start_point]
-    res_ref, res_ref_stdout = utils.run(get_ref_cmd, logger, cwd=build_path, return_stdout=True)
-    if res_ref == 0 and res_ref_stdout != None and res_ref_stdout.strip() != 'HEAD' and res_ref_stdout.strip() != '':
-      with models.session():
-        Build.get(id=build.id).ref = res_ref_stdout.strip()
-    elif res_ref_stdout.strip() == '':
-      # keep going, used ref was probably commit sha
-      pass
-    else:
-      logger.error('[Flux]: failed to read current ref')
-      return False
-
-  if terminate_event.is_set():
-    logger.info('[Flux]: build stopped')
-    return False
-
-  # Deletes .git folder before build, if is configured so.
-  if config.git_folder_handling == GitFolderHandling.DELETE_BEFORE_BUILD or config.git_folder_handling == None:
-    logger.info('[Flux]: removing .git folder before build')
-    deleteGitFolder(build_path)
-
-  # Copy over overridden files if any
-  if os.path.exists(override_path):
-    dir_util.copy_tree(override_path, build_path)
-
-  # Find the build script that we need to execute.
-  script_fn = None
-  for fname in config.build_scripts:
-    script_fn = os.path.join(build_path, fname)
-    if os.path.isfile(script_fn):
-      break
-    script_fn = None
-
-  if not script_fn:
-    choices = '{' + ','.join(map(str, config.build_scripts)) + '}'
-    logger.error('[Flux]: no build script found, choices are ' + choices)
-    return False
-
-  # Make sure the build script is executable.
-  st = os.stat(script_fn)
-  os.chmod(script_fn, st.st_mode | stat.S_IEXEC)
-
-  # Execute the script.
-  logger.info('[Flux]: executing {}'.format(os.path.basename(script_fn)))
-  logger.info('$ ' + shlex.quote(script_fn))
-  popen = subprocess.Popen([script_fn], cwd=build_path,
-    stdout=logfile, stderr=subprocess.STDOUT, stdin=None)
-
-  # Wait until the process finished or the terminate event is set.
-  while popen.poll() is None and not terminate_event.is_set():
-    time.sleep(0.5)
-  if terminate_event.is_set():
-    try:
-      popen.terminate()
-    except OSError as exc:
-      logger.exception(exc)
-    logger.error('[Flux]: build stopped. build script terminated')
-    return False
-
-  # Deletes .git folder after build, if is configured so.
-  if config.git_folder_handling == GitFolderHandling.DELETE_AFTER_BUILD:
-    logger.info('[Flux]: removing .git folder after build')
-    deleteGitFolder(build_path)
-
-  logger.info('[Flux]: exit-code {}'.format(popen.returncode))
-  return popen.returncode == 0
@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+'''
+A small, thread-safe LRU cache with hit and miss counters.
+'''
+
+from threading import Lock
+
+import collections
+
+
+class LRUCache(object):
+  ''' A mapping with at most *max_size* entries. When it is full, the
+  least recently used entry is evicted. '''
+
+  def __init__(self, max_size):
+    if max_size < 1:
+      raise ValueError('max_size must be >= 1')
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = Lock()
+    self._data = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._data[key]
+      except KeyError:
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._data[key] = value
+      self._data.move_to_end(key)
+      while len(self._data) > self.max_size:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def discard(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def discard_if(self, predicate):
+    ''' Removes all entries whose key matches *predicate*. '''
+
+    with self._lock:
+      for key in [k for k in self._data if predicate(k)]:
+        del self._data[key]
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def stats(self):
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        'size': len(self._data),
+        'max_size': self.max_size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': (self.hits / total) if total else None,
+      }
@@ -27,6 +27,69 @@ import sys
 
 loaded = False
 
+# Default values for options that have been added after the initial
+# release. Configuration files written for older versions of Flux CI
+# do not contain these, see `flux_config.py` for their documentation.
+hook_rate_limit_per_repo = None
+hook_rate_limit_per_ip = None
+max_queued_builds = None
+poll_workers = 0
+poll_interval = 60
+poll_max_interval = 900
+poll_jitter = 0.2
+auto_migrate = True
+login_revocation_refresh = 10
+login_token_sweep_interval = 3600
+login_user_cache_ttl = 10
+lookup_cache_size = 1024
+web_server = 'development'
+web_workers = 4
+web_threads = 8
+web_keepalive = 5
+web_timeout = 60
+trusted_proxies = 0
+build_sync_interval = 5
+build_in_web = True
+agent_secret = None
+agent_timeout = 60
+agent_heartbeat_interval = 10
+agent_poll_timeout = 30
+agent_server_url = None
+agent_name = None
+agent_labels = []
+agent_capacity = 1
+agent_work_dir = None
+affinity_wait = 15
+affinity_candidates = 20
+mirror_dir = None
+prefetch_threads = 2
+admission_max_load = None
+admission_min_free_memory = None
+admission_min_free_disk = None
+cgroup_root = None
+build_limit_cpu = None
+build_limit_memory = None
+build_limit_pids = None
+build_cpu_pinning = False
+build_reserved_cpus = 1
+build_nice = None
+build_ionice = None
+build_definition = '.flux-build.json'
+build_max_jobs = 64
+ram_workspace_dir = None
+ram_workspace_size = None
+override_hardlinks = False
+upload_chunk_size = 8 * 1024 * 1024
+upload_expiry = 86400
+ssh_key_type = 'ed25519'
+ssh_key_pool_size = 0
+ssh_control_dir = None
+ssh_control_persist = 60
+health_check_workers = 16
+health_check_per_host = 4
+health_check_timeout = 30
+health_check_ttl = 3600
+
 
 def load(filename=None):
   global loaded
@@ -1,8 +1,26 @@
 # -*- coding: utf8 -*-
 
+from flux.cache import LRUCache
+from datetime import datetime
+
 import io
 import os
 import shutil
+import stat
+
+#: The number of directory listings that are kept in memory.
+LISTING_CACHE_SIZE = 256
+
+#: The keys by which #list_folder() can sort the files.
+SORT_KEYS = {
+  'name': lambda f: f.filename.lower(),
+  'size': lambda f: f.filesize,
+  'modified': lambda f: f.mtime,
+}
+
+#: Maps the path of a directory to its modification time and listing, see
+#: #scan_folder(). The hit and miss counters are reported at `/api/stats`.
+listings = LRUCache(LISTING_CACHE_SIZE)
 
 
 def split_url_path(path):
@@ -21,28 +39,56 @@ def split_url_path(path):
   return separator.join(parts[0:2]), separator.join(parts[2:])
 
 
-def list_folder(cwd):
+def list_folder(cwd, sort='name', reverse=False):
   """
-  List folder on *cwd* path as list of *File*.
+  List folder on *cwd* path as list of *File*, folders first.
 
   # Parameters
   cwd (str): The absolute path to be listed.
+  sort (str): One of the #SORT_KEYS.
+  reverse (bool): Sort in descending order.
 
   # Return
   list (File): The list of files and folders listed in path.
   """
 
-  data = sorted(os.listdir(cwd))
-  dirs = []
-  files = []
-  for filename in data:
-    file = File(filename, cwd)
-    if file.type == File.TYPE_FOLDER:
-      dirs.append(file)
-    else:
-      files.append(file)
-  result = dirs + files
-  return result
+  files = scan_folder(cwd)
+  dirs = [x for x in files if x.type == File.TYPE_FOLDER]
+  files = [x for x in files if x.type != File.TYPE_FOLDER]
+  key = SORT_KEYS[sort]
+  return sorted(dirs, key=key, reverse=reverse) + sorted(files, key=key, reverse=reverse)
+
+
+def scan_folder(cwd):
+  """
+  Returns the list of *File*s in *cwd*, which is read with #os.scandir()
+  (thus it needs at most one `stat()` per file) and cached in #listings
+  until the modification time of the directory changes. Changes of the
+  content of a file do not change it, see #invalidate_listing().
+  """
+
+  cwd = os.path.normpath(cwd)
+  mtime = os.stat(cwd).st_mtime_ns
+  cached = listings.get(cwd)
+  if cached and cached[0] == mtime:
+    return cached[1]
+  with os.scandir(cwd) as entries:
+    files = [File.from_entry(entry, cwd) for entry in entries]
+  listings.put(cwd, (mtime, files))
+  return files
+
+
+def invalidate_listing(cwd):
+  """
+  Drops the cached listing of the directory *cwd* after a file in it has
+  been changed, and updates the modification time of the directory so
+  that other processes read it again as well.
+  """
+
+  cwd = os.path.normpath(cwd)
+  listings.discard(cwd)
+  if os.path.isdir(cwd):
+    os.utime(cwd)
 
 
 def create_folder(cwd, folder_name):
@@ -196,11 +242,25 @@ class File:
   TYPE_FOLDER = 'folder'
   TYPE_FILE = 'file'
 
-  def __init__(self, filename, path):
+  def __init__(self, filename, path, st=None):
     full_path = os.path.join(path, filename)
+    if st is None:
+      st = os.stat(full_path)
 
-    self.type = File.TYPE_FOLDER if os.path.isdir(full_path) else File.TYPE_FILE
+    self.type = File.TYPE_FOLDER if stat.S_ISDIR(st.st_mode) else File.TYPE_FILE
     self.filename = filename
     self.path = path
-    self.filesize = os.path.getsize(full_path) if self.type == File.TYPE_FILE else 0
+    self.filesize = st.st_size if self.type == File.TYPE_FILE else 0
     self.filesize_readable = human_readable_size(self.filesize)
+    self.mtime = datetime.fromtimestamp(st.st_mtime)
+
+  @classmethod
+  def from_entry(cls, entry, path):
+    ''' Creates a *File* from an #os.DirEntry, whose `stat()` result is
+    cached. Broken symlinks are listed as files. '''
+
+    try:
+      st = entry.stat()
+    except FileNotFoundError:
+      st = entry.stat(follow_symlinks=False)
+    return cls(entry.name, path, st)
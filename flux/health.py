@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+'''
+Health check of the repositories. Every repository is checked with
+``git ls-remote`` to find the repositories whose clone URL or deploy key
+no longer works. The repositories are checked concurrently on at most
+``health_check_workers`` threads, of which at most ``health_check_per_host``
+connect to the same Git server at a time.
+
+The results are stored as :class:`RepoHealth` and are reused for
+``health_check_ttl`` seconds, thus repeating a check only verifies the
+repositories whose result expired (unless it is forced). A check runs in
+the background, every process runs at most one at a time.
+'''
+
+from flux import app, config, models, utils
+from flux.models import select, Repository, RepoHealth
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import BoundedSemaphore, Lock, Thread
+
+import os
+import re
+import subprocess
+import urllib.parse
+
+#: A repository to check, with the attributes that #utils.get_git_ssh_env()
+#: needs, so that no database session is held while Git runs.
+Target = namedtuple('Target', 'id name clone_url')
+
+
+def clone_host(clone_url):
+  ''' Returns the host of a Git *clone_url*, including SCP-like URLs
+  (``git@host:owner/repo.git``), or an empty string for local paths. '''
+
+  if '://' in clone_url:
+    return (urllib.parse.urlparse(clone_url).hostname or '').lower()
+  match = re.match(r'^(?:[^@/]+@)?([^:/]+):', clone_url)
+  return match.group(1).lower() if match else ''
+
+
+def check_remote(target):
+  """
+  Checks whether the refs of *target* can be listed.
+
+  # Return
+  tuple of (bool, str): Whether the check succeeded and the first error
+    that Git or SSH printed if it failed.
+  """
+
+  env = dict(os.environ, GIT_TERMINAL_PROMPT='0', **utils.get_git_ssh_env(target))
+  command = ['git', 'ls-remote', target.clone_url, 'HEAD']
+  try:
+    proc = subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+      timeout=config.health_check_timeout)
+  except subprocess.TimeoutExpired:
+    return False, 'timed out after {} seconds'.format(config.health_check_timeout)
+  except OSError as exc:
+    return False, str(exc)
+  if proc.returncode == 0:
+    return True, ''
+  lines = [x.strip() for x in proc.stderr.decode(errors='replace').splitlines()]
+  lines = [x for x in lines if x and not x.lower().startswith('warning:')]
+  return False, (lines[0] if lines else 'git ls-remote exited with code {}'.format(proc.returncode))[:200]
+
+
+def save_result(target, ok, message):
+  with models.session():
+    repo = Repository.get(id=target.id)
+    if not repo or repo.clone_url != target.clone_url:
+      return
+    if repo.health:
+      repo.health.set(ok=ok, message=message, date_checked=datetime.now())
+    else:
+      RepoHealth(repo=repo, ok=ok, message=message, date_checked=datetime.now())
+
+
+def check_repositories(force=False):
+  """
+  Checks all repositories, or only those without a fresh result unless
+  *force* is True, and stores the results.
+
+  # Return
+  tuple of (int, int): The number of repositories checked and failed.
+  """
+
+  with models.session():
+    targets = [Target(x.id, x.name, x.clone_url) for x in select(x for x in Repository).prefetch(Repository.health)
+               if force or not x.health or not x.health.is_fresh()]
+  if not targets:
+    return 0, 0
+
+  by_host = {}
+  for target in targets:
+    by_host.setdefault(clone_host(target.clone_url), []).append(target)
+  hosts = {x: BoundedSemaphore(config.health_check_per_host) for x in by_host}
+
+  def check(target):
+    with hosts[clone_host(target.clone_url)]:
+      ok, message = check_remote(target)
+    save_result(target, ok, message)
+    if not ok:
+      app.logger.warning('Health check of {} failed: {}'.format(target.name, message))
+    return ok
+
+  # Interleave the hosts, so that the threads are not all blocked on the
+  # semaphore of the host that has the most repositories.
+  queues = list(by_host.values())
+  targets = [q[i] for i in range(max(map(len, queues))) for q in queues if i < len(q)]
+
+  with ThreadPoolExecutor(max_workers=config.health_check_workers) as executor:
+    results = list(executor.map(check, targets))
+  return len(results), results.count(False)
+
+
+class HealthChecker(object):
+  ''' Runs :func:`check_repositories` in a background thread. '''
+
+  def __init__(self):
+    self._lock = Lock()
+    self._thread = None
+
+  def is_running(self):
+    with self._lock:
+      return self._thread is not None
+
+  def start(self, force=False):
+    ''' Starts a health check. Returns False if one is already running. '''
+
+    with self._lock:
+      if self._thread:
+        return False
+      self._thread = Thread(target=self._run, args=[force], daemon=True)
+      self._thread.start()
+      return True
+
+  def _run(self, force):
+    try:
+      checked, failed = check_repositories(force)
+      app.logger.info('Health check: {} repositories checked, {} failed'.format(checked, failed))
+    except BaseException as exc:
+      app.logger.exception(exc)
+    finally:
+      with self._lock:
+        self._thread = None
+
+
+_checker = HealthChecker()
+run_check = _checker.start
+is_checking = _checker.is_running
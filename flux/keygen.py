@@ -0,0 +1,163 @@
+# -*- coding: utf8 -*-
+'''
+Generates the SSH keypairs of repositories in the background, so that a
+request does not wait for the generation of a 4096-bit RSA key. While a
+key is generated, a marker file exists in the customs directory of the
+repository, thus every web server process can tell that it is pending
+(see :func:`status`).
+
+If ``ssh_key_pool_size`` is set, every process keeps as many keypairs
+generated in advance and a repository gets one of them immediately. The
+pool is only held in memory and is dropped in a forked process, so that
+no two processes hand out the same key.
+'''
+
+from flux import app, config, utils
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import os
+import time
+
+#: The number of threads that generate keys.
+KEYGEN_THREADS = 2
+
+#: The number of seconds after which a pending key generation is
+#: considered to have failed (eg. because the process was terminated).
+PENDING_TIMEOUT = 300
+
+
+def pending_path(repo):
+  return os.path.join(utils.get_customs_path(repo), 'keygen.pending')
+
+
+def status(repo):
+  ''' Returns "ready" if *repo* has a keypair, "pending" if it is being
+  generated or "none". '''
+
+  if os.path.isfile(utils.get_repo_public_key_path(repo)):
+    return 'ready'
+  try:
+    mtime = os.path.getmtime(pending_path(repo))
+  except OSError:
+    return 'none'
+  return 'pending' if time.time() - mtime < PENDING_TIMEOUT else 'none'
+
+
+def save_keypair(private_key_path, private_key, public_key):
+  ''' Writes a keypair. The private key is only readable by the owner, the
+  public key is written last, see :func:`status`. '''
+
+  utils.makedirs(os.path.dirname(private_key_path))
+  fd = os.open(private_key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  with open(fd, 'w') as fp:
+    fp.write(private_key)
+  os.chmod(private_key_path, 0o600)
+  with open(private_key_path + '.pub', 'w') as fp:
+    fp.write(public_key)
+
+
+class KeyGenerator(object):
+  ''' Generates keypairs on a thread pool that is started on first use
+  (after a fork, the pool of the parent process is not inherited). '''
+
+  def __init__(self):
+    self._lock = Lock()
+    self._executor = None
+    self._pid = None
+    self._pool = deque()
+    self._filling = 0
+
+  def _get_executor(self):
+    # Must be called with the lock held.
+    if self._pid != os.getpid():
+      self._executor = ThreadPoolExecutor(max_workers=KEYGEN_THREADS)
+      self._pid = os.getpid()
+      self._pool.clear()
+      self._filling = 0
+    return self._executor
+
+  def stop(self, join=True):
+    with self._lock:
+      executor, self._executor, self._pid = self._executor, None, None
+      self._pool.clear()
+    if executor:
+      executor.shutdown(wait=join)
+
+  def generate(self, repo):
+    """
+    Generates a keypair for *repo*. A key from the pool is saved right
+    away, otherwise the key is generated in the background.
+
+    # Return
+    bool: True if the keypair has been saved, False if it is pending.
+    """
+
+    key_type = config.ssh_key_type
+    private_key_path = utils.get_repo_private_key_path(repo, key_type)
+    comment = repo.name + '@FluxCI'
+    with self._lock:
+      executor = self._get_executor()
+      key = None
+      while self._pool and not key:
+        key = self._pool.popleft()
+        if key[0] != key_type:
+          key = None
+    if key:
+      save_keypair(private_key_path, key[1], key[2] + ' ' + comment)
+      self.fill()
+      return True
+
+    marker = pending_path(repo)
+    utils.makedirs(os.path.dirname(marker))
+    open(marker, 'w').close()
+    executor.submit(self._generate, key_type, private_key_path, comment, marker)
+    self.fill()
+    return False
+
+  def fill(self):
+    ''' Generates keys for the pool in the background until it has
+    ``ssh_key_pool_size`` keys. '''
+
+    with self._lock:
+      missing = config.ssh_key_pool_size - len(self._pool) - self._filling
+      if missing <= 0:
+        return
+      executor = self._get_executor()
+      self._filling += missing
+      for i in range(missing):
+        executor.submit(self._fill_one, self._pid)
+
+  def _generate(self, key_type, private_key_path, comment, marker):
+    try:
+      private_key, public_key = utils.generate_ssh_keypair(comment, key_type)
+      save_keypair(private_key_path, private_key, public_key)
+      app.logger.info('SSH keypair {} generated'.format(private_key_path))
+    except BaseException as exc:
+      app.logger.exception(exc)
+    finally:
+      try:
+        os.remove(marker)
+      except OSError:
+        pass
+
+  def _fill_one(self, pid):
+    key_type = config.ssh_key_type
+    try:
+      key = (key_type,) + utils.generate_ssh_keypair(None, key_type)
+    except BaseException as exc:
+      app.logger.exception(exc)
+      key = None
+    with self._lock:
+      if self._pid != pid:
+        return
+      self._filling -= 1
+      if key:
+        self._pool.append(key)
+
+
+_generator = KeyGenerator()
+generate = _generator.generate
+fill_pool = _generator.fill
+stop_generator = _generator.stop
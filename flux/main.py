@@ -23,14 +23,31 @@
 
 import argparse
 import re
+import signal
+import socket
 import subprocess
 import sys
 import os
+import threading
 
 
 def get_argument_parser(prog=None):
   parser = argparse.ArgumentParser(prog=prog)
+  parser.add_argument('command', nargs='?', choices=['web', 'worker', 'agent'],
+    help='"web" is the same as --web, "worker" runs builds without the webserver, '
+    '"agent" runs builds on a host without access to the database')
   parser.add_argument('--web', action='store_true', help='launch builtin webserver')
+  parser.add_argument('--name', help='name of the build worker or agent, must be '
+    'unique among all processes that run builds (default: <hostname>:worker '
+    'or agent_name, or <hostname>:<pid> for an agent)')
+  parser.add_argument('-j', '--threads', type=int, help='number of parallel '
+    'builds of the build worker or agent (default: parallel_builds or agent_capacity)')
+  parser.add_argument('--server', help='URL of the Flux CI server for the agent '
+    '(default: agent_server_url)')
+  parser.add_argument('--labels', help='comma separated labels of the agent '
+    '(default: agent_labels)')
+  parser.add_argument('--migrate', action='store_true', help='apply pending database migrations')
+  parser.add_argument('--check-db', action='store_true', help='report pending database migrations and missing indexes')
   parser.add_argument('-c','--config-file', help='Flux CI config file to load')
   return parser
 
@@ -38,8 +55,10 @@ def get_argument_parser(prog=None):
 def main(argv=None, prog=None):
   parser = get_argument_parser(prog)
   args = parser.parse_args(argv)
+  if args.command == 'web':
+    args.web = True
 
-  if not args.web:
+  if not (args.web or args.command in ('worker', 'agent') or args.migrate or args.check_db):
     parser.print_usage()
     return 0
 
@@ -52,9 +71,34 @@ def main(argv=None, prog=None):
   from flux import config
   config.load(args.config_file)
 
+  if args.migrate or args.check_db:
+    return check_db(migrate=args.migrate)
+  if args.command == 'worker':
+    return start_worker(args.name, args.threads)
+  if args.command == 'agent':
+    labels = args.labels.split(',') if args.labels is not None else None
+    return start_agent(args.server, args.name, labels, args.threads)
   start_web()
 
 
+def check_db(migrate=False):
+  """
+  Applies the pending database migrations if *migrate* is #True, then
+  reports the problems that remain with the database schema.
+  """
+
+  from flux import config
+  config.auto_migrate = migrate
+  from flux import models, migrations
+
+  problems = migrations.check(models.db)
+  for problem in problems:
+    print('Error: {}'.format(problem))
+  if not problems:
+    print('Database schema is up to date (version {}).'.format(migrations.get_version(models.db)))
+  return 1 if problems else 0
+
+
 def check_requirements():
   """
   Checks some system requirements. If they are not met, prints an error and
@@ -72,6 +116,92 @@ def check_requirements():
     sys.exit(1)
 
 
+def make_dirs():
+  """
+  Ensure that some of the required directories exist.
+  """
+
+  from flux import config
+  for dirname in [config.root_dir, config.build_dir, config.override_dir, config.customs_dir]:
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+
+def start_worker(name=None, num_threads=None):
+  """
+  Runs the builds without the web server until the process receives
+  SIGINT or SIGTERM. Running builds are stopped on exit.
+  """
+
+  check_requirements()
+
+  from flux import app, build, config, mirror, models, utils
+  make_dirs()
+
+  name = name or socket.gethostname() + ':worker'
+  num_threads = num_threads or config.parallel_builds
+  build.set_worker_name(name)
+  build.update_queue()
+
+  stop = threading.Event()
+  signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+  print('Starting build worker {!r} with {} thread(s)...'.format(name, num_threads))
+  if config.mirror_dir and config.prefetch_threads > 0:
+    mirror.run_prefetcher(num_threads=config.prefetch_threads)
+  build.run_consumers(num_threads=num_threads, sync_interval=config.build_sync_interval)
+  try:
+    while not stop.wait(1):
+      pass
+  except KeyboardInterrupt:
+    pass
+  finally:
+    print('Stopping build worker...')
+    build.stop_consumers()
+    mirror.stop_prefetcher()
+    utils.close_ssh_masters()
+  return 0
+
+
+def start_agent(server=None, name=None, labels=None, capacity=None):
+  """
+  Runs a build agent that claims builds from the Flux CI server at
+  *server* until the process receives SIGINT or SIGTERM.
+  """
+
+  check_requirements()
+
+  import logging
+  from flux import config, utils
+  from flux.agent_runner import AgentClient, BuildAgent
+
+  secret = os.getenv('FLUX_AGENT_SECRET') or config.agent_secret
+  if not secret:
+    print('Error: agent_secret is not set')
+    return 1
+  server = server or config.agent_server_url or config.app_url
+  name = name or config.agent_name or '{}:{}'.format(socket.gethostname(), os.getpid())
+  labels = [x.strip() for x in (config.agent_labels if labels is None else labels) if x.strip()]
+  capacity = capacity or config.agent_capacity
+  work_dir = config.agent_work_dir or os.path.join(config.root_dir, 'agent')
+
+  logging.basicConfig(level=logging.INFO, format='[%(asctime)-15s - %(levelname)s]: %(message)s')
+  agent = BuildAgent(AgentClient(server, name, secret), labels, capacity, work_dir)
+  signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+  thread = threading.Thread(target=agent.run)
+  thread.start()
+  try:
+    while thread.is_alive():
+      thread.join(1)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    agent.stop()
+    thread.join()
+    utils.close_ssh_masters()
+  return 0
+
+
 def start_web():
   check_requirements()
 
@@ -86,19 +216,22 @@ def start_web():
   print('DEBUG = {}'.format(config.debug))
   print('SERVER_NAME = {}'.format(config.server_name))
 
-  from flux import views, build, models
+  from flux import views, agents, build, keygen, mirror, models, poll, server, tokens
   from urllib.parse import urlparse
 
-  # Ensure that some of the required directories exist.
-  for dirname in [config.root_dir, config.build_dir, config.override_dir, config.customs_dir]:
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
+  make_dirs()
 
   # Make sure the root user exists and has all privileges, and that
   # the password is up to date.
   with models.session():
     models.User.create_or_update_root()
 
+  # Take the client address and scheme from the headers of the proxies.
+  if config.trusted_proxies:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.trusted_proxies,
+      x_proto=config.trusted_proxies)
+
   # Create a dispatcher for the sub-url under which the app is run.
   url_prefix = urlparse(config.app_url).path
   if url_prefix and url_prefix != '/':
@@ -110,16 +243,39 @@ def start_web():
   else:
     target_app = app
 
-  app.logger.info('Starting builder threads...')
-  build.run_consumers(num_threads=config.parallel_builds)
-  build.update_queue()
+  # Must be created before any threads are started, see GunicornServer.
+  web_server = server.create_server(target_app)
+
+  if config.build_in_web:
+    app.logger.info('Starting builder threads...')
+    build.set_worker_name(socket.gethostname() + ':web')
+    build.update_queue()
+    if config.mirror_dir and config.prefetch_threads > 0:
+      mirror.run_prefetcher(num_threads=config.prefetch_threads)
+    build.run_consumers(num_threads=config.parallel_builds,
+      sync_interval=config.build_sync_interval)
+  app.logger.info('Starting login token sweeper...')
+  tokens.run_sweeper()
+  if config.agent_secret:
+    app.logger.info('Starting build agent monitor...')
+    agents.run_monitor()
+  if config.poll_workers > 0:
+    app.logger.info('Starting repository poller...')
+    poll.run_poller(num_workers=config.poll_workers)
   try:
-    from werkzeug.serving import run_simple
-    run_simple(config.host, config.port, target_app,
-      use_debugger=config.debug, use_reloader=False)
+    web_server.serve_forever()
   finally:
-    app.logger.info('Stopping builder threads...')
-    build.stop_consumers()
+    app.logger.info('Stopping repository poller...')
+    poll.stop_poller()
+    agents.stop_monitor()
+    keygen.stop_generator(join=False)
+    app.logger.info('Stopping login token sweeper...')
+    tokens.stop_sweeper()
+    if config.build_in_web:
+      app.logger.info('Stopping builder threads...')
+      build.stop_consumers()
+      mirror.stop_prefetcher()
+    utils.close_ssh_masters()
 
 
 _entry_point = lambda: sys.exit(main())
@@ -0,0 +1,316 @@
+# -*- coding: utf8 -*-
+"""
+Versioned schema migrations. New tables are created by PonyORM, but it
+does not alter tables that already exist, which is what the migrations
+in this module take care of.
+
+The version of the database schema is stored in the `flux_schema` table.
+On startup, every migration with a higher version is applied in order
+(unless `auto_migrate` is disabled in the configuration, in which case
+the pending migrations are only reported). New migrations are added to
+the end of this module with the #migration() decorator and the next free
+version number, existing migrations must never be changed.
+"""
+
+import collections
+import pony.orm as orm
+
+#: The tables with an integer `id` primary key.
+ID_TABLES = ['users', 'logintokens', 'repos', 'builds']
+
+#: Represents an index that the models expect to exist.
+Index = collections.namedtuple('Index', 'name table columns')
+
+#: The indexes created by migrations, checked by #check_indexes().
+INDEXES = []
+
+#: List of (version, function) tuples, in the order of the versions.
+MIGRATIONS = []
+
+
+def migration(version):
+  """
+  Decorator that registers a migration function. The function accepts the
+  #orm.Database as its only argument and is called inside a database
+  session.
+  """
+
+  def decorator(func):
+    if MIGRATIONS and MIGRATIONS[-1][0] >= version:
+      raise RuntimeError('migration versions must be increasing')
+    MIGRATIONS.append((version, func))
+    return func
+  return decorator
+
+
+def index(name, table, columns):
+  """
+  Registers an #Index that is expected to exist in the database. It must
+  be created by a migration with #create_index().
+  """
+
+  result = Index(name, table, columns)
+  INDEXES.append(result)
+  return result
+
+
+def get_version(db):
+  with orm.db_session:
+    db.execute('CREATE TABLE IF NOT EXISTS flux_schema (version INTEGER NOT NULL)')
+    row = db.execute('SELECT MAX(version) FROM flux_schema').fetchone()
+    return (row[0] if row else None) or 0
+
+
+def get_pending(db):
+  " Returns a list of the (version, function) tuples that are not applied yet. "
+
+  version = get_version(db)
+  return [x for x in MIGRATIONS if x[0] > version]
+
+
+def upgrade(db, logger=None):
+  """
+  Applies all pending migrations to the database *db*. Every migration is
+  committed separately together with the new schema version.
+  """
+
+  for version, func in get_pending(db):
+    if logger:
+      logger.info('Applying database migration {} ({})'.format(version, func.__name__))
+    with orm.db_session:
+      func(db)
+      db.execute('DELETE FROM flux_schema')
+      db.execute('INSERT INTO flux_schema (version) VALUES ({})'.format(int(version)))
+
+
+def check(db):
+  """
+  Checks the database *db* for pending migrations and missing indexes.
+
+  # Return
+  list of str: A description of every problem that was found.
+  """
+
+  problems = []
+  for version, func in get_pending(db):
+    problems.append('migration {} ({}) is not applied'.format(version, func.__name__))
+  for index in check_indexes(db):
+    problems.append('index {} on {} ({}) is missing'.format(
+      index.name, index.table, ', '.join(index.columns)))
+  return problems
+
+
+def check_indexes(db):
+  " Returns a list of the #INDEXES that do not exist in the database. "
+
+  with orm.db_session:
+    return [x for x in INDEXES if not has_index(db, x.table, x.name)]
+
+
+def has_index(db, table, name):
+  provider = db.provider_name
+  if provider == 'sqlite':
+    sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND name = '{}'"
+  elif provider == 'postgres':
+    sql = ("SELECT indexname FROM pg_indexes "
+           "WHERE schemaname = current_schema() AND indexname = '{}'")
+  elif provider == 'mysql':
+    sql = ("SELECT index_name FROM information_schema.statistics "
+           "WHERE table_schema = DATABASE() AND index_name = '{}'")
+  else:
+    raise RuntimeError('unsupported database provider: {!r}'.format(provider))
+  return db.execute(sql.format(name)).fetchone() is not None
+
+
+def has_column(db, table, column):
+  provider = db.provider_name
+  if provider == 'sqlite':
+    columns = db.execute('PRAGMA table_info({})'.format(table)).fetchall()
+    return any(c[1] == column for c in columns)
+  elif provider == 'postgres':
+    sql = ("SELECT column_name FROM information_schema.columns "
+           "WHERE table_schema = current_schema() AND table_name = '{}' AND column_name = '{}'")
+  elif provider == 'mysql':
+    sql = ("SELECT column_name FROM information_schema.columns "
+           "WHERE table_schema = DATABASE() AND table_name = '{}' AND column_name = '{}'")
+  else:
+    raise RuntimeError('unsupported database provider: {!r}'.format(provider))
+  return db.execute(sql.format(table, column)).fetchone() is not None
+
+
+def add_column(db, table, column, type_name, default=None):
+  """
+  Adds a column to *table* if it does not exist yet. The *type_name* is
+  one of `'int'`, `'str'` or `'datetime'` and is translated to the type
+  that PonyORM uses for the database. If a *default* is specified, the
+  column is `NOT NULL` and existing rows receive the default value.
+  """
+
+  if has_column(db, table, column):
+    return
+  provider = db.provider_name
+  if type_name == 'int':
+    sql_type = 'INTEGER'
+  elif type_name == 'str':
+    sql_type = 'VARCHAR(255)' if provider == 'mysql' else 'TEXT'
+  elif type_name == 'datetime':
+    sql_type = 'TIMESTAMP' if provider == 'postgres' else 'DATETIME'
+  else:
+    raise ValueError('invalid type_name: {!r}'.format(type_name))
+  if default is not None:
+    if isinstance(default, str):
+      default = "'{}'".format(default.replace("'", "''"))
+    sql_type += ' NOT NULL DEFAULT {}'.format(default)
+  db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, sql_type))
+
+
+def create_index(db, index):
+  " Creates the #Index *index* if it does not exist yet. "
+
+  if not has_index(db, index.table, index.name):
+    db.execute('CREATE INDEX {} ON {} ({})'.format(
+      index.name, index.table, ', '.join(index.columns)))
+
+
+@migration(1)
+def upgrade_primary_keys(db):
+  """
+  Makes sure that the database generates the `id` of the #ID_TABLES on
+  insert. Tables created by SQLAlchemy or by Flux CI versions that
+  computed the next ID with `max(id) + 1` have no AUTO INCREMENT or
+  sequence on the column.
+  """
+
+  provider = db.provider_name
+  for table in ID_TABLES:
+    if provider == 'sqlite':
+      # An INTEGER PRIMARY KEY is an alias of the ROWID, SQLite assigns
+      # the next value when no ID is specified.
+      columns = db.execute('PRAGMA table_info({})'.format(table)).fetchall()
+      pk = [c for c in columns if c[5]]
+      if len(pk) != 1 or pk[0][1] != 'id' or pk[0][2].upper() != 'INTEGER':
+        raise RuntimeError('{}.id is not an INTEGER PRIMARY KEY'.format(table))
+    elif provider == 'postgres':
+      default = db.execute(
+        "SELECT column_default FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = '{}' "
+        "AND column_name = 'id'".format(table)).fetchone()
+      if default and default[0]:
+        continue
+      sequence = '{}_id_seq'.format(table)
+      db.execute('CREATE SEQUENCE IF NOT EXISTS {} OWNED BY {}.id'.format(sequence, table))
+      db.execute("ALTER TABLE {} ALTER COLUMN id SET DEFAULT nextval('{}')".format(table, sequence))
+      db.execute("SELECT setval('{}', COALESCE((SELECT MAX(id) FROM {}), 0) + 1, false)"
+        .format(sequence, table))
+    elif provider == 'mysql':
+      extra = db.execute(
+        "SELECT extra FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = '{}' "
+        "AND column_name = 'id'".format(table)).fetchone()
+      if extra and 'auto_increment' in extra[0].lower():
+        continue
+      # The foreign keys that reference the column would block the change.
+      db.execute('SET FOREIGN_KEY_CHECKS = 0')
+      try:
+        db.execute('ALTER TABLE {} MODIFY id INTEGER NOT NULL AUTO_INCREMENT'.format(table))
+      finally:
+        db.execute('SET FOREIGN_KEY_CHECKS = 1')
+    else:
+      raise RuntimeError('unsupported database provider: {!r}'.format(provider))
+
+
+IDX_BUILDS_REPO_NUM = index('idx_builds_repo_num', 'builds', ['repo_id', 'num'])
+IDX_BUILDS_STATUS = index('idx_builds_status', 'builds', ['status'])
+IDX_BUILDS_DATE_QUEUED = index('idx_builds_date_queued', 'builds', ['date_queued'])
+
+@migration(2)
+def add_build_indexes(db):
+  " Indexes for the build lookups, the queue and the build lists. "
+
+  create_index(db, IDX_BUILDS_REPO_NUM)
+  create_index(db, IDX_BUILDS_STATUS)
+  create_index(db, IDX_BUILDS_DATE_QUEUED)
+
+
+@migration(3)
+def add_repository_summary(db):
+  " Build summary columns of the repos table, see #Repository.summarize_build(). "
+
+  add_column(db, 'repos', 'last_build_id', 'int')
+  add_column(db, 'repos', 'last_build_num', 'int')
+  add_column(db, 'repos', 'last_build_ref', 'str', '')
+  add_column(db, 'repos', 'last_build_status', 'str', '')
+  add_column(db, 'repos', 'last_build_date', 'datetime')
+  add_column(db, 'repos', 'builds_total', 'int', 0)
+  for status in ['queued', 'building', 'error', 'success', 'stopped']:
+    add_column(db, 'repos', 'builds_' + status, 'int', 0)
+
+  counts = ['builds_total = (SELECT COUNT(*) FROM builds WHERE builds.repo_id = repos.id)']
+  for status in ['queued', 'building', 'error', 'success', 'stopped']:
+    counts.append("builds_{0} = (SELECT COUNT(*) FROM builds WHERE builds.repo_id = repos.id "
+                  "AND builds.status = '{0}')".format(status))
+  counts.append('last_build_num = (SELECT MAX(num) FROM builds WHERE builds.repo_id = repos.id)')
+  db.execute('UPDATE repos SET ' + ', '.join(counts))
+
+  last = 'FROM builds WHERE builds.repo_id = repos.id AND builds.num = repos.last_build_num'
+  db.execute('UPDATE repos SET '
+    'last_build_id = (SELECT MAX(id) {0}), '
+    "last_build_ref = COALESCE((SELECT MAX(ref) {0}), ''), "
+    "last_build_status = COALESCE((SELECT MAX(status) {0}), ''), "
+    'last_build_date = (SELECT MAX(COALESCE(date_finished, date_started, date_queued)) {0})'
+    .format(last))
+
+
+IDX_BUILDS_REPO_DATE_QUEUED = index('idx_builds_repo_date_queued', 'builds',
+  ['repo_id', 'date_queued', 'id'])
+
+@migration(4)
+def add_build_list_index(db):
+  " Index for the keyset pagination of the builds of a repository. "
+
+  create_index(db, IDX_BUILDS_REPO_DATE_QUEUED)
+
+
+@migration(5)
+def add_build_worker(db):
+  " Name of the consumer that claimed a build, see #flux.build.BuildConsumer. "
+
+  add_column(db, 'builds', 'worker', 'str', '')
+
+
+@migration(6)
+def add_repository_agent_labels(db):
+  " Labels that the build agents of a repository must have, see #flux.agents. "
+
+  add_column(db, 'repos', 'agent_labels', 'str', '')
+
+
+@migration(7)
+def add_build_affinity(db):
+  " Outcome of the affinity scheduling, see #flux.build.claim_queued(). "
+
+  add_column(db, 'builds', 'affinity', 'str', '')
+
+
+@migration(8)
+def add_build_resources(db):
+  " Resource limits of repositories and usage of builds, see #flux.resources. "
+
+  for column in ['limit_cpu', 'limit_memory', 'limit_pids']:
+    add_column(db, 'repos', column, 'int')
+  for column in ['peak_rss_kb', 'cpu_time_ms', 'io_read_kb', 'io_write_kb']:
+    add_column(db, 'builds', column, 'int')
+
+
+@migration(9)
+def add_ram_workspace(db):
+  " The RAM workspace size of repositories, see #flux.resources.workspace(). "
+
+  add_column(db, 'repos', 'ram_workspace', 'int')
+
+
+@migration(10)
+def add_agent_instance(db):
+  " The process of a build agent, see #flux.agents.agent_register(). "
+
+  add_column(db, 'agents', 'instance', 'str', '')
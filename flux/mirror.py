@@ -0,0 +1,157 @@
+# -*- coding: utf8 -*-
+'''
+Bare mirrors of the repositories in ``mirror_dir``. Builds clone from the
+local mirror after fetching the missing commits into it, instead of
+cloning the whole repository over the network every time.
+
+The :class:`Prefetcher` fetches the commits of queued builds into the
+mirrors in the background, on at most ``prefetch_threads`` threads, so
+that the build can start as soon as a build thread claims it. Fetches
+into the same mirror are serialized, also across processes that share
+``mirror_dir``, thus a build waits for a prefetch that is still running
+rather than downloading the same objects again.
+
+This module must not import :mod:`flux.models`, it is also used by build
+agents.
+'''
+
+from flux import config, utils
+from flux.cache import LRUCache
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import os
+import traceback
+import uuid
+
+#: The number of recently prefetched builds that are remembered, so that
+#: they are not prefetched again.
+PREFETCH_MEMORY = 1024
+
+
+def enabled():
+  return bool(config.mirror_dir)
+
+
+def mirror_path(repo):
+  ''' Returns the path of the bare mirror of *repo*. '''
+
+  return os.path.join(config.mirror_dir, repo.name.replace('/', os.sep) + '.git')
+
+
+def has_commit(path, commit_sha):
+  res = utils.run(['git', 'cat-file', '-e', commit_sha + '^{commit}'], None, cwd=path)
+  return res == 0
+
+
+def fetch(repo, commit_sha=None, logger=None):
+  """
+  Creates or updates the mirror of *repo*. If *commit_sha* is specified
+  and the mirror already contains it, nothing is fetched.
+
+  # Parameters
+  repo: A #Repository, or an object with the same `name` and `clone_url`
+    attributes.
+  commit_sha (str, None): The commit that is required, or #None to fetch
+    the latest state of all branches and tags.
+  logger (logging.Logger, None): Receives the output of Git.
+
+  # Return
+  str, None: The path of the mirror, or #None if it could not be fetched.
+  """
+
+  path = mirror_path(repo)
+  env = utils.get_git_ssh_env(repo)
+  with utils.locked(path):
+    if os.path.isdir(path):
+      if commit_sha and has_commit(path, commit_sha):
+        return path
+      utils.run(['git', 'remote', 'set-url', 'origin', repo.clone_url], None, cwd=path)
+      res = utils.run(['git', 'fetch', '--prune', '--quiet', 'origin'], logger, cwd=path, env=env)
+    else:
+      # Clone into a temporary directory, a partial mirror must not be used.
+      temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+      res = utils.run(['git', 'clone', '--mirror', '--quiet', repo.clone_url, temp_path],
+        logger, env=env)
+      if res == 0:
+        os.rename(temp_path, path)
+      elif os.path.exists(temp_path):
+        utils.rmtree(temp_path, remove_write_protection=True)
+  if res != 0:
+    return None
+  if commit_sha and not has_commit(path, commit_sha):
+    return None
+  return path
+
+
+def remove(repo):
+  ''' Deletes the mirror of *repo*, eg. when the repository is deleted. '''
+
+  path = mirror_path(repo)
+  with utils.locked(path):
+    if os.path.isdir(path):
+      utils.rmtree(path, remove_write_protection=True)
+  try:
+    os.remove(path + '.lock')
+  except OSError:
+    pass
+
+
+class Prefetcher(object):
+  ''' Fetches the commits of queued builds into the mirrors on a bounded
+  pool of threads. Every build is only prefetched once. '''
+
+  def __init__(self):
+    self._lock = Lock()
+    self._executor = None
+    self._pending = set()
+    self._done = LRUCache(PREFETCH_MEMORY)
+
+  def start(self, num_threads=1):
+    if num_threads < 1:
+      raise ValueError('num_threads must be >= 1')
+    with self._lock:
+      if self._executor:
+        raise RuntimeError('already running')
+      self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+  def stop(self, join=True):
+    with self._lock:
+      executor, self._executor = self._executor, None
+      self._pending.clear()
+    if executor:
+      executor.shutdown(wait=join)
+
+  def is_running(self):
+    with self._lock:
+      return self._executor is not None
+
+  def prefetch(self, build_id, repo, commit_sha):
+    ''' Schedules a fetch of the *commit_sha* of *repo* (an object with the
+    `name` and `clone_url` of a repository) for the build with the
+    specified ID. Builds of a branch name pass None as *commit_sha*. '''
+
+    if not enabled():
+      return
+    with self._lock:
+      if not self._executor or build_id in self._pending or self._done.get(build_id):
+        return
+      self._pending.add(build_id)
+      self._executor.submit(self._fetch, build_id, repo, commit_sha)
+
+  def _fetch(self, build_id, repo, commit_sha):
+    try:
+      fetch(repo, commit_sha)
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      self._done.put(build_id, True)
+      with self._lock:
+        self._pending.discard(build_id)
+
+
+_prefetcher = Prefetcher()
+prefetch = _prefetcher.prefetch
+is_prefetching = _prefetcher.is_running
+run_prefetcher = _prefetcher.start
+stop_prefetcher = _prefetcher.stop
@@ -2,16 +2,21 @@
 """
 This package provides the database models using PonyORM.
 
-Note that we do not rely on the auto increment feature as the previous
-SQLAlchemy implementation did not set AUTO INCREMENT on the ID fields,
-as PonyORM would.
+Primary keys are allocated by the database (AUTO INCREMENT, sequences).
+Databases that have been created by the previous SQLAlchemy implementation
+or by older versions of Flux CI did not set AUTO INCREMENT on the ID fields,
+these are upgraded by #flux.migrations when the models are loaded. Changes
+to existing tables always need a migration in that module.
 """
 
 from flask import url_for
-from flux import app, config, utils
+from flux import app, config, migrations, mirror, resources, utils
+from flux.cache import LRUCache
 
+import collections
 import datetime
 import hashlib
+import json
 import os
 import pony.orm as orm
 import shutil
@@ -28,7 +33,7 @@ desc = orm.desc
 class User(db.Entity):
   _table_ = 'users'
 
-  id = orm.PrimaryKey(int)
+  id = orm.PrimaryKey(int, auto=True)
   name = orm.Required(str, unique=True)
   passhash = orm.Required(str)
   can_manage = orm.Required(bool)
@@ -36,11 +41,6 @@ class User(db.Entity):
   can_view_buildlogs = orm.Required(bool)
   login_tokens = orm.Set('LoginToken')
 
-  def __init__(self, **kwargs):
-    if 'id' not in kwargs:
-      kwargs['id'] = (orm.max(x.id for x in User) or 0) + 1
-    super().__init__(**kwargs)
-
   def set_password(self, password):
     self.passhash = utils.hash_pw(password)
 
@@ -78,6 +78,12 @@ class User(db.Entity):
   def url(self):
     return url_for('edit_user', user_id=self.id)
 
+  def after_update(self):
+    from flux import tokens
+    tokens.users.discard(self.id)
+
+  after_delete = after_update
+
 
 class LoginToken(db.Entity):
   """
@@ -89,11 +95,16 @@ class LoginToken(db.Entity):
   The expiration duration can be set with the `login_token_duration`
   configuration value. Setting this option to #None will prevent tokens
   from expiring.
+
+  The browser's session does not contain the token itself but a signed
+  copy of its ID, user, IP and expiration date which is verified without
+  querying the database, see #flux.tokens. Deleting a token before it
+  expires adds it to the #RevokedToken table.
   """
 
   _table_ = 'logintokens'
 
-  id = orm.PrimaryKey(int)
+  id = orm.PrimaryKey(int, auto=True)
   ip = orm.Required(str)
   user = orm.Required(User)
   token = orm.Required(str, unique=True)
@@ -103,19 +114,43 @@ class LoginToken(db.Entity):
   def create(cls, ip, user):
     " Create a new login token assigned to the specified IP and user. "
 
-    id = (orm.max(x.id for x in cls) or 0) + 1
     created = datetime.datetime.now()
     token = str(uuid.uuid4()).replace('-', '')
     token += hashlib.md5((token + str(created)).encode()).hexdigest()
-    return cls(id=id, ip=ip, user=user, token=token, created=created)
+    result = cls(ip=ip, user=user, token=token, created=created)
+    orm.flush()  # Allocate the ID, it is part of the signed token.
+    return result
+
+  def expires(self):
+    " Returns the date that the token expires at, or #None. "
+
+    if config.login_token_duration is None:
+      return None
+    return self.created + config.login_token_duration
 
   def expired(self):
     " Returns #True if the token is expired, #False otherwise. "
 
-    if config.login_token_duration is None:
-      return False
-    now = datetime.datetime.now()
-    return (self.created + config.login_token_duration) < now
+    expires = self.expires()
+    return expires is not None and expires < datetime.datetime.now()
+
+  def before_delete(self):
+    if not self.expired():
+      RevokedToken(token_id=self.id, expires=self.expires())
+
+
+class RevokedToken(db.Entity):
+  """
+  The ID of a #LoginToken that has been deleted before it expired. Signed
+  tokens remain valid until they expire, thus every process keeps a copy
+  of this table in a #flux.tokens.RevocationList. Rows are deleted by the
+  token sweeper once the token would have expired anyway.
+  """
+
+  _table_ = 'revokedtokens'
+
+  token_id = orm.PrimaryKey(int)
+  expires = orm.Optional(datetime.datetime)
 
 
 class Repository(db.Entity):
@@ -123,22 +158,51 @@ class Repository(db.Entity):
   Represents a repository for which push events are being accepted. The Git
   server specified at the `clone_url` must accept the Flux server's public
   key.
+
+  The repository also carries a summary of its builds (the most recent
+  build and the number of builds per status) so that lists of repositories
+  can be rendered without loading the builds. It is updated by the #Build
+  hooks in the same transaction as the build itself, with SQL statements
+  that modify the row in place (see #summarize_build()).
   """
 
   _table_ = 'repos'
 
-  id = orm.PrimaryKey(int)
+  id = orm.PrimaryKey(int, auto=True)
   name = orm.Required(str)
   secret = orm.Optional(str)
   clone_url = orm.Required(str)
   build_count = orm.Required(int, default=0)
   builds = orm.Set('Build')
   ref_whitelist = orm.Optional(str)  # newline separated list of accepted Git refs
-
-  def __init__(self, **kwargs):
-    if 'id' not in kwargs:
-      kwargs['id'] = (orm.max(x.id for x in Repository) or 0) + 1
-    super().__init__(**kwargs)
+  poll_state = orm.Optional('PollState', cascade_delete=True)  # only set if polled
+  agent_labels = orm.Optional(str)  # space separated, builds only run on agents with these labels
+  affinities = orm.Set('BuildAffinity', cascade_delete=True)
+  health = orm.Optional('RepoHealth', cascade_delete=True)  # last health check
+
+  # Resource limits of the build scripts, see flux.resources. None falls
+  # back to the build_limit_* configuration values.
+  limit_cpu = orm.Optional(int)  # percent of one CPU
+  limit_memory = orm.Optional(int)  # MiB
+  limit_pids = orm.Optional(int)
+
+  # The size of the RAM workspace of the builds in MiB, see
+  # flux.resources.workspace(). None runs the builds on disk.
+  ram_workspace = orm.Optional(int)
+
+  # Build summary, see summarize_build(). Updated with SQL statements that
+  # concurrent transactions do not conflict on.
+  last_build_id = orm.Optional(int, volatile=True, optimistic=False)
+  last_build_num = orm.Optional(int, volatile=True, optimistic=False)
+  last_build_ref = orm.Optional(str, volatile=True, optimistic=False)
+  last_build_status = orm.Optional(str, volatile=True, optimistic=False)
+  last_build_date = orm.Optional(datetime.datetime, volatile=True, optimistic=False)
+  builds_total = orm.Required(int, default=0, volatile=True, optimistic=False)
+  builds_queued = orm.Required(int, default=0, volatile=True, optimistic=False)
+  builds_building = orm.Required(int, default=0, volatile=True, optimistic=False)
+  builds_error = orm.Required(int, default=0, volatile=True, optimistic=False)
+  builds_success = orm.Required(int, default=0, volatile=True, optimistic=False)
+  builds_stopped = orm.Required(int, default=0, volatile=True, optimistic=False)
 
   def url(self, **kwargs):
     return url_for('view_repo', path=self.name, **kwargs)
@@ -155,6 +219,223 @@ class Repository(db.Entity):
   def most_recent_build(self):
     return self.builds.select().order_by(desc(Build.date_started)).first()
 
+  def summarize_build(self, build, old_status, new_status):
+    """
+    Updates the build summary of the repository after the status of *build*
+    changed from *old_status* to *new_status*. The old status is #None for
+    a new build, the new status is #None for a deleted build.
+
+    The counters are changed by the difference and the most recent build
+    is only replaced by a build with the same or a higher number, in the
+    `UPDATE` statement itself. Thus concurrent transactions that change
+    builds of the same repository do not overwrite each other's changes
+    (and do not fail the optimistic check on the repository).
+    """
+
+    deltas = collections.Counter()
+    if old_status != new_status:
+      if old_status is not None:
+        deltas['builds_' + old_status] -= 1
+      if new_status is not None:
+        deltas['builds_' + new_status] += 1
+      deltas['builds_total'] += (new_status is not None) - (old_status is not None)
+    deltas = {k: v for k, v in deltas.items() if v}
+    for column in deltas:
+      if column not in Repository._adict_:
+        raise ValueError('invalid build status: {!r}'.format(column[len('builds_'):]))
+    if deltas:
+      db.execute('UPDATE repos SET {} WHERE id = $repo_id'.format(
+        ', '.join('{0} = {0} + ({1:d})'.format(k, v) for k, v in sorted(deltas.items()))),
+        {'repo_id': self.id})
+
+    if new_status is None:
+      self.set_last_build(self.builds.select(lambda x: x.id != build.id)
+        .order_by(desc(Build.num)).first(), 'last_build_id = $value', build.id)
+    else:
+      self.set_last_build(build, 'last_build_num IS NULL OR last_build_num <= $value', build.num)
+
+  def set_last_build(self, build, condition=None, value=None):
+    """
+    Records *build* (or none) as the most recent build of the repository.
+
+    # Parameters
+    condition (str, None): An SQL condition on the row of the repository,
+      which may refer to *value* as `$value`.
+    """
+
+    params = {
+      'repo_id': self.id,
+      'value': value,
+      'id': build.id if build else None,
+      'num': build.num if build else None,
+      'ref': build.ref if build else '',
+      'status': build.status if build else '',
+      'date': Repository.last_build_date.converters[0].val2dbval(
+        build.date_finished or build.date_started or build.date_queued) if build else None,
+    }
+    db.execute('UPDATE repos SET last_build_id = $id, last_build_num = $num, '
+      'last_build_ref = $ref, last_build_status = $status, last_build_date = $date '
+      'WHERE id = $repo_id' + (' AND ({})'.format(condition) if condition else ''), params)
+
+  def get_agent_labels(self):
+    return set(self.agent_labels.replace(',', ' ').split())
+
+  def set_agent_labels(self, labels):
+    self.agent_labels = ' '.join(sorted(set(labels.replace(',', ' ').split())))
+
+  def is_polled(self):
+    return self.poll_state is not None
+
+  def set_polled(self, polled):
+    """
+    Enables or disables polling for changes for this repository. Disabling
+    polling discards the refs that have been seen so far.
+    """
+
+    if polled and not self.poll_state:
+      PollState(repo=self, interval=config.poll_interval)
+    elif not polled and self.poll_state:
+      self.poll_state.delete()
+
+  def before_update(self):
+    old_name = self._dbvals_.get(Repository.name)
+    if old_name != self.name:
+      repository_ids.discard(old_name)
+
+  def before_delete(self):
+    repository_ids.discard(self.name)
+    build_ids.discard_if(lambda key: key[0] == self.id)
+    if mirror.enabled():
+      try:
+        mirror.remove(self)
+      except OSError as exc:
+        app.logger.exception(exc)
+
+
+class PollState(db.Entity):
+  """
+  Tracks the Git refs that have last been seen for a #Repository that is
+  polled for changes instead of (or in addition to) receiving webhooks.
+  The polling interval grows while the repository does not change and
+  when the remote can not be reached, see #flux.poll.
+  """
+
+  _table_ = 'pollstates'
+
+  repo = orm.PrimaryKey(Repository, column='repo_id')
+  refs = orm.Optional(orm.LongStr)  # JSON object that maps refs to SHAs
+  interval = orm.Required(int)  # current polling interval in seconds
+  failures = orm.Required(int, default=0)
+  next_poll = orm.Optional(datetime.datetime)
+  last_poll = orm.Optional(datetime.datetime)
+  last_error = orm.Optional(str)
+
+  def get_refs(self):
+    """
+    Returns a dictionary of the refs seen in the last successful poll,
+    or #None if the repository has not been polled successfully yet.
+    """
+
+    return json.loads(self.refs) if self.refs else None
+
+  def set_refs(self, refs):
+    self.refs = json.dumps(refs, sort_keys=True)
+
+
+class RepoHealth(db.Entity):
+  """
+  The result of the last health check of a #Repository, ie. whether Flux
+  could list the refs of its `clone_url` with its SSH key. Results are
+  reused for `health_check_ttl` seconds, see #flux.health.
+  """
+
+  _table_ = 'repohealth'
+
+  repo = orm.PrimaryKey(Repository, column='repo_id')
+  ok = orm.Required(bool)
+  message = orm.Optional(str)  # the error reported by Git
+  date_checked = orm.Required(datetime.datetime)
+
+  def is_fresh(self):
+    limit = datetime.datetime.now() - datetime.timedelta(seconds=config.health_check_ttl)
+    return self.date_checked > limit
+
+
+class Agent(db.Entity):
+  """
+  A build agent that runs builds on another host, see #flux.agents. Agents
+  register with their labels and their capacity (the number of builds that
+  they run in parallel) and must send heartbeats. An agent that has not
+  been seen for `agent_timeout` seconds is considered dead and its builds
+  are queued again.
+  """
+
+  _table_ = 'agents'
+
+  id = orm.PrimaryKey(int, auto=True)
+  name = orm.Required(str, unique=True)
+  instance = orm.Optional(str)  # random ID of the agent process that registered
+  labels = orm.Optional(str)  # space separated
+  capacity = orm.Required(int, default=1)
+  registered = orm.Required(datetime.datetime, default=datetime.datetime.now)
+  last_seen = orm.Required(datetime.datetime, default=datetime.datetime.now)
+
+  @property
+  def worker_name(self):
+    " The name that is recorded in #Build.worker for builds of this agent. "
+
+    return 'agent:' + self.name
+
+  def get_labels(self):
+    return set(self.labels.split())
+
+  def accepts(self, repo):
+    " Returns #True if the agent has all labels that *repo* requires. "
+
+    return repo.get_agent_labels() <= self.get_labels()
+
+  def is_alive(self):
+    timeout = datetime.timedelta(seconds=config.agent_timeout)
+    return self.last_seen + timeout >= datetime.datetime.now()
+
+  def running_builds(self):
+    return select(x for x in Build if x.status == Build.Status_Building
+                  and x.worker == self.worker_name)
+
+
+class Worker(db.Entity):
+  """
+  A build consumer process (the web process or a `flux-ci worker`), see
+  #flux.build.BuildConsumer. The consumer reports its state every
+  `build_sync_interval` seconds and resizes its pool of build threads when
+  #threads has been changed, eg. on the "Workers" page.
+  """
+
+  _table_ = 'workers'
+
+  id = orm.PrimaryKey(int, auto=True)
+  name = orm.Required(str, unique=True)
+  threads = orm.Required(int, default=1)  # The size of the build thread pool
+  running = orm.Required(int, default=0)  # The number of running builds
+  admission = orm.Optional(str)  # Why no new builds are started, if at all
+  started = orm.Required(datetime.datetime, default=datetime.datetime.now)
+  last_seen = orm.Required(datetime.datetime, default=datetime.datetime.now)
+
+  def is_alive(self):
+    timeout = datetime.timedelta(seconds=max(30, config.build_sync_interval * 3))
+    return self.last_seen + timeout >= datetime.datetime.now()
+
+  def to_json(self):
+    return {
+      'name': self.name,
+      'threads': self.threads,
+      'running': self.running,
+      'admission': self.admission or None,
+      'alive': self.is_alive(),
+      'started': self.started.isoformat(),
+      'last_seen': self.last_seen.isoformat(),
+    }
+
 
 class Build(db.Entity):
   """
@@ -176,15 +457,22 @@ class Build(db.Entity):
   Status_Stopped = 'stopped'
   Status = [Status_Queued, Status_Building, Status_Error, Status_Success, Status_Stopped]
 
+  # Whether the build went to the worker that last built its repository
+  # and ref, see flux.build.claim_queued().
+  Affinity_None = ''
+  Affinity_Hit = 'hit'
+  Affinity_Miss = 'miss'
+
   Data_BuildDir = 'build_dir'
   Data_OverrideDir = 'override_dir'
   Data_Artifact = 'artifact'
   Data_Log = 'log'
+  Data_StageCache = 'stage_cache'
 
   class CanNotDelete(Exception):
     pass
 
-  id = orm.PrimaryKey(int)
+  id = orm.PrimaryKey(int, auto=True)
   repo = orm.Required(Repository, column='repo_id')
   ref = orm.Required(str)
   commit_sha = orm.Required(str)
@@ -193,13 +481,32 @@ class Build(db.Entity):
   date_queued = orm.Required(datetime.datetime, default=datetime.datetime.now)
   date_started = orm.Optional(datetime.datetime)
   date_finished = orm.Optional(datetime.datetime)
+  worker = orm.Optional(str)  # Name of the build consumer that claimed the build
+  affinity = orm.Optional(str)  # One of the Affinity strings
+
+  # Resource usage of the build script, see flux.resources.Usage.
+  peak_rss_kb = orm.Optional(int)
+  cpu_time_ms = orm.Optional(int)
+  io_read_kb = orm.Optional(int)
+  io_write_kb = orm.Optional(int)
+
+  jobs = orm.Set('BuildJob', cascade_delete=True)
 
-  def __init__(self, **kwargs):
-    # Backwards compatibility for when SQLAlchemy was used, Auto Increment
-    # was not enabled there.
-    if 'id' not in kwargs:
-      kwargs['id'] = (orm.max(x.id for x in Build) or 0) + 1
-    super(Build, self).__init__(**kwargs)
+  @classmethod
+  def create(cls, repo, ref, commit_sha):
+    " Create a new queued build for *repo* and increment its build count. "
+
+    build = cls(
+      repo=repo,
+      commit_sha=commit_sha,
+      num=repo.build_count,
+      ref=ref,
+      status=cls.Status_Queued,
+      date_queued=datetime.datetime.now(),
+      date_started=None,
+      date_finished=None)
+    repo.build_count += 1
+    return build
 
   def url(self, data=None, **kwargs):
     path = self.repo.name + '/' + str(self.num)
@@ -210,6 +517,25 @@ class Build(db.Entity):
     else:
       raise ValueError('invalid mode: {!r}'.format(mode))
 
+  def to_json(self):
+    " Returns a JSON serializable representation of the build. "
+
+    fmt = lambda d: d.isoformat() if d else None
+    return {
+      'id': self.id,
+      'repo': self.repo.name,
+      'num': self.num,
+      'ref': self.ref,
+      'commit_sha': self.commit_sha,
+      'status': self.status,
+      'date_queued': fmt(self.date_queued),
+      'date_started': fmt(self.date_started),
+      'date_finished': fmt(self.date_finished),
+      'url': utils.strip_url_path(config.app_url) + self.url(),
+      'usage': {x: getattr(self, x) for x in resources.Usage._fields},
+      'jobs': [x.to_json() for x in self.jobs.order_by(BuildJob.num)],
+    }
+
   def path(self, data=Data_BuildDir):
     base = os.path.join(config.build_dir, self.repo.name.replace('/', os.sep), str(self.num))
     if data == self.Data_BuildDir:
@@ -218,6 +544,8 @@ class Build(db.Entity):
       return base + '.zip'
     elif data == self.Data_Log:
       return base + '.log'
+    elif data == self.Data_StageCache:
+      return base + '.stages'
     elif data == self.Data_OverrideDir:
       return os.path.join(config.override_dir, self.repo.name.replace('/', os.sep))
     else:
@@ -256,8 +584,229 @@ class Build(db.Entity):
 
   # db.Entity Overrides
 
+  def after_insert(self):
+    # Only now the ID of the build is known.
+    self.repo.summarize_build(self, None, self.status)
+
+  def before_update(self):
+    self.repo.summarize_build(self, self._dbvals_.get(Build.status), self.status)
+
   def before_delete(self):
     self.delete_build()
+    if self.exists(self.Data_StageCache):
+      utils.rmtree(self.path(self.Data_StageCache), remove_write_protection=True)
+    repo = self._dbvals_.get(Build.repo)
+    if repo is not None:
+      build_ids.discard((repo.id, self.num))
+    try:
+      self.repo.summarize_build(self, self._dbvals_.get(Build.status), None)
+    except orm.OperationWithDeletedObjectError:
+      pass  # The repository is deleted together with the build.
+
+
+class BuildJob(db.Entity):
+  """
+  A job of the build matrix or a stage of the pipeline of a #Build, see
+  #flux.runner.expand_matrix() and #flux.runner.parse_stages(). The jobs
+  of a build run on the free build threads of the consumer that claimed
+  the build and share one checkout. Their logs are appended to the log of
+  the build when all jobs finished.
+  """
+
+  _table_ = 'build_jobs'
+
+  id = orm.PrimaryKey(int, auto=True)
+  build = orm.Required(Build, column='build_id')
+  num = orm.Required(int)
+  name = orm.Required(str)
+  status = orm.Required(str, default=Build.Status_Queued)  # One of the Build.Status strings
+  date_started = orm.Optional(datetime.datetime)
+  date_finished = orm.Optional(datetime.datetime)
+  worker = orm.Optional(str)  # Name of the build consumer that ran the job
+
+  def to_json(self):
+    fmt = lambda d: d.isoformat() if d else None
+    return {
+      'num': self.num,
+      'name': self.name,
+      'status': self.status,
+      'date_started': fmt(self.date_started),
+      'date_finished': fmt(self.date_finished),
+    }
+
+
+class BuildAffinity(db.Entity):
+  """
+  Remembers the worker (a build consumer or agent) that last built a ref
+  of a repository, see #flux.build.claim_queued().
+  """
+
+  _table_ = 'build_affinity'
+
+  repo = orm.Required(Repository, column='repo_id')
+  ref = orm.Required(str)
+  worker = orm.Required(str)
+  date = orm.Required(datetime.datetime, default=datetime.datetime.now)
+  orm.PrimaryKey(repo, ref)
+
+  @classmethod
+  def lookup(cls, builds):
+    """
+    Returns a dictionary that maps each of the *builds* to the worker that
+    last built its ref or, if the ref has not been built yet, any other
+    ref of the repository. Builds without a preferred worker are omitted.
+    """
+
+    repos = {x.repo for x in builds}
+    by_ref, by_repo = {}, {}
+    for affinity in select(x for x in cls if x.repo in repos).order_by(cls.date):
+      by_ref[affinity.repo, affinity.ref] = affinity.worker
+      by_repo[affinity.repo] = affinity.worker
+    result = {}
+    for build in builds:
+      worker = by_ref.get((build.repo, build.ref)) or by_repo.get(build.repo)
+      if worker:
+        result[build] = worker
+    return result
+
+  @classmethod
+  def record(cls, build):
+    " Records that *build* has been claimed by #Build.worker. "
+
+    affinity = cls.get(repo=build.repo, ref=build.ref)
+    if affinity:
+      affinity.worker = build.worker
+      affinity.date = datetime.datetime.now()
+    else:
+      cls(repo=build.repo, ref=build.ref, worker=build.worker)
+
+
+def get_affinity_stats(since):
+  """
+  Counts the builds queued after *since* by the outcome of the affinity
+  scheduling, see #flux.build.claim_queued().
+
+  # Return
+  dict: The number of `hits`, `misses` and `unassigned` builds (whose
+    repository had no preferred worker yet), and the `hit_rate` of the
+    builds that had a preferred worker.
+  """
+
+  counts = dict(select((x.affinity, orm.count(x)) for x in Build
+                       if x.date_queued >= since and x.worker != ''))
+  hits = counts.get(Build.Affinity_Hit, 0)
+  misses = counts.get(Build.Affinity_Miss, 0)
+  return {
+    'hits': hits,
+    'misses': misses,
+    'unassigned': counts.get(Build.Affinity_None, 0),
+    'hit_rate': (hits / (hits + misses)) if hits + misses else None,
+  }
+
+
+#: A page of builds returned by #paginate_builds(). The *older* and *newer*
+#: members are cursors for the adjacent pages, or #None if there is none.
+Page = collections.namedtuple('Page', 'items older newer')
+
+
+def make_cursor(build):
+  " Returns a cursor that represents the position of *build* in a build list. "
+
+  return '{:%Y%m%d%H%M%S%f}-{}'.format(build.date_queued, build.id)
+
+
+def parse_cursor(cursor):
+  """
+  Parses a cursor created with #make_cursor().
+
+  # Raises
+  ValueError: If *cursor* is not a valid cursor.
+
+  # Return
+  tuple of (datetime, int): The queue date and ID of the build.
+  """
+
+  date, _, build_id = cursor.partition('-')
+  return datetime.datetime.strptime(date, '%Y%m%d%H%M%S%f'), int(build_id)
+
+
+def paginate_builds(query, limit, before=None, after=None):
+  """
+  Keyset pagination of a query of #Build objects, from the newest to the
+  oldest build by `(date_queued, id)`. With *before*, the page contains the
+  builds older than the cursor, with *after* the builds newer than the
+  cursor. Unlike slicing with an offset, every page costs the same no
+  matter how deep it is.
+
+  # Raises
+  ValueError: If *before* or *after* is not a valid cursor.
+
+  # Return
+  Page: The builds (newest first) and the cursors of the adjacent pages.
+  """
+
+  if after:
+    date, build_id = parse_cursor(after)
+    query = query.filter(lambda b: b.date_queued > date or
+                         (b.date_queued == date and b.id > build_id))
+    items = query.order_by(Build.date_queued, Build.id)[:limit + 1]
+    has_newer, has_older = len(items) > limit, True
+    items = list(reversed(items[:limit]))
+  else:
+    if before:
+      date, build_id = parse_cursor(before)
+      query = query.filter(lambda b: b.date_queued < date or
+                           (b.date_queued == date and b.id < build_id))
+    items = query.order_by(desc(Build.date_queued), desc(Build.id))[:limit + 1]
+    has_newer, has_older = bool(before), len(items) > limit
+    items = list(items[:limit])
+
+  older = make_cursor(items[-1]) if items and has_older else None
+  newer = make_cursor(items[0]) if items and has_newer else None
+  return Page(items, older, newer)
+
+
+#: Read-through caches for #get_repository() and #get_build() that map a
+#: repository name to its ID and `(repo_id, num)` to the ID of a build.
+#: The hit and miss counters are reported at `/api/stats`.
+repository_ids = LRUCache(config.lookup_cache_size)
+build_ids = LRUCache(config.lookup_cache_size)
+
+
+def get_repository(name):
+  """
+  Returns the #Repository with the specified *name*, or #None. The ID of
+  the repository is cached in #repository_ids. Cached entries are dropped
+  when a repository is renamed or deleted, and are checked against the
+  loaded repository in case another process renamed it.
+  """
+
+  repo_id = repository_ids.get(name)
+  if repo_id is not None:
+    repo = Repository.get(id=repo_id)
+    if repo and repo.name == name:
+      return repo
+    repository_ids.discard(name)
+  repo = Repository.get(name=name)
+  if repo:
+    repository_ids.put(name, repo.id)
+  return repo
+
+
+def get_build(repo, num):
+  " Returns the #Build number *num* of *repo*, or #None. See #get_repository(). "
+
+  key = (repo.id, num)
+  build_id = build_ids.get(key)
+  if build_id is not None:
+    build = Build.get(id=build_id)
+    if build and build.repo == repo and build.num == num:
+      return build
+    build_ids.discard(key)
+  build = Build.get(repo=repo, num=num)
+  if build:
+    build_ids.put(key, build.id)
+  return build
 
 
 def get_target_for(path):
@@ -276,14 +825,22 @@ def get_target_for(path):
   if len(parts) not in (2, 3):
     return None
   repo_name = parts[0] + '/' + parts[1]
-  repo = Repository.get(name=repo_name)
+  repo = get_repository(repo_name)
   if not repo:
     return None
   if len(parts) == 3:
     try: num = int(parts[2])
     except ValueError: return None
-    return Build.get(repo=repo, num=num)
+    return get_build(repo, num)
   return repo
 
 
-db.generate_mapping(create_tables=True)
+# Only create missing tables here, the existing tables are checked after
+# the migrations had a chance to bring them up to date.
+db.generate_mapping(create_tables=True, check_tables=False)
+if config.auto_migrate:
+  migrations.upgrade(db, app.logger)
+  db.check_tables()
+else:
+  for problem in migrations.check(db):
+    app.logger.error('Database schema: {}'.format(problem))
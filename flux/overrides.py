@@ -0,0 +1,252 @@
+# -*- coding: utf8 -*-
+'''
+Applies the override files of a repository to the checkout of a build.
+
+Every override directory has a manifest (``<override_path>.manifest.json``)
+with the relative path, size, modification time and SHA-256 hash of every
+file, and a store of the file contents named by their hash
+(``<override_path>.objects``). The manifest is updated by the override
+views whenever a file is changed (see :func:`update_manifest`); before a
+build it is only checked against the modification times, thus unchanged
+files are never read again.
+
+The files are materialized in the checkout from the store as reflinks
+(copy-on-write clones, eg. on Btrfs and XFS), as hardlinks if
+``override_hardlinks`` is enabled, or as copies if neither is possible.
+Objects in the store are read-only, so that a build can not change the
+content of a hardlinked file that other builds share. Files with the same
+content share one object, which has the modification time
+:data:`OBJECT_MTIME_NS` instead of that of any of the files; an object
+whose size or modification time differs has been changed anyway (eg. by a
+build script running as root) and is replaced.
+
+This module must not import :mod:`flux.models`, it is also used by build
+agents.
+'''
+
+from flux import config, utils
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import uuid
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # Windows
+
+#: The ``FICLONE`` ioctl of Linux, which clones a file on file systems
+#: that support reflinks.
+FICLONE = 0x40049409
+
+MANIFEST_VERSION = 1
+
+#: The modification time of all objects in the store (2000-01-01 UTC, in
+#: nanoseconds), see :func:`object_valid`. Hardlinked override files have
+#: it as well; it must be after 1980, which is the earliest timestamp that
+#: ZIP files support.
+OBJECT_MTIME_NS = 946684800 * 10 ** 9
+
+
+def manifest_path(override_path):
+  return override_path + '.manifest.json'
+
+
+def store_path(override_path):
+  return override_path + '.objects'
+
+
+def object_path(override_path, entry):
+  ''' Returns the path of the object of a manifest *entry* in the store.
+  Executable files are stored separately, hardlinks share the mode. '''
+
+  name = entry['sha256'] + ('.x' if entry['executable'] else '')
+  return os.path.join(store_path(override_path), name[:2], name)
+
+
+def hash_file(path):
+  sha = hashlib.sha256()
+  with open(path, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+
+def load_manifest(override_path):
+  ''' Returns the manifest of *override_path*, or an empty manifest if it
+  does not exist or has another version. '''
+
+  try:
+    with open(manifest_path(override_path), encoding='utf8') as fp:
+      manifest = json.load(fp)
+  except (OSError, ValueError):
+    manifest = None
+  if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+    manifest = {'version': MANIFEST_VERSION, 'dirs': [], 'files': {}}
+  return manifest
+
+
+def update_manifest(override_path):
+  """
+  Brings the manifest of *override_path* up to date with the files in the
+  directory. Only files whose size or modification time changed are read
+  and added to the store, objects that are no longer referenced are
+  removed from it. Returns the manifest.
+  """
+
+  if not os.path.isdir(override_path):
+    remove(override_path)
+    return load_manifest(override_path)
+  with utils.locked(manifest_path(override_path)):
+    return _update_manifest(override_path)
+
+
+def _update_manifest(override_path):
+  # Must be called with the manifest locked, see update_manifest().
+  old = load_manifest(override_path)
+  manifest = {'version': MANIFEST_VERSION, 'dirs': [], 'files': {}}
+  for root, dirs, files in os.walk(override_path):
+    dirs.sort()
+    rel_root = os.path.relpath(root, override_path).replace(os.sep, '/')
+    for name in dirs:
+      manifest['dirs'].append(name if rel_root == '.' else rel_root + '/' + name)
+    for name in sorted(files):
+      rel = name if rel_root == '.' else rel_root + '/' + name
+      path = os.path.join(root, name)
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        continue  # Deleted in the meantime, or a broken symlink
+      entry = old['files'].get(rel)
+      if not entry or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns \
+          or not object_valid(override_path, entry):
+        entry = {
+          'size': st.st_size,
+          'mtime_ns': st.st_mtime_ns,
+          'executable': bool(st.st_mode & stat.S_IXUSR),
+          'sha256': hash_file(path),
+        }
+        add_object(override_path, path, entry)
+      manifest['files'][rel] = entry
+  if manifest == old and os.path.isfile(manifest_path(override_path)):
+    return manifest
+
+  temp_path = '{}.{}.tmp'.format(manifest_path(override_path), uuid.uuid4().hex)
+  with open(temp_path, 'w', encoding='utf8') as fp:
+    json.dump(manifest, fp, sort_keys=True)
+  os.replace(temp_path, manifest_path(override_path))
+  remove_unused_objects(override_path, manifest)
+  return manifest
+
+
+def object_valid(override_path, entry):
+  ''' Returns True if the object of *entry* exists and has not been
+  changed since it was added to the store. '''
+
+  try:
+    st = os.stat(object_path(override_path, entry))
+  except OSError:
+    return False
+  return st.st_size == entry['size'] and st.st_mtime_ns == OBJECT_MTIME_NS
+
+
+def add_object(override_path, path, entry):
+  ''' Adds the file at *path* to the store as the object of *entry*,
+  unless the store already has a valid object with the same content. '''
+
+  if object_valid(override_path, entry):
+    return
+  dst = object_path(override_path, entry)
+  utils.makedirs(os.path.dirname(dst))
+  temp_path = '{}.{}.tmp'.format(dst, uuid.uuid4().hex)
+  if not clone_file(path, temp_path):
+    shutil.copyfile(path, temp_path)
+  os.utime(temp_path, ns=(OBJECT_MTIME_NS, OBJECT_MTIME_NS))
+  os.chmod(temp_path, 0o555 if entry['executable'] else 0o444)
+  os.replace(temp_path, dst)
+
+
+def remove_unused_objects(override_path, manifest):
+  used = {object_path(override_path, x) for x in manifest['files'].values()}
+  store = store_path(override_path)
+  if not os.path.isdir(store):
+    return
+  for prefix in os.listdir(store):
+    for name in os.listdir(os.path.join(store, prefix)):
+      path = os.path.join(store, prefix, name)
+      if path not in used:
+        os.remove(path)
+
+
+def remove(override_path):
+  ''' Deletes the manifest and the store of *override_path*. '''
+
+  for path in (manifest_path(override_path), manifest_path(override_path) + '.lock'):
+    if os.path.isfile(path):
+      os.remove(path)
+  if os.path.isdir(store_path(override_path)):
+    utils.rmtree(store_path(override_path), remove_write_protection=True)
+
+
+def clone_file(src, dst):
+  ''' Creates *dst* as a reflink of *src*. Returns False if the file system
+  does not support it. '''
+
+  if not fcntl or not sys.platform.startswith('linux'):
+    return False
+  try:
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+      fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    return True
+  except OSError:
+    if os.path.exists(dst):
+      os.remove(dst)
+    return False
+
+
+def apply(override_path, build_path, logger=None):
+  """
+  Materializes the override files from *override_path* in *build_path*,
+  replacing the files of the checkout. Returns the number of files.
+
+  The manifest stays locked until all files are materialized, thus a
+  concurrent #update_manifest() can not remove an object in the meantime.
+  """
+
+  if not os.path.isdir(override_path):
+    return 0
+  counts = {'reflinked': 0, 'hardlinked': 0, 'copied': 0}
+  with utils.locked(manifest_path(override_path)):
+    manifest = _update_manifest(override_path)
+    for rel in manifest['dirs']:
+      utils.makedirs(os.path.join(build_path, rel.replace('/', os.sep)))
+    for rel, entry in sorted(manifest['files'].items()):
+      dst = os.path.join(build_path, rel.replace('/', os.sep))
+      if os.path.lexists(dst) and not os.path.isdir(dst):
+        os.remove(dst)
+      counts[materialize(object_path(override_path, entry), dst)] += 1
+  if logger and manifest['files']:
+    logger.info('[Flux]: applied {} override files ({})'.format(len(manifest['files']),
+      ', '.join('{} {}'.format(v, k) for k, v in counts.items() if v)))
+  return len(manifest['files'])
+
+
+def materialize(src, dst):
+  ''' Creates *dst* from the object *src* and returns how: "reflinked",
+  "hardlinked" or "copied". Reflinks and copies are writable. '''
+
+  if config.override_hardlinks:
+    try:
+      os.link(src, dst)
+      return 'hardlinked'
+    except OSError:
+      pass
+  how = 'reflinked' if clone_file(src, dst) else 'copied'
+  if how == 'copied':
+    shutil.copyfile(src, dst)
+  os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
+  return how
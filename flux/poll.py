@@ -0,0 +1,177 @@
+# -*- coding: utf8 -*-
+'''
+Change detection for repositories that can not deliver webhooks to Flux.
+Repositories that have polling enabled are periodically checked with
+``git ls-remote`` and a build is queued for every branch or tag that
+points to a new commit (and passes the repository's ref whitelist).
+
+The polling interval of each repository starts at ``poll_interval``
+and grows while the repository does not change or can not be reached,
+up to ``poll_max_interval``. Every interval is randomized by
+``poll_jitter`` so that the repositories do not hit the Git server
+all at the same time.
+'''
+
+from flux import app, config, utils, models
+from flux.build import enqueue, queue_is_full
+from flux.models import select, Build, PollState
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Condition, Thread
+
+import random
+import traceback
+
+
+class RepositoryPoller(object):
+  ''' Schedules the repositories that are due for polling on a
+  bounded pool of worker threads. '''
+
+  def __init__(self):
+    self._cond = Condition()
+    self._running = False
+    self._thread = None
+    self._executor = None
+    self._pending = set()
+
+  def start(self, num_workers=1):
+    if num_workers < 1:
+      raise ValueError('num_workers must be >= 1')
+    with self._cond:
+      if self._running:
+        raise RuntimeError('already running')
+      self._running = True
+      self._executor = ThreadPoolExecutor(max_workers=num_workers)
+      self._thread = Thread(target=self._run, args=[num_workers])
+      self._thread.start()
+
+  def stop(self, join=True):
+    with self._cond:
+      if not self._running:
+        return
+      self._running = False
+      self._cond.notify()
+    if join:
+      self._thread.join()
+      self._executor.shutdown(wait=True)
+
+  def _run(self, num_workers):
+    while True:
+      with self._cond:
+        if not self._running:
+          break
+      try:
+        timeout = self._schedule(num_workers)
+      except BaseException:
+        traceback.print_exc()
+        timeout = config.poll_interval
+      with self._cond:
+        if self._running:
+          self._cond.wait(timeout)
+
+  def _schedule(self, num_workers):
+    ''' Submits the repositories that are due for polling to the worker
+    pool and returns the number of seconds until the next one is due. '''
+
+    now = datetime.now()
+    with models.session():
+      states = select(x for x in PollState if x.next_poll is None or x.next_poll <= now)
+      states = states.order_by(PollState.next_poll)[:num_workers * 2]
+      due = [x.repo.id for x in states]
+      upcoming = select(x.next_poll for x in PollState if x.next_poll > now).min()
+
+    with self._cond:
+      for repo_id in due:
+        if repo_id not in self._pending:
+          self._pending.add(repo_id)
+          self._executor.submit(self._poll, repo_id)
+      if len(self._pending) >= num_workers:
+        # Wait for a worker to finish before scheduling more repositories.
+        return 1.0
+
+    if upcoming is None:
+      return config.poll_interval
+    return min(config.poll_interval, max(1.0, (upcoming - now).total_seconds()))
+
+  def _poll(self, repo_id):
+    try:
+      poll_repo(repo_id)
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      with self._cond:
+        self._pending.discard(repo_id)
+        self._cond.notify()
+
+
+def next_interval(state, changed, failed):
+  ''' Calculates the polling interval of a repository after it has been
+  polled, without jitter. '''
+
+  if failed:
+    interval = config.poll_interval * (2 ** min(state.failures, 16))
+  elif changed:
+    interval = config.poll_interval
+  else:
+    interval = state.interval * 1.5
+  return int(max(config.poll_interval, min(interval, config.poll_max_interval)))
+
+
+def poll_repo(repo_id):
+  ''' Checks the repository with the specified *repo_id* for new commits
+  and queues builds for every ref that changed since the last poll. The
+  first successful poll only records the current state of the refs. '''
+
+  with models.session():
+    repo = models.Repository.get(id=repo_id)
+    if not repo or not repo.poll_state:
+      return
+    clone_url = repo.clone_url
+
+  # Do not hold a database session while talking to the Git server.
+  res, refs = utils.ls_remote(clone_url, repo)
+
+  builds = []
+  with models.session():
+    repo = models.Repository.get(id=repo_id)
+    if not repo or not repo.poll_state:
+      return
+    state = repo.poll_state
+    state.last_poll = datetime.now()
+
+    changed = False
+    if res != 0:
+      state.failures += 1
+      state.last_error = 'git ls-remote exited with code {}'.format(res)
+      app.logger.warning('Polling {} failed ({})'.format(repo.name, state.last_error))
+    else:
+      state.failures = 0
+      state.last_error = ''
+      seen = state.get_refs()
+      if seen is not None:
+        for ref, sha in sorted(refs.items()):
+          if seen.get(ref) == sha or not repo.check_accept_ref(ref):
+            continue
+          if queue_is_full():
+            # Keep the old SHA so that the change is picked up again
+            # once there is room in the queue.
+            refs[ref] = seen.get(ref)
+            continue
+          builds.append(Build.create(repo, ref, sha))
+          changed = True
+      state.set_refs({k: v for k, v in refs.items() if v is not None})
+
+    state.interval = next_interval(state, changed, res != 0)
+    jitter = random.uniform(-config.poll_jitter, config.poll_jitter)
+    state.next_poll = state.last_poll + timedelta(seconds=state.interval * (1 + jitter))
+
+    models.commit()
+    for build in builds:
+      enqueue(build)
+      app.logger.info('Build #{} for repository {} queued (polled {})'
+        .format(build.num, repo.name, build.ref))
+
+
+_poller = RepositoryPoller()
+run_poller = _poller.start
+stop_poller = _poller.stop
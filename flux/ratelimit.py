@@ -0,0 +1,98 @@
+# -*- coding: utf8 -*-
+"""
+Token bucket rate limiting. Used to protect the push webhook from
+repositories or hosts that deliver events in a tight loop.
+"""
+
+import math
+import threading
+import time
+
+
+class TokenBucket(object):
+  """
+  A token bucket that holds at most *capacity* tokens and refills at
+  *rate* tokens per second. Every accepted request consumes one token.
+
+  # Parameters
+  capacity (int): The maximum number of tokens (the allowed burst).
+  rate (float): The number of tokens added per second.
+  """
+
+  def __init__(self, capacity, rate):
+    if capacity < 1:
+      raise ValueError('capacity must be >= 1')
+    if rate <= 0:
+      raise ValueError('rate must be > 0')
+    self.capacity = capacity
+    self.rate = rate
+    self.tokens = float(capacity)
+    self.updated = time.monotonic()
+
+  def _refill(self, now):
+    elapsed = max(0.0, now - self.updated)
+    self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+    self.updated = now
+
+  def consume(self, now=None):
+    """
+    Consumes one token.
+
+    # Return
+    float: Zero if a token was available, otherwise the number of
+        seconds until the next token becomes available.
+    """
+
+    self._refill(time.monotonic() if now is None else now)
+    if self.tokens >= 1.0:
+      self.tokens -= 1.0
+      return 0.0
+    return (1.0 - self.tokens) / self.rate
+
+  def is_full(self, now=None):
+    self._refill(time.monotonic() if now is None else now)
+    return self.tokens >= self.capacity
+
+
+class RateLimiter(object):
+  """
+  Keeps one #TokenBucket per key. The *limit* is a tuple of
+  `(count, seconds)` which allows a burst of *count* requests and
+  refills the bucket within *seconds*. A *limit* of #None disables
+  the rate limiter.
+
+  Buckets that are full again are discarded once more than
+  *max_keys* keys are tracked, so the memory use stays bounded.
+  """
+
+  def __init__(self, limit, max_keys=10000):
+    self.limit = limit
+    self.max_keys = max_keys
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def hit(self, key):
+    """
+    Registers a request for *key*.
+
+    # Return
+    int: Zero if the request is allowed, otherwise the number of
+        seconds that the client should wait before retrying.
+    """
+
+    if self.limit is None:
+      return 0
+    count, seconds = self.limit
+    with self._lock:
+      bucket = self._buckets.get(key)
+      if bucket is None:
+        if len(self._buckets) >= self.max_keys:
+          self._prune()
+        bucket = self._buckets[key] = TokenBucket(count, count / float(seconds))
+      wait = bucket.consume()
+    return int(math.ceil(wait))
+
+  def _prune(self):
+    now = time.monotonic()
+    for key in [k for k, b in self._buckets.items() if b.is_full(now)]:
+      del self._buckets[key]
@@ -0,0 +1,456 @@
+# -*- coding: utf8 -*-
+'''
+Resource limits, accounting and scheduling priorities for the build
+scripts.
+
+If ``cgroup_root`` points to a cgroup v2 directory that has been delegated
+to the Flux CI user, every build script runs in its own child cgroup with
+the CPU, memory and process limits of its repository. The peak memory,
+CPU time and I/O of the whole process tree are read from the cgroup when
+the script exited, and the remaining processes are killed.
+
+Otherwise (or if the memory controller is not available) the memory limit
+is applied with ``setrlimit(RLIMIT_AS)`` to each process of the build, and
+the CPU time and I/O are taken from the ``rusage`` of the build script and
+the children it waited for. The peak memory is only known from the cgroup:
+``ru_maxrss`` includes the memory of the Flux CI process that the script
+was started from. The CPU and process limits need cgroups.
+
+Builds of repositories with a RAM workspace size run in a directory in
+``ram_workspace_dir`` (see :func:`workspace`) while their size fits into
+the free space.
+
+This module must not import :mod:`flux.models`, it is also used by build
+agents.
+'''
+
+from flux import config, utils
+
+import collections
+import contextlib
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None  # Windows
+
+#: The limits of a build. Every value is None if it is not limited. *cpu*
+#: is in percent of one CPU, *memory* in MiB.
+Limits = collections.namedtuple('Limits', 'cpu memory pids')
+
+#: The resource usage of a build, every value may be None if it is unknown.
+Usage = collections.namedtuple('Usage', 'peak_rss_kb cpu_time_ms io_read_kb io_write_kb')
+
+#: The length of a CPU period in microseconds, see ``cpu.max``.
+CPU_PERIOD = 100000
+
+#: The number of seconds that a terminated build script has to exit
+#: before it is killed.
+TERMINATE_TIMEOUT = 10
+
+#: Names of the I/O scheduling classes of ``ionice -c``.
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+#: The CPUs that the process may run on when it is started.
+_process_cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else set()
+
+# The sizes of the RAM workspaces of the running builds in MiB by path.
+_ram_workspaces = {}
+_ram_lock = threading.Lock()
+
+# The paths of the cgroups of the running build scripts of this process.
+_cgroups = set()
+_cgroups_lock = threading.Lock()
+
+
+def get_limits(repo):
+  ''' Returns the :class:`Limits` of the builds of *repo*, which falls back
+  to the ``build_limit_*`` configuration values. '''
+
+  def value(name):
+    return getattr(repo, 'limit_' + name, None) or getattr(config, 'build_limit_' + name) or None
+  return Limits(value('cpu'), value('memory'), value('pids'))
+
+
+def get_priority_prefix(logger=None, cpus=None):
+  """
+  Returns the command that runs the build script on the set of *cpus*
+  (with taskset), with the `build_nice` niceness (with nice) and the
+  `build_ionice` I/O scheduling class (with ionice). The settings are
+  applied before the build script starts, thus they are inherited by all
+  processes of the build.
+
+  # Return
+  tuple of (list, set): The command, and the settings (`'cpus'` or
+    `'nice'`) whose command is not installed, which the caller has to
+    apply in the child process instead.
+  """
+
+  prefix = []
+  missing = set()
+  if cpus:
+    taskset = shutil.which('taskset')
+    if taskset:
+      prefix += [taskset, '-c', ','.join(map(str, sorted(cpus)))]
+    else:
+      missing.add('cpus')
+  if config.build_nice:
+    nice = shutil.which('nice')
+    if nice:
+      prefix += [nice, '-n', str(int(config.build_nice))]
+    else:
+      missing.add('nice')
+  if config.build_ionice:
+    ionice = shutil.which('ionice')
+    if ionice:
+      io_class, _, level = str(config.build_ionice).partition(':')
+      prefix += [ionice, '-c', IONICE_CLASSES.get(io_class, io_class)]
+      if level:
+        prefix += ['-n', level]
+    elif logger:
+      logger.warning('[Flux]: build_ionice is set, but ionice is not installed')
+  return prefix, missing
+
+
+def get_slot_cpus(slot, num_slots):
+  """
+  Returns the set of CPUs that build slot number *slot* of *num_slots* is
+  pinned to, or #None if `build_cpu_pinning` is disabled. The CPUs of the
+  process, except for the first `build_reserved_cpus` which are left to
+  the web server and the build consumers, are split evenly between the
+  slots. Slots share CPUs if there are more slots than CPUs.
+  """
+
+  if not config.build_cpu_pinning or not hasattr(os, 'sched_getaffinity'):
+    return None
+  cpus = sorted(_process_cpus)[config.build_reserved_cpus:]
+  if not cpus or num_slots < 1:
+    return None
+  if num_slots >= len(cpus):
+    return {cpus[slot % len(cpus)]}
+  size = len(cpus) // num_slots
+  start = (slot % num_slots) * size
+  end = start + size if slot % num_slots < num_slots - 1 else len(cpus)
+  return set(cpus[start:end])
+
+
+@contextlib.contextmanager
+def workspace(build, build_path, logger):
+  """
+  A context manager that returns the directory that *build* runs in. If
+  the repository of the build has a RAM workspace size (`ram_workspace`,
+  in MiB) and `ram_workspace_dir` is set, this is a directory in the
+  latter, which is removed on exit. Otherwise, or if the size does not
+  fit into the free space, it is *build_path*.
+  """
+
+  size = getattr(build.repo, 'ram_workspace', None)
+  path = None
+  if size and config.ram_workspace_dir:
+    path = os.path.join(config.ram_workspace_dir, build.repo.name.replace('/', os.sep), str(build.num))
+    reason = reserve_ram_workspace(path, size)
+    if reason:
+      logger.info('[Flux]: running on disk, the RAM workspace is not available: ' + reason)
+      path = None
+    else:
+      logger.info('[Flux]: running in a RAM workspace of {} MiB'.format(size))
+  try:
+    yield path or build_path
+  finally:
+    if path:
+      with _ram_lock:
+        _ram_workspaces.pop(path, None)
+      if os.path.isdir(path):
+        utils.rmtree(path, remove_write_protection=True)
+
+
+def reserve_ram_workspace(path, size):
+  ''' Reserves *size* MiB in ``ram_workspace_dir`` for the workspace at
+  *path*. The reservations of the running builds count against
+  ``ram_workspace_size``, or the size of the directory's file system, even
+  if the builds did not fill their workspaces yet. Returns None if it
+  fits, otherwise the reason why not. '''
+
+  try:
+    if os.path.isdir(path):
+      utils.rmtree(path, remove_write_protection=True)  # Left over by a crash
+    utils.makedirs(os.path.dirname(path))
+    usage = shutil.disk_usage(config.ram_workspace_dir)
+  except OSError as exc:
+    return str(exc)
+  free = usage.free // 1024 ** 2
+  budget = config.ram_workspace_size
+  if budget is None:
+    budget = usage.total // 1024 ** 2
+  with _ram_lock:
+    reserved = sum(_ram_workspaces.values())
+    if reserved + size > budget:
+      return '{} MiB needed, {} of {} MiB reserved'.format(size, reserved, budget)
+    if size > free:
+      return '{} MiB needed, {} MiB free'.format(size, free)
+    _ram_workspaces[path] = size
+  return None
+
+
+def format_limits(limits):
+  parts = []
+  if limits.cpu:
+    parts.append('{}% CPU'.format(limits.cpu))
+  if limits.memory:
+    parts.append('{} MiB memory'.format(limits.memory))
+  if limits.pids:
+    parts.append('{} processes'.format(limits.pids))
+  return ', '.join(parts) or 'none'
+
+
+def format_usage(usage):
+  fmt = lambda value, unit: '?' if value is None else '{}{}'.format(value, unit)
+  return 'peak RSS {}, CPU time {}, read {}, written {}'.format(
+    fmt(usage.peak_rss_kb, ' KiB'), fmt(usage.cpu_time_ms, ' ms'),
+    fmt(usage.io_read_kb, ' KiB'), fmt(usage.io_write_kb, ' KiB'))
+
+
+def cgroups_available():
+  ''' Returns True if ``cgroup_root`` is a writable cgroup v2 directory. '''
+
+  root = config.cgroup_root
+  return bool(root) and os.path.isfile(os.path.join(root, 'cgroup.subtree_control')) \
+    and os.access(root, os.W_OK)
+
+
+class BuildProcess(object):
+  ''' A build script that runs with the :class:`Limits` *limits*, in a
+  cgroup named after the *build_id* (and the *job_num* of a job of the
+  build matrix or pipeline) if available, on the CPUs *cpus* (a set, or
+  None for all CPUs) and with the ``build_nice`` and ``build_ionice``
+  priorities. :meth:`poll` and :meth:`terminate` behave like those of
+  :class:`subprocess.Popen`. '''
+
+  def __init__(self, build_id, limits, logger, cpus=None, job_num=None):
+    self.build_id = build_id
+    self.job_num = job_num
+    self.limits = limits
+    self.logger = logger
+    self.cpus = cpus
+    self.cgroup = None
+    self.returncode = None
+    self._memory_limited = False
+    self._rlimit_memory = False
+    self._preexec_priority = set()
+    self._rusage = None
+    self._popen = None
+
+  def start(self, command, **kwargs):
+    ''' Starts the *command* with :class:`subprocess.Popen`, which receives
+    the *kwargs*. '''
+
+    if cgroups_available():
+      try:
+        self.cgroup = self._create_cgroup()
+      except OSError as exc:
+        self.logger.warning('[Flux]: could not create a cgroup: {}'.format(exc))
+    # Falls back to setrlimit() if the memory controller is not available.
+    self._rlimit_memory = bool(resource and self.limits.memory and not self._memory_limited)
+    if self.cpus and not hasattr(os, 'sched_setaffinity'):
+      self.cpus = None
+    if self.cpus:
+      self.logger.info('[Flux]: running on CPU(s) {}'.format(','.join(map(str, sorted(self.cpus)))))
+    # The CPUs and priorities are set by commands that run the script,
+    # unless they are not installed. The cgroup and the memory limit must
+    # be set up in the child before the command is executed.
+    prefix, self._preexec_priority = get_priority_prefix(self.logger, self.cpus)
+    if os.name == 'nt':
+      self._preexec_priority = set()
+    preexec_fn = None
+    if os.name != 'nt' and (self.cgroup or self._rlimit_memory or self._preexec_priority):
+      preexec_fn = self._preexec
+    try:
+      self._popen = subprocess.Popen(prefix + list(command), preexec_fn=preexec_fn, **kwargs)
+    except BaseException:
+      if self.cgroup:
+        self._remove_cgroup(self.cgroup)
+      raise
+    return self
+
+  @property
+  def pid(self):
+    return self._popen.pid
+
+  def poll(self):
+    ''' Returns the exit code or None if the script is still running.
+    The script is reaped with :func:`os.wait4` to get its usage. '''
+
+    if self.returncode is not None:
+      return self.returncode
+    if not hasattr(os, 'wait4'):
+      self.returncode = self._popen.poll()
+      return self.returncode
+    pid, status, rusage = os.wait4(self._popen.pid, os.WNOHANG)
+    if pid == 0:
+      return None
+    self.returncode = self._popen.returncode = os.waitstatus_to_exitcode(status)
+    self._rusage = rusage
+    return self.returncode
+
+  def terminate(self):
+    self._popen.terminate()
+
+  def finish(self):
+    ''' Kills the processes that are left in the cgroup, removes it and
+    returns the :class:`Usage`. Must be called after the script exited. '''
+
+    if self.returncode is None:
+      self.terminate()
+      deadline = time.monotonic() + TERMINATE_TIMEOUT
+      while self.poll() is None:
+        if deadline is not None and time.monotonic() > deadline:
+          self._popen.kill()
+          deadline = None
+        time.sleep(0.1)
+    usage = Usage(None, None, None, None)
+    if self._rusage is not None:
+      ru = self._rusage
+      usage = Usage(
+        peak_rss_kb=None,  # ru_maxrss would include the memory of this process
+        cpu_time_ms=int((ru.ru_utime + ru.ru_stime) * 1000),
+        io_read_kb=ru.ru_inblock // 2,  # 512 byte blocks
+        io_write_kb=ru.ru_oublock // 2)
+    if self.cgroup:
+      # The cgroup covers all processes, the rusage only fills the values
+      # of the controllers that are not enabled.
+      try:
+        cgroup_usage = self._finish_cgroup()
+      except OSError as exc:
+        self.logger.warning('[Flux]: could not read the cgroup: {}'.format(exc))
+      else:
+        usage = Usage(*[a if a is not None else b for a, b in zip(cgroup_usage, usage)])
+    return usage
+
+  def _create_cgroup(self):
+    name = 'flux-build-{}'.format(self.build_id)
+    if self.job_num is not None:
+      name += '-{}'.format(self.job_num)
+    path = os.path.join(config.cgroup_root, name)
+    with _cgroups_lock:
+      if path in _cgroups:
+        raise OSError('cgroup {} is in use'.format(path))
+      if os.path.isdir(path):
+        os.rmdir(path)  # Left over by a crashed build
+      os.mkdir(path)
+      _cgroups.add(path)
+    try:
+      self._setup_cgroup(path)
+    except BaseException:
+      self._remove_cgroup(path)
+      raise
+    self.logger.info('[Flux]: running in cgroup {}'.format(path))
+    return path
+
+  def _setup_cgroup(self, path):
+    with open(os.path.join(path, 'cgroup.controllers')) as fp:
+      controllers = fp.read().split()
+    cpu, memory, pids = self.limits
+    if cpu and 'cpu' in controllers:
+      write(path, 'cpu.max', '{} {}'.format(int(CPU_PERIOD * cpu / 100), CPU_PERIOD))
+    if memory and 'memory' in controllers:
+      write(path, 'memory.max', str(memory * 1024 ** 2))
+      write(path, 'memory.swap.max', '0', ignore_errors=True)
+      self._memory_limited = True
+    if pids and 'pids' in controllers:
+      write(path, 'pids.max', str(pids))
+    missing = [name for name, value in zip(self.limits._fields, self.limits)
+               if value and name not in controllers]
+    if missing:
+      self.logger.warning('[Flux]: the {} controller(s) are not enabled in {}'
+        .format(', '.join(missing), config.cgroup_root))
+
+  def _preexec(self):
+    # Runs in the child process before the build script is executed.
+    if self.cgroup:
+      with open(os.path.join(self.cgroup, 'cgroup.procs'), 'w') as fp:
+        fp.write('0')
+    if self._rlimit_memory:
+      limit = self.limits.memory * 1024 ** 2
+      resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if 'cpus' in self._preexec_priority:
+      os.sched_setaffinity(0, self.cpus)
+    if 'nice' in self._preexec_priority and hasattr(os, 'nice'):
+      os.nice(config.build_nice)
+
+  def _finish_cgroup(self):
+    path = self.cgroup
+    if os.path.isfile(os.path.join(path, 'cgroup.kill')):
+      write(path, 'cgroup.kill', '1')
+    else:
+      for pid in read(path, 'cgroup.procs').split():
+        try:
+          os.kill(int(pid), signal.SIGKILL)
+        except OSError:
+          pass
+    cpu_stat = parse_keyed(read(path, 'cpu.stat'))
+    usage = Usage(
+      peak_rss_kb=int(read(path, 'memory.peak') or 0) // 1024 or None,
+      cpu_time_ms=cpu_stat.get('usage_usec', 0) // 1000 if cpu_stat else None,
+      io_read_kb=None, io_write_kb=None)
+    io = [parse_keyed(line) for line in read(path, 'io.stat').splitlines()]
+    if io:
+      usage = usage._replace(
+        io_read_kb=sum(x.get('rbytes', 0) for x in io) // 1024,
+        io_write_kb=sum(x.get('wbytes', 0) for x in io) // 1024)
+    self._remove_cgroup(path)
+    return usage
+
+  def _remove_cgroup(self, path):
+    # The cgroup can only be removed once the killed processes are gone.
+    try:
+      for i in range(50):
+        try:
+          os.rmdir(path)
+          break
+        except FileNotFoundError:
+          break
+        except OSError:
+          time.sleep(0.1)
+      else:
+        self.logger.warning('[Flux]: could not remove cgroup {}'.format(path))
+    finally:
+      with _cgroups_lock:
+        _cgroups.discard(path)
+
+
+def read(path, filename):
+  ''' Returns the content of a cgroup interface file, or an empty string if
+  it does not exist (eg. because the controller is not enabled). '''
+
+  try:
+    with open(os.path.join(path, filename)) as fp:
+      return fp.read().strip()
+  except FileNotFoundError:
+    return ''
+
+
+def parse_keyed(content):
+  ''' Parses the content of a flat keyed cgroup file (``key value`` per
+  line) or a line of a nested keyed file (``device key=value ...``) into a
+  dictionary of integers. '''
+
+  if '=' in content:
+    pairs = [x.split('=', 1) for x in content.split() if '=' in x]
+  else:
+    pairs = [x.split(None, 1) for x in content.splitlines() if x.strip()]
+  return {k: int(v) for k, v in pairs if v.strip().isdigit()}
+
+
+def write(path, filename, value, ignore_errors=False):
+  try:
+    with open(os.path.join(path, filename), 'w') as fp:
+      fp.write(value)
+  except OSError:
+    if not ignore_errors:
+      raise
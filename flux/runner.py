@@ -0,0 +1,667 @@
+# -*- coding: utf8 -*-
+'''
+The steps of a build that do not access the database: cloning the
+repository, applying the overrides and running the build script. They
+are shared by the build consumers (see :mod:`flux.build`) and the build
+agents (see :mod:`flux.agent_runner`), which run on hosts that have no
+access to the database.
+'''
+
+from flux import config, mirror, overrides, resources, utils
+from flux.enums import GitFolderHandling
+
+import collections
+import itertools
+import json
+import os
+import re
+import shlex
+import shutil
+import stat
+import subprocess
+import threading
+import time
+
+
+#: A job of a build matrix, see #expand_matrix(). *env* contains the
+#: variables of the job.
+Job = collections.namedtuple('Job', 'num name env')
+
+#: A stage of a pipeline, see #parse_stages(). It runs as the #Job *job*,
+#: whose name is the name of the stage.
+Stage = collections.namedtuple('Stage', 'job script needs outputs')
+
+# The same values as the models.Build.Status strings.
+STATUS_SUCCESS = 'success'
+STATUS_ERROR = 'error'
+STATUS_STOPPED = 'stopped'
+
+
+def deleteGitFolder(build_path):
+  shutil.rmtree(os.path.join(build_path, '.git'))
+
+
+def do_build_(build, build_path, override_path, logger, logfile, terminate_event, update,
+              cpus=None, run_jobs=None, stage_cache=None):
+  """
+  Clones the repository of *build* into *build_path*, applies the files
+  from *override_path* and runs the build script. Returns #True if the
+  build succeeded.
+
+  # Parameters
+  build: A #Build, or an object with the same `id`, `num`, `ref`,
+    `commit_sha`, `repo.name` and `repo.clone_url` attributes.
+  update (callable): Called with the keyword arguments `commit_sha` and
+    `ref` when they have been resolved from a branch name, and with the
+    fields of the #resources.Usage when the build script exited.
+  cpus (set, None): The CPUs that the build script is pinned to, see
+    #resources.get_slot_cpus().
+  run_jobs (callable, None): Runs the jobs of a build matrix or the stages
+    of a pipeline, see #run_serially().
+  stage_cache (str, None): The directory in which the checkout and the
+    outputs of the stages of a pipeline are kept when the pipeline fails,
+    see #run_pipeline(). Without it, a pipeline always starts over.
+  """
+
+  logger.info('[Flux]: build {}#{} started'.format(build.repo.name, build.num))
+
+  source = os.path.join(stage_cache, 'source') if stage_cache else None
+  if source and os.path.isdir(source):
+    logger.info('[Flux]: resuming the pipeline with the checkout of the previous run')
+    utils.copy_workspace(source, build_path)
+  elif not checkout(build, build_path, override_path, logger, terminate_event, update):
+    return False
+
+  # Read the build definition, if the repository has one.
+  try:
+    definition = load_definition(build_path)
+    stages = parse_stages(definition)
+    jobs = expand_matrix(definition)
+  except ValueError as exc:
+    logger.error('[Flux]: invalid {}: {}'.format(config.build_definition, exc))
+    return False
+  if stages and jobs:
+    logger.error('[Flux]: invalid {}: "stages" and "matrix" can not be combined'
+      .format(config.build_definition))
+    return False
+
+  runner = JobRunner(build, build_path, logger, logfile, terminate_event, cpus,
+    run_jobs or run_serially)
+  if stages:
+    success = run_pipeline(runner, stages, stage_cache)
+  else:
+    # Find the build script that we need to execute.
+    script_fn = find_build_script(build_path, definition)
+    if not script_fn:
+      choices = '{' + ','.join(map(str, config.build_scripts)) + '}'
+      logger.error('[Flux]: no build script found, choices are ' + choices)
+      return False
+    if jobs:
+      success = run_matrix(runner, script_fn, jobs)
+    else:
+      success = run_script(build, build_path, script_fn, logger, logfile,
+        terminate_event, update, cpus)
+  if runner.usages:
+    update(**runner.get_usage()._asdict())
+  if not success:
+    return False
+
+  # Deletes .git folder after build, if is configured so.
+  if config.git_folder_handling == GitFolderHandling.DELETE_AFTER_BUILD:
+    logger.info('[Flux]: removing .git folder after build')
+    deleteGitFolder(build_path)
+  return True
+
+
+def checkout(build, build_path, override_path, logger, terminate_event, update):
+  """
+  Clones the repository of *build* into *build_path*, checks out its
+  commit and applies the files from *override_path*. Returns #True on
+  success. The parameters are the same as those of #do_build_().
+  """
+
+  if build.ref and build.commit_sha == ("0" * 32):
+    build_start_point = build.ref
+    is_ref_build = True
+  else:
+    build_start_point = build.commit_sha
+    is_ref_build = False
+
+  # Clone the repository, from the local mirror if possible.
+  env = utils.get_git_ssh_env(build.repo)  # Enables batch mode
+  logger.info('[Flux]: GIT_SSH_COMMAND={!r}'.format(env['GIT_SSH_COMMAND']))
+  mirror_path = None
+  if mirror.enabled():
+    logger.info('[Flux]: updating mirror of {}'.format(build.repo.name))
+    mirror_path = mirror.fetch(build.repo, None if is_ref_build else build.commit_sha, logger)
+    if not mirror_path:
+      logger.warning('[Flux]: unable to update the mirror, cloning from remote')
+  if mirror_path:
+    clone_cmd = ['git', 'clone', '--quiet', mirror_path, build_path]
+  else:
+    clone_cmd = ['git', 'clone', build.repo.clone_url, build_path, '--recursive']
+  res = utils.run(clone_cmd, logger, env=env)
+  if res != 0:
+    logger.error('[Flux]: unable to clone repository')
+    return False
+  if mirror_path:
+    # Submodules with relative URLs are resolved against the origin.
+    utils.run(['git', 'remote', 'set-url', 'origin', build.repo.clone_url], logger, cwd=build_path)
+
+  if terminate_event.is_set():
+    logger.info('[Flux]: build stopped')
+    return False
+
+  # Checkout the correct build_start_point.
+  checkout_cmd = ['git', 'checkout', '-q', build_start_point]
+  res = utils.run(checkout_cmd, logger, cwd=build_path)
+  if res != 0:
+    logger.error('[Flux]: failed to checkout {!r}'.format(build_start_point))
+    return False
+
+  # If checkout was initiated by Start build, update commit_sha and ref of build
+  if is_ref_build:
+    # update commit sha
+    get_ref_sha_cmd = ['git', 'rev-parse', 'HEAD']
+    res_ref_sha, res_ref_sha_stdout = utils.run(get_ref_sha_cmd, logger, cwd=build_path, return_stdout=True)
+    if res_ref_sha == 0 and res_ref_sha_stdout != None:
+      update(commit_sha=res_ref_sha_stdout.strip())
+    else:
+      logger.error('[Flux]: failed to read current sha')
+      return False
+    # update ref; user could enter just branch name, e.g 'master'
+    get_ref_cmd = ['git', 'rev-parse', '--symbolic-full-name', build_start_point]
+    res_ref, res_ref_stdout = utils.run(get_ref_cmd, logger, cwd=build_path, return_stdout=True)
+    if res_ref == 0 and res_ref_stdout != None and res_ref_stdout.strip() != 'HEAD' and res_ref_stdout.strip() != '':
+      update(ref=res_ref_stdout.strip())
+    elif res_ref_stdout.strip() == '':
+      # keep going, used ref was probably commit sha
+      pass
+    else:
+      logger.error('[Flux]: failed to read current ref')
+      return False
+
+  if mirror_path and os.path.isfile(os.path.join(build_path, '.gitmodules')):
+    submodule_cmd = ['git', 'submodule', 'update', '--init', '--recursive']
+    res = utils.run(submodule_cmd, logger, cwd=build_path, env=env)
+    if res != 0:
+      logger.error('[Flux]: unable to update submodules')
+      return False
+
+  if terminate_event.is_set():
+    logger.info('[Flux]: build stopped')
+    return False
+
+  # Deletes .git folder before build, if is configured so.
+  if config.git_folder_handling == GitFolderHandling.DELETE_BEFORE_BUILD or config.git_folder_handling == None:
+    logger.info('[Flux]: removing .git folder before build')
+    deleteGitFolder(build_path)
+
+  # Apply the overridden files, if any.
+  overrides.apply(override_path, build_path, logger)
+  return True
+
+
+def find_build_script(build_path, definition=None):
+  """
+  Returns the path of the build script in *build_path*: the `script` of
+  the build *definition*, or the first of the `build_scripts` that exists.
+  Returns #None if there is no build script.
+  """
+
+  if definition and definition.get('script'):
+    names = [definition['script']]
+  else:
+    names = config.build_scripts
+  for fname in names:
+    script_fn = os.path.join(build_path, fname)
+    inside = os.path.realpath(script_fn).startswith(os.path.realpath(build_path) + os.sep)
+    if inside and os.path.isfile(script_fn):
+      return script_fn
+  return None
+
+
+def run_script(build, workspace, script_fn, logger, logfile, terminate_event,
+               update, cpus=None, env=None, job=None):
+  """
+  Runs the build script *script_fn* in the directory *workspace* and
+  reports its resource usage to *update*. Returns #True if the script
+  exited with code 0.
+
+  # Parameters
+  env (dict, None): Variables that are added to the environment.
+  job (Job, None): The job of the build matrix or pipeline that the script
+    runs for. Every job runs in its own cgroup.
+  """
+
+  # Make sure the build script is executable.
+  st = os.stat(script_fn)
+  os.chmod(script_fn, st.st_mode | stat.S_IEXEC)
+
+  # Execute the script.
+  logger.info('[Flux]: executing {}'.format(os.path.relpath(script_fn, workspace)))
+  logger.info('$ ' + shlex.quote(script_fn))
+  limits = resources.get_limits(build.repo)
+  if any(limits):
+    logger.info('[Flux]: limits: ' + resources.format_limits(limits))
+  popen = resources.BuildProcess(build.id, limits, logger, cpus,
+    job.num if job else None).start([script_fn],
+    cwd=workspace, stdout=logfile, stderr=subprocess.STDOUT, stdin=None,
+    env=dict(os.environ, **env) if env else None)
+
+  # Wait until the process finished or the terminate event is set.
+  try:
+    while popen.poll() is None and not terminate_event.is_set():
+      time.sleep(0.5)
+  finally:
+    # Terminates the script if it is still running.
+    usage = popen.finish()
+    logger.info('[Flux]: usage: ' + resources.format_usage(usage))
+    update(**usage._asdict())
+  if terminate_event.is_set():
+    logger.error('[Flux]: build stopped. build script terminated')
+    return False
+
+  logger.info('[Flux]: exit-code {}'.format(popen.returncode))
+  return popen.returncode == 0
+
+
+def load_definition(build_path):
+  """
+  Loads the build definition (the `build_definition` file, a JSON object)
+  from *build_path*. Returns #None if the repository has none. Raises a
+  #ValueError if it is invalid.
+  """
+
+  filename = os.path.join(build_path, config.build_definition)
+  if not os.path.isfile(filename):
+    return None
+  with open(filename, encoding='utf8') as fp:
+    definition = json.load(fp)
+  if not isinstance(definition, dict):
+    raise ValueError('expected a JSON object')
+  if not isinstance(definition.get('script', ''), str):
+    raise ValueError('"script" must be a string')
+  return definition
+
+
+def expand_matrix(definition):
+  """
+  Returns the list of #Job\s of the `matrix` of the build *definition*,
+  which maps variable names to lists of values. Every combination of the
+  values is a job, except for those that match an entry of the optional
+  `exclude` list. Returns an empty list if there is no matrix.
+
+  ```json
+  {
+    "matrix": {"python": ["3.8", "3.9"], "mode": ["debug", "release"]},
+    "exclude": [{"python": "3.8", "mode": "release"}]
+  }
+  ```
+  """
+
+  matrix = (definition or {}).get('matrix')
+  if not matrix:
+    return []
+  if not isinstance(matrix, dict) or not all(isinstance(v, list) and v for v in matrix.values()):
+    raise ValueError('"matrix" must map names to non-empty lists of values')
+  exclude = definition.get('exclude', [])
+  if not isinstance(exclude, list) or not all(isinstance(x, dict) for x in exclude):
+    raise ValueError('"exclude" must be a list of objects')
+
+  keys = sorted(matrix)
+  jobs = []
+  for values in itertools.product(*(matrix[k] for k in keys)):
+    variables = collections.OrderedDict(zip(keys, map(str, values)))
+    if any(all(variables.get(k) == str(v) for k, v in x.items()) for x in exclude):
+      continue
+    name = ' '.join('{}={}'.format(k, v) for k, v in variables.items())
+    env = {'FLUX_MATRIX_' + re.sub('[^A-Z0-9_]', '_', k.upper()): v for k, v in variables.items()}
+    env['FLUX_JOB'] = name
+    jobs.append(Job(len(jobs), name, env))
+  if len(jobs) > config.build_max_jobs:
+    raise ValueError('the matrix has {} jobs, at most {} are allowed'
+      .format(len(jobs), config.build_max_jobs))
+  return jobs
+
+
+def run_serially(jobs, run):
+  """
+  Runs the *jobs* of a build one after another in the current thread. This
+  is the default for the `run_jobs` argument of #do_build_(), which build
+  consumers replace to run the jobs on all their free build slots.
+
+  # Parameters
+  jobs (list of Job): The jobs of the build.
+  run (callable): Runs a job, accepts the #Job and the set of CPUs (or
+    #None) and returns the status of the job.
+
+  # Return
+  list of str: The status of every job.
+  """
+
+  return [run(job, None) for job in jobs]
+
+
+class JobRunner(object):
+  """
+  Runs #Job\s of a build with the `run_jobs` function of #do_build_().
+  Every job writes its own log, which is appended to the build log when
+  the jobs finished, and may work in its own copy of the checkout (see
+  #workspace()). The usage of all jobs is collected in #usages.
+  """
+
+  def __init__(self, build, build_path, logger, logfile, terminate_event, cpus, run_jobs):
+    self.build = build
+    self.build_path = build_path
+    self.logger = logger
+    self.logfile = logfile
+    self.terminate_event = terminate_event
+    self.cpus = cpus
+    self.run_jobs = run_jobs
+    self.usages = {}
+    self._lock = threading.Lock()
+
+  def workspace(self, job):
+    """
+    Copies the checkout for the *job* (see #utils.copy_workspace()) and
+    returns its path. It is removed when the job finished.
+    """
+
+    path = '{}.job-{}'.format(self.build_path, job.num)
+    if os.path.isdir(path):
+      utils.rmtree(path, remove_write_protection=True)
+    utils.copy_workspace(self.build_path, path)
+    return path
+
+  def run_script(self, job, workspace, script_fn, logger, logfile, cpus):
+    """
+    Runs the build script *script_fn* in the *workspace* of the *job*
+    with the environment variables of the job. Returns the status.
+    """
+
+    def update(**usage):
+      with self._lock:
+        self.usages[job.num] = usage
+    if run_script(self.build, workspace, script_fn, logger, logfile,
+                  self.terminate_event, update, cpus, job.env, job):
+      return STATUS_SUCCESS
+    return STATUS_STOPPED if self.terminate_event.is_set() else STATUS_ERROR
+
+  def run(self, jobs, execute):
+    """
+    Runs the *jobs* and returns the status of every job.
+
+    # Parameters
+    execute (callable): Runs a job. Accepts the #Job, a logger and the log
+      file of the job and the set of CPUs (or #None), and returns its status.
+    """
+
+    def run(job, cpus):
+      log_path = '{}.job-{}.log'.format(self.build_path, job.num)
+      with open(log_path, 'w') as logfile:
+        logger = utils.create_logger(logfile)
+        logger.info('[Flux]: {}'.format(job.name))
+        if self.terminate_event.is_set():
+          return STATUS_STOPPED
+        try:
+          return execute(job, logger, logfile, cpus or self.cpus)
+        except BaseException as exc:
+          logger.exception(exc)
+          return STATUS_ERROR
+        finally:
+          workspace = '{}.job-{}'.format(self.build_path, job.num)
+          if os.path.isdir(workspace):
+            utils.rmtree(workspace, remove_write_protection=True)
+
+    statuses = self.run_jobs(jobs, run)
+
+    # Append the logs of the jobs to the build log.
+    for job, status in zip(jobs, statuses):
+      log_path = '{}.job-{}.log'.format(self.build_path, job.num)
+      self.logfile.flush()
+      self.logfile.write('\n==== {} ({}) ====\n'.format(job.name, status))
+      if os.path.isfile(log_path):
+        with open(log_path) as fp:
+          shutil.copyfileobj(fp, self.logfile)
+        os.remove(log_path)
+      self.logfile.flush()
+    for job, status in zip(jobs, statuses):
+      self.logger.info('[Flux]: {}: {}'.format(job.name, status))
+    return statuses
+
+  def get_usage(self):
+    """
+    Returns the #resources.Usage of all jobs. The values are summed up,
+    except for the peak memory which is the maximum.
+    """
+
+    values = [resources.Usage(**x) for x in self.usages.values()]
+    total = lambda field: None if any(getattr(x, field) is None for x in values) \
+      else sum(getattr(x, field) for x in values)
+    return resources.Usage(
+      peak_rss_kb=max((x.peak_rss_kb or 0) for x in values) or None,
+      cpu_time_ms=total('cpu_time_ms'),
+      io_read_kb=total('io_read_kb'),
+      io_write_kb=total('io_write_kb'))
+
+
+def run_matrix(runner, script_fn, jobs):
+  """
+  Runs the build script once for every #Job of a build matrix with the
+  #JobRunner, each in its own copy of the checkout. Returns #True if all
+  jobs succeeded.
+  """
+
+  runner.logger.info('[Flux]: running {} jobs'.format(len(jobs)))
+
+  def execute(job, logger, logfile, cpus):
+    workspace = runner.workspace(job)
+    job_script = os.path.join(workspace, os.path.relpath(script_fn, runner.build_path))
+    return runner.run_script(job, workspace, job_script, logger, logfile, cpus)
+
+  statuses = runner.run(jobs, execute)
+  return all(x == STATUS_SUCCESS for x in statuses)
+
+
+def parse_stages(definition):
+  """
+  Returns the list of #Stage\s of the `stages` of the build *definition*
+  in the order of their dependencies, or an empty list if it has none.
+  Every stage runs a `script` after the stages that it `needs`, and the
+  files and directories listed in its `outputs` are passed on to the
+  stages that depend on it (directly or indirectly). Raises a #ValueError
+  if the stages are invalid or their dependencies contain a cycle.
+
+  ```json
+  {
+    "stages": {
+      "build": {"script": "ci/build.sh", "outputs": ["dist"]},
+      "lint": {"script": "ci/lint.sh"},
+      "test": {"script": "ci/test.sh", "needs": ["build"]},
+      "package": {"script": "ci/package.sh", "needs": ["test", "lint"]}
+    }
+  }
+  ```
+  """
+
+  stages = (definition or {}).get('stages')
+  if not stages:
+    return []
+  if not isinstance(stages, dict):
+    raise ValueError('"stages" must be an object')
+  if len(stages) > config.build_max_jobs:
+    raise ValueError('{} stages, at most {} are allowed'.format(len(stages), config.build_max_jobs))
+
+  def check_list(name, key, value):
+    if not isinstance(value, list) or not all(isinstance(x, str) and x for x in value):
+      raise ValueError('"{}" of stage {!r} must be a list of strings'.format(key, name))
+    return value
+
+  specs = {}
+  for name, spec in stages.items():
+    if not re.match(r'^[\w.-]+$', name):
+      raise ValueError('invalid stage name {!r}'.format(name))
+    if not isinstance(spec, dict) or not isinstance(spec.get('script'), str):
+      raise ValueError('stage {!r} needs a "script"'.format(name))
+    needs = check_list(name, 'needs', spec.get('needs', []))
+    outputs = check_list(name, 'outputs', spec.get('outputs', []))
+    for dep in needs:
+      if dep not in stages:
+        raise ValueError('stage {!r} needs unknown stage {!r}'.format(name, dep))
+    for path in outputs:
+      if os.path.isabs(path) or '..' in path.replace('\\', '/').split('/'):
+        raise ValueError('output {!r} of stage {!r} must be a relative path'.format(path, name))
+    specs[name] = (spec['script'], needs, outputs)
+
+  # Sort the stages topologically, stages without dependencies between
+  # them are kept in the order of their names.
+  order = []
+  visiting = set()
+  def visit(name, path):
+    if name in order:
+      return
+    if name in visiting:
+      raise ValueError('cyclic dependency: ' + ' -> '.join(path + [name]))
+    visiting.add(name)
+    for dep in sorted(specs[name][1]):
+      visit(dep, path + [name])
+    visiting.discard(name)
+    order.append(name)
+  for name in sorted(specs):
+    visit(name, [])
+
+  result = []
+  for num, name in enumerate(order):
+    script, needs, outputs = specs[name]
+    job = Job(num, name, {'FLUX_STAGE': name})
+    result.append(Stage(job, script, tuple(needs), tuple(outputs)))
+  return result
+
+
+def run_pipeline(runner, stages, stage_cache=None):
+  """
+  Runs the #Stage\s of a pipeline with the #JobRunner. All stages are
+  passed to the `run_jobs` function at once, in the order of their
+  dependencies, and every stage starts as soon as the stages that it
+  needs finished (thus it does not wait for unrelated stages). Every stage
+  runs in its own copy of the checkout that also contains the outputs of
+  the stages that it depends on. A stage whose dependency did not succeed
+  is skipped (its status is "stopped"). The outputs of all stages are
+  copied into the build directory when the pipeline succeeded.
+
+  The checkout and the outputs of every stage that succeeded are kept in
+  the *stage_cache* directory. If the pipeline fails, it is kept and a
+  restart of the build only runs the stages that did not succeed yet,
+  without cloning the repository again. Returns #True if all stages
+  succeeded.
+  """
+
+  logger = runner.logger
+  temporary = not stage_cache
+  if temporary:
+    stage_cache = runner.build_path + '.stages'
+    if os.path.isdir(stage_cache):
+      utils.rmtree(stage_cache, remove_write_protection=True)
+  source = os.path.join(stage_cache, 'source')
+  if not temporary and not os.path.isdir(source):
+    utils.makedirs(stage_cache)
+    utils.copy_workspace(runner.build_path, source + '.tmp')
+    os.rename(source + '.tmp', source)
+  output_path = lambda name: os.path.join(stage_cache, 'outputs', name)
+  by_name = {x.job.name: x for x in stages}
+  statuses = {}
+  finished = threading.Condition()
+
+  def ancestors(stage):
+    result = set()
+    pending = list(stage.needs)
+    while pending:
+      name = pending.pop()
+      if name not in result:
+        result.add(name)
+        pending.extend(by_name[name].needs)
+    return [x for x in stages if x.job.name in result]
+
+  def execute(job, logger, logfile, cpus):
+    stage = by_name[job.name]
+    # The stages are started in the order of their dependencies, thus the
+    # stages that this one needs are already running on other threads.
+    with finished:
+      if not all(x in statuses for x in stage.needs):
+        logger.info('[Flux]: waiting for {}'.format(', '.join(stage.needs)))
+      while not all(x in statuses for x in stage.needs):
+        if runner.terminate_event.is_set():
+          return STATUS_STOPPED
+        finished.wait(1)
+    failed = [x for x in stage.needs if statuses[x] != STATUS_SUCCESS]
+    if failed:
+      logger.info('[Flux]: skipped, {} did not succeed'.format(', '.join(failed)))
+      return STATUS_STOPPED
+    if os.path.isdir(output_path(job.name)):
+      logger.info('[Flux]: succeeded in a previous run, using the cached outputs')
+      return STATUS_SUCCESS
+    workspace = runner.workspace(job)
+    for dep in ancestors(stage):
+      if os.path.isdir(output_path(dep.job.name)):
+        shutil.copytree(output_path(dep.job.name), workspace, symlinks=True, dirs_exist_ok=True)
+    script_fn = find_build_script(workspace, {'script': stage.script})
+    if not script_fn:
+      logger.error('[Flux]: build script {!r} not found'.format(stage.script))
+      return STATUS_ERROR
+    status = runner.run_script(job, workspace, script_fn, logger, logfile, cpus)
+    if status == STATUS_SUCCESS and not save_outputs(stage, workspace, output_path(job.name), logger):
+      status = STATUS_ERROR
+    return status
+
+  def execute_stage(job, logger, logfile, cpus):
+    status = STATUS_ERROR
+    try:
+      status = execute(job, logger, logfile, cpus)
+    finally:
+      with finished:
+        statuses[job.name] = status
+        finished.notify_all()
+    return status
+
+  logger.info('[Flux]: running {} stages'.format(len(stages)))
+  results = runner.run([x.job for x in stages], execute_stage)
+  statuses.update(zip((x.job.name for x in stages), results))
+
+  success = all(x == STATUS_SUCCESS for x in statuses.values())
+  if success:
+    for stage in stages:
+      if os.path.isdir(output_path(stage.job.name)):
+        shutil.copytree(output_path(stage.job.name), runner.build_path, symlinks=True,
+          dirs_exist_ok=True)
+  if success or temporary:
+    utils.rmtree(stage_cache, remove_write_protection=True)
+  else:
+    logger.info('[Flux]: restart the build to resume the pipeline from the stages that did not succeed')
+  return success
+
+
+def save_outputs(stage, workspace, path, logger):
+  """
+  Copies the outputs of the *stage* from its *workspace* to *path*.
+  Returns #False if an output is missing.
+  """
+
+  temp_path = path + '.tmp'
+  if os.path.isdir(temp_path):
+    utils.rmtree(temp_path, remove_write_protection=True)
+  utils.makedirs(temp_path)
+  for name in stage.outputs:
+    src = os.path.join(workspace, name)
+    dst = os.path.join(temp_path, name)
+    if not os.path.exists(src):
+      logger.error('[Flux]: output {!r} is missing'.format(name))
+      utils.rmtree(temp_path, remove_write_protection=True)
+      return False
+    utils.makedirs(os.path.dirname(dst))
+    if os.path.isdir(src):
+      shutil.copytree(src, dst, symlinks=True)
+    else:
+      shutil.copy2(src, dst)
+  os.rename(temp_path, path)
+  return True
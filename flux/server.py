@@ -0,0 +1,128 @@
+# -*- coding: utf8 -*-
+'''
+The WSGI servers for ``flux-ci --web``, selected with the ``web_server``
+configuration value:
+
+* ``'development'``: The threaded Werkzeug development server. The interactive
+  debugger is enabled with ``debug``. Do not use it in production.
+* ``'threaded'``: A Werkzeug server that handles every connection in a
+  separate thread, with a timeout for stalled connections.
+* ``'gunicorn'``: A pre-forking Gunicorn server with ``web_workers``
+  processes of ``web_threads`` threads each. Requires the ``gunicorn``
+  package.
+
+The build consumer (unless ``build_in_web`` is disabled), the repository
+poller and the token sweeper run in the process that was started with
+``flux-ci --web``. With Gunicorn, the web workers are children of that
+process and only ever change the builds in the database, see
+:class:`build.BuildConsumer`.
+'''
+
+from flux import app, config, models
+from werkzeug.serving import WSGIRequestHandler
+
+import multiprocessing
+
+
+class RequestHandler(WSGIRequestHandler):
+  ''' Aborts connections that stall for more than ``web_timeout`` seconds.
+  Werkzeug closes the connection after every response, ``web_keepalive``
+  only applies to Gunicorn. '''
+
+  def setup(self):
+    self.timeout = config.web_timeout
+    super().setup()
+
+
+class DevelopmentServer(object):
+
+  def __init__(self, wsgi_app):
+    self.wsgi_app = wsgi_app
+
+  def serve_forever(self):
+    from werkzeug.serving import run_simple
+    # Threaded, as agents long-poll the server for builds.
+    run_simple(config.host, config.port, self.wsgi_app, threaded=True,
+      use_debugger=config.debug, use_reloader=False)
+
+
+class ThreadedServer(object):
+
+  def __init__(self, wsgi_app):
+    from werkzeug.serving import make_server
+    self._server = make_server(config.host, config.port, wsgi_app,
+      threaded=True, request_handler=RequestHandler)
+
+  def serve_forever(self):
+    self._server.serve_forever()
+
+
+class GunicornServer(object):
+  ''' Runs the Gunicorn arbiter in a child process. It must be created
+  before any other threads are started in this process, as the child is
+  created with :func:`os.fork`. '''
+
+  def __init__(self, wsgi_app):
+    try:
+      import gunicorn.app.base
+    except ImportError:
+      raise RuntimeError("web_server = 'gunicorn' requires the gunicorn "
+                         "package (pip install gunicorn)")
+    if models.db.provider_name == 'sqlite' and config.web_workers > 1:
+      app.logger.warning('SQLite does not handle concurrent writes from '
+        'multiple web workers well, consider PostgreSQL or MySQL.')
+    # Connections must not be shared with the child processes.
+    models.db.disconnect()
+    context = multiprocessing.get_context('fork')
+    self._process = context.Process(target=_run_gunicorn, args=[wsgi_app],
+      name='flux-web')
+    self._process.start()
+
+  def serve_forever(self):
+    try:
+      self._process.join()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      if self._process.is_alive():
+        # Graceful shutdown, Gunicorn lets running requests finish.
+        self._process.terminate()
+        self._process.join()
+
+
+def _run_gunicorn(wsgi_app):
+  import gunicorn.app.base
+
+  def post_fork(server, worker):
+    models.db.disconnect()
+
+  class Application(gunicorn.app.base.BaseApplication):
+    def load_config(self):
+      self.cfg.set('bind', '{}:{}'.format(config.host, config.port))
+      self.cfg.set('workers', config.web_workers)
+      self.cfg.set('worker_class', 'gthread')
+      self.cfg.set('threads', config.web_threads)
+      self.cfg.set('keepalive', config.web_keepalive)
+      self.cfg.set('timeout', config.web_timeout)
+      self.cfg.set('post_fork', post_fork)
+    def load(self):
+      return wsgi_app
+
+  Application().run()
+
+
+SERVERS = {
+  'development': DevelopmentServer,
+  'threaded': ThreadedServer,
+  'gunicorn': GunicornServer,
+}
+
+
+def create_server(wsgi_app):
+  ''' Creates the server selected with ``web_server`` for *wsgi_app*. '''
+
+  try:
+    server_class = SERVERS[config.web_server]
+  except KeyError:
+    raise ValueError('invalid web_server: {!r}'.format(config.web_server))
+  return server_class(wsgi_app)
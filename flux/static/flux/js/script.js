@@ -123,7 +123,12 @@ $(document).ready(function() {
 	$('.upload-form input[type=file]').on('change', function() {
 		if ('files' in $(this)[0]) {
 			if ($(this)[0].files.length > 0) {
-				$(this).parent('.upload-form').submit();
+				var form = $(this).parent('.upload-form');
+				if (window.XMLHttpRequest && form.attr('data-upload-url')) {
+					uploadFiles(form, $(this)[0].files);
+				} else {
+					form.submit();
+				}
 			}
 		}
 	});
@@ -134,4 +139,79 @@ $(document).ready(function() {
 		var id = $(this).attr('data-toggle');
 		$(id).toggle();
 	});
-});
\ No newline at end of file
+});
+
+// Uploads the files one after another in chunks through the resumable
+// upload API. A chunk that fails is retried from the offset that the
+// server reports.
+function uploadFiles(form, files) {
+	var url = form.attr('data-upload-url');
+	var chunkSize = parseInt(form.attr('data-chunk-size'));
+	var extract = form[0].querySelector('input[name=extract]').checked;
+	var status = form[0].querySelector('.upload-status');
+	var index = 0;
+
+	function request(method, target, body, done) {
+		var xhr = new XMLHttpRequest();
+		xhr.open(method, target);
+		xhr.onload = function() {
+			var data = {};
+			try { data = JSON.parse(xhr.responseText); } catch (e) {}
+			done(xhr.status, data);
+		};
+		xhr.onerror = function() { done(0, {}); };
+		if (body !== null && !(body instanceof Blob)) {
+			xhr.setRequestHeader('Content-Type', 'application/json');
+			body = JSON.stringify(body);
+		}
+		xhr.send(body);
+	}
+
+	function fail(file, message) {
+		status.textContent = "Could not upload '" + file.name + "': " + message;
+	}
+
+	function next() {
+		if (index >= files.length) {
+			window.location = form.attr('data-done-url');
+			return;
+		}
+		var file = files[index++];
+		var retries = 5;
+		request('POST', url, {name: file.name, size: file.size, extract: extract}, function(code, upload) {
+			if (code !== 201) {
+				return fail(file, upload.error || 'error ' + code);
+			}
+			var target = url + '?id=' + upload.id;
+			function send(offset) {
+				status.textContent = "Uploading '" + file.name + "' ("
+					+ (file.size ? Math.floor(100 * offset / file.size) : 100) + '%)';
+				if (offset >= file.size) {
+					return request('POST', target, null, function(code, data) {
+						if (code !== 200) {
+							return fail(file, data.error || 'error ' + code);
+						}
+						next();
+					});
+				}
+				var chunk = file.slice(offset, offset + chunkSize);
+				request('PUT', target + '&offset=' + offset, chunk, function(code, data) {
+					if (code === 200) {
+						return send(data.offset);
+					}
+					if (code === 404 || retries-- <= 0) {
+						return fail(file, data.error || 'error ' + code);
+					}
+					setTimeout(function() {
+						request('GET', target, null, function(code, data) {
+							send(code === 200 ? data.offset : offset);
+						});
+					}, 1000);
+				});
+			}
+			send(0);
+		});
+	}
+
+	next();
+}
@@ -0,0 +1,208 @@
+# -*- coding: utf8 -*-
+'''
+Signed login tokens. The browser's session contains the ID, user, IP
+and expiration date of a :class:`models.LoginToken`, signed with the
+``secret_key``, so that authenticating a request does not require to
+look up the token in the database.
+
+Because a signed token is valid until it expires, tokens that have been
+deleted before (eg. on logout) are recorded in the revoked tokens table.
+Every process keeps a copy of that table in memory, which is refreshed
+every ``login_revocation_refresh`` seconds. Expired tokens are deleted
+in bulk by the token sweeper every ``login_token_sweep_interval`` seconds.
+
+The users of the tokens are cached as well (see :class:`UserCache`), thus
+an authenticated request does not query the database at all.
+'''
+
+from flux import app, config, models
+from flask import url_for
+from datetime import datetime
+from itsdangerous import URLSafeSerializer, BadSignature
+from threading import Condition, Lock, Thread
+
+import collections
+import time
+import traceback
+
+
+class Claims(collections.namedtuple('Claims', 'token_id user_id ip expires')):
+  ''' The contents of a signed login token. *expires* is a UNIX timestamp
+  or None if the token does not expire. '''
+
+  def expired(self):
+    return self.expires is not None and self.expires < time.time()
+
+
+def _serializer():
+  return URLSafeSerializer(config.secret_key, salt='flux-login-token')
+
+
+def sign(token):
+  ''' Returns the signed representation of the :class:`models.LoginToken`
+  *token* that is stored in the browser's session. '''
+
+  expires = token.expires()
+  expires = expires.timestamp() if expires else None
+  return _serializer().dumps([token.id, token.user.id, token.ip, expires])
+
+
+def load(value):
+  ''' Verifies the signature of a token created with :func:`sign` and
+  returns its :class:`Claims`, or None if the token is invalid. The
+  caller must check the IP, expiration and revocation. '''
+
+  if not value:
+    return None
+  try:
+    return Claims(*_serializer().loads(value))
+  except (BadSignature, TypeError, ValueError):
+    return None
+
+
+class RevocationList(object):
+  ''' In-memory copy of the IDs in the :class:`models.RevokedToken` table.
+  Tokens revoked by this process are added immediately, tokens revoked by
+  other processes are picked up with the next refresh. '''
+
+  def __init__(self):
+    self._lock = Lock()
+    self._ids = frozenset()
+    self._refreshed = None
+
+  def add(self, token_id):
+    with self._lock:
+      self._ids = self._ids | {token_id}
+
+  def refresh(self):
+    with models.session():
+      ids = frozenset(models.select(x.token_id for x in models.RevokedToken)[:])
+    with self._lock:
+      self._ids = ids
+      self._refreshed = time.monotonic()
+
+  def __contains__(self, token_id):
+    refreshed = self._refreshed
+    if refreshed is None or time.monotonic() - refreshed >= config.login_revocation_refresh:
+      self.refresh()
+    return token_id in self._ids
+
+
+revoked = RevocationList()
+
+
+class CachedUser(collections.namedtuple('CachedUser',
+    'id name can_manage can_download_artifacts can_view_buildlogs')):
+  ''' The fields of a :class:`models.User` that the views need to check
+  the privileges of the user of a request. '''
+
+  def url(self):
+    return url_for('edit_user', user_id=self.id)
+
+
+class UserCache(object):
+  ''' Caches the :class:`CachedUser` of every user ID for
+  ``login_user_cache_ttl`` seconds. Users that are changed or deleted by
+  this process are dropped immediately (see :class:`models.User`), changes
+  by other processes are picked up when the entry expired. '''
+
+  def __init__(self):
+    self._lock = Lock()
+    self._users = {}
+
+  def get(self, user_id):
+    ''' Returns the :class:`CachedUser` with the specified ID, or None if
+    the user does not exist. '''
+
+    now = time.monotonic()
+    with self._lock:
+      entry = self._users.get(user_id)
+    if entry and now - entry[1] < config.login_user_cache_ttl:
+      return entry[0]
+    with models.session():
+      user = models.User.get(id=user_id)
+      user = user and CachedUser(user.id, user.name, user.can_manage,
+        user.can_download_artifacts, user.can_view_buildlogs)
+    with self._lock:
+      if user:
+        self._users[user_id] = (user, now)
+      else:
+        self._users.pop(user_id, None)
+    return user
+
+  def discard(self, user_id):
+    with self._lock:
+      self._users.pop(user_id, None)
+
+
+users = UserCache()
+
+
+def revoke(token_id):
+  ''' Deletes the login token with the specified ID and adds it to the
+  revocation list. Must be called inside a database session. '''
+
+  revoked.add(token_id)
+  token = models.LoginToken.get(id=token_id)
+  if token:
+    token.delete()
+
+
+def sweep():
+  ''' Deletes expired login tokens and the revoked tokens that would have
+  expired by now in bulk. Returns the number of deleted login tokens. '''
+
+  now = datetime.now()
+  count = 0
+  with models.session():
+    if config.login_token_duration is not None:
+      limit = now - config.login_token_duration
+      count = models.select(x for x in models.LoginToken if x.created < limit).delete(bulk=True)
+    models.select(x for x in models.RevokedToken
+      if x.expires is not None and x.expires < now).delete(bulk=True)
+  return count
+
+
+class TokenSweeper(object):
+  ''' Runs :func:`sweep` periodically in a background thread. '''
+
+  def __init__(self):
+    self._cond = Condition()
+    self._running = False
+    self._thread = None
+
+  def start(self):
+    with self._cond:
+      if self._running:
+        raise RuntimeError('already running')
+      self._running = True
+      self._thread = Thread(target=self._run)
+      self._thread.start()
+
+  def stop(self, join=True):
+    with self._cond:
+      if not self._running:
+        return
+      self._running = False
+      self._cond.notify()
+    if join:
+      self._thread.join()
+
+  def _run(self):
+    while True:
+      try:
+        count = sweep()
+        if count:
+          app.logger.info('Deleted {} expired login token(s)'.format(count))
+      except BaseException:
+        traceback.print_exc()
+      with self._cond:
+        if self._running:
+          self._cond.wait(config.login_token_sweep_interval)
+        if not self._running:
+          break
+
+
+_sweeper = TokenSweeper()
+run_sweeper = _sweeper.start
+stop_sweeper = _sweeper.stop
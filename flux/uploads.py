@@ -0,0 +1,281 @@
+# -*- coding: utf8 -*-
+'''
+Resumable uploads of override files. Instead of buffering a whole file in
+the request, the client creates an upload and sends the file in chunks of
+at most ``upload_chunk_size`` bytes, which are written straight to a
+temporary file. An interrupted upload is resumed from the offset that the
+server reports. When all chunks arrived, the size and the SHA-256 checksum
+are verified and the file is renamed into the override directory, or the
+archive is extracted into it.
+
+The temporary files and the state of the uploads are kept in
+``<override_path>.uploads``, next to the override directory and thus on
+the same file system, so that they do not show up in the override browser
+or in the builds. Uploads that were not finished within ``upload_expiry``
+seconds are deleted.
+'''
+
+from flux import config, overrides, utils
+
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+import uuid
+import zipfile
+
+#: The file name suffixes of the archives that can be extracted.
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+_id_regex = re.compile('^[0-9a-f]{32}$')
+
+
+def uploads_path(override_path):
+  return override_path + '.uploads'
+
+
+def is_archive(filename):
+  return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _paths(override_path, upload_id):
+  base = os.path.join(uploads_path(override_path), upload_id)
+  return base + '.json', base + '.part'
+
+
+def create(override_path, target, name, size, sha256=None, extract=False):
+  """
+  Creates an upload of the file *name* into the directory *target* (a path
+  relative to *override_path* with forward slashes).
+
+  # Parameters
+  override_path (str): The override directory of the repository.
+  target (str): The directory that receives the file.
+  name (str): The file name, which must already be secured.
+  size (int): The size of the file in bytes.
+  sha256 (str, None): The expected checksum of the file.
+  extract (bool): Extract the archive instead of saving the file.
+
+  # Return
+  dict: The state of the upload, see #load().
+  """
+
+  if extract and not is_archive(name):
+    raise ValueError('{!r} is not a supported archive'.format(name))
+  if sha256 is not None and not re.match('^[0-9a-f]{64}$', sha256):
+    raise ValueError('invalid SHA-256 checksum')
+  remove_expired(override_path)
+  state = {
+    'id': uuid.uuid4().hex,
+    'target': target,
+    'name': name,
+    'size': size,
+    'sha256': sha256,
+    'extract': extract,
+    'created': time.time(),
+  }
+  state_path, part_path = _paths(override_path, state['id'])
+  utils.makedirs(uploads_path(override_path))
+  open(part_path, 'wb').close()
+  with open(state_path, 'w', encoding='utf8') as fp:
+    json.dump(state, fp)
+  state['offset'] = 0
+  return state
+
+
+def load(override_path, upload_id):
+  ''' Returns the state of the upload with the specified ID and the number
+  of bytes received so far as its ``offset``, or None if there is no such
+  upload. '''
+
+  if not _id_regex.match(upload_id):
+    return None
+  state_path, part_path = _paths(override_path, upload_id)
+  try:
+    with open(state_path, encoding='utf8') as fp:
+      state = json.load(fp)
+    state['offset'] = os.path.getsize(part_path)
+  except (OSError, ValueError):
+    return None
+  return state
+
+
+def write_chunk(override_path, upload_id, offset, stream):
+  """
+  Writes the data from the file-like *stream* to the upload at *offset*,
+  which must not be behind the data received so far. A chunk that is sent
+  again (eg. because the response to it got lost) replaces the data after
+  *offset*. At most ``upload_chunk_size`` bytes are read.
+
+  # Raises
+  KeyError: If the upload does not exist.
+  ValueError: If *offset* is invalid or the chunk is too large.
+
+  # Return
+  int: The new offset of the upload.
+  """
+
+  state_path, part_path = _paths(override_path, upload_id)
+  with utils.locked(state_path):
+    state = load(override_path, upload_id)
+    if not state:
+      raise KeyError(upload_id)
+    if offset < 0 or offset > state['offset']:
+      raise ValueError('expected offset {}'.format(state['offset']))
+    limit = min(config.upload_chunk_size, state['size'] - offset)
+    with open(part_path, 'r+b') as fp:
+      fp.seek(offset)
+      fp.truncate()
+      written = 0
+      while True:
+        chunk = stream.read(min(64 * 1024, limit + 1 - written))
+        if not chunk:
+          break
+        written += len(chunk)
+        if written > limit:
+          fp.truncate(offset)
+          raise ValueError('the chunk exceeds {} bytes'.format(limit))
+        fp.write(chunk)
+    return offset + written
+
+
+def finish(override_path, upload_id):
+  """
+  Verifies the upload and moves the file into the override directory, or
+  extracts it there. The upload is deleted unless it is incomplete.
+
+  # Raises
+  KeyError: If the upload does not exist.
+  ValueError: If the upload is incomplete, the checksum does not match or
+    the archive can not be extracted.
+
+  # Return
+  str: The directory that received the files.
+  """
+
+  state_path, part_path = _paths(override_path, upload_id)
+  with utils.locked(state_path):
+    state = load(override_path, upload_id)
+    if not state:
+      raise KeyError(upload_id)
+    if state['offset'] != state['size']:
+      raise ValueError('received {} of {} bytes'.format(state['offset'], state['size']))
+    try:
+      if state['sha256'] and overrides.hash_file(part_path) != state['sha256']:
+        raise ValueError('the SHA-256 checksum does not match')
+      cwd = os.path.join(override_path, state['target'].replace('/', os.sep))
+      utils.makedirs(cwd)
+      if state['extract']:
+        extract_archive(part_path, state['name'], cwd, part_path + '.d')
+      else:
+        os.replace(part_path, os.path.join(cwd, state['name']))
+    finally:
+      remove(override_path, upload_id)
+  return cwd
+
+
+def remove(override_path, upload_id):
+  ''' Deletes the upload with the specified ID. '''
+
+  state_path, part_path = _paths(override_path, upload_id)
+  for path in (state_path, part_path, state_path + '.lock'):
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+  if os.path.isdir(part_path + '.d'):
+    utils.rmtree(part_path + '.d', remove_write_protection=True)
+
+
+def remove_expired(override_path):
+  ''' Deletes the uploads that were created more than ``upload_expiry``
+  seconds ago. '''
+
+  path = uploads_path(override_path)
+  if not os.path.isdir(path):
+    return
+  limit = time.time() - config.upload_expiry
+  for name in os.listdir(path):
+    upload_id = name.partition('.')[0]
+    if not _id_regex.match(upload_id) or not name.endswith('.json'):
+      continue
+    try:
+      expired = os.path.getmtime(os.path.join(path, name)) < limit
+    except FileNotFoundError:
+      continue
+    if expired:
+      remove(override_path, upload_id)
+
+
+def extract_archive(filename, name, cwd, temp_path):
+  """
+  Extracts the archive *filename* (whose type is determined from *name*)
+  into the directory *cwd*, replacing existing files. The archive is first
+  extracted into *temp_path*, thus a broken archive leaves *cwd* alone.
+  Members with absolute paths or paths that leave the archive are
+  rejected, links in tar archives must point inside of it.
+  """
+
+  utils.makedirs(temp_path)
+  if name.lower().endswith('.zip'):
+    try:
+      with zipfile.ZipFile(filename) as zipf:
+        for member in zipf.namelist():
+          _check_member(member)
+        zipf.extractall(temp_path)
+    except zipfile.BadZipFile as exc:
+      raise ValueError(str(exc))
+  else:
+    try:
+      with tarfile.open(filename) as tarf:
+        if hasattr(tarfile, 'data_filter'):
+          tarf.extractall(temp_path, filter='data')
+        else:
+          for member in tarf.getmembers():
+            _check_member(member.name)
+            if member.issym() or member.islnk():
+              _check_member(os.path.join(os.path.dirname(member.name), member.linkname)
+                            if member.issym() else member.linkname)
+            elif not (member.isfile() or member.isdir()):
+              raise ValueError('unsupported member {!r}'.format(member.name))
+          tarf.extractall(temp_path)
+    except tarfile.TarError as exc:
+      raise ValueError(str(exc))
+
+  for root, dirs, files in os.walk(temp_path):
+    dst = os.path.join(cwd, os.path.relpath(root, temp_path))
+    files += [x for x in dirs if os.path.islink(os.path.join(root, x))]
+    dirs[:] = [x for x in dirs if x not in files]
+    for dirname in dirs:
+      dst_dir = os.path.join(dst, dirname)
+      if os.path.lexists(dst_dir) and not os.path.isdir(dst_dir):
+        os.remove(dst_dir)
+      utils.makedirs(dst_dir)
+    for fname in files:
+      dst_file = os.path.join(dst, fname)
+      if os.path.isdir(dst_file) and not os.path.islink(dst_file):
+        shutil.rmtree(dst_file)
+      os.replace(os.path.join(root, fname), dst_file)
+
+
+def extract_stream(override_path, stream, name, cwd):
+  ''' Extracts the archive *name* from the file-like *stream* into *cwd*,
+  see :func:`extract_archive`. '''
+
+  upload_id = uuid.uuid4().hex
+  utils.makedirs(uploads_path(override_path))
+  part_path = _paths(override_path, upload_id)[1]
+  try:
+    with open(part_path, 'wb') as fp:
+      shutil.copyfileobj(stream, fp, 1024 * 1024)
+    extract_archive(part_path, name, cwd, part_path + '.d')
+  finally:
+    remove(override_path, upload_id)
+
+
+def _check_member(name):
+  path = os.path.normpath(name.replace('\\', '/'))
+  if os.path.isabs(path) or path == '..' or path.startswith('..' + os.sep):
+    raise ValueError('unsafe path in archive: {!r}'.format(name))
@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import contextlib
 import io
 import functools
 import hashlib
@@ -29,19 +30,33 @@ import shlex
 import shutil
 import stat
 import subprocess
+import sys
 import urllib.parse
 import uuid
 import werkzeug
 import zipfile
 
-from . import app, config, models
+from . import app, config
 from urllib.parse import urlparse
 from flask import request, session, redirect, url_for, Response
 from datetime import datetime
+from threading import Lock
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 from cryptography.hazmat.backends import default_backend
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # Windows, locks only work within the process
+
+_path_locks = {}
+_path_locks_lock = Lock()
+
+#: The file names of the SSH keypairs of repositories in the customs
+#: directory by key type.
+SSH_KEY_FILES = {'ed25519': 'id_ed25519', 'rsa': 'id_rsa'}
+
 
 def get_raise(data, key, expect_type=None):
   ''' Helper function to retrieve an element from a JSON data structure.
@@ -102,22 +117,60 @@ def basic_auth(message='Login required'):
   return Response('Please log in.', 401, headers, mimetype='text/plain')
 
 
+def authenticate(allow_basic=False):
+  ''' Authenticates the current request with the signed login token stored
+  in the session (see :mod:`flux.tokens`) or, if there is none and
+  *allow_basic* is True, with HTTP Basic credentials. On success,
+  ``request.user`` (a :class:`tokens.CachedUser` with a token, a
+  :class:`models.User` with Basic credentials) and ``request.login_token``
+  (the token's :class:`tokens.Claims`, #None with Basic credentials) are
+  set and True is returned. '''
+
+  from flux import models, tokens  # imports the database, not needed by agents
+  claims = tokens.load(session.get('flux_login_token'))
+  if claims and claims.ip == request.remote_addr and claims.token_id not in tokens.revoked:
+    if claims.expired():
+      flash("Your login session has expired.")
+      session.pop('flux_login_token', None)
+    else:
+      user = tokens.users.get(claims.user_id)
+      if user:
+        request.login_token = claims
+        request.user = user
+        return True
+
+  auth = request.authorization if allow_basic else None
+  if auth and auth.username and auth.password:
+    user = models.User.get_by_login_details(auth.username, auth.password)
+    if user:
+      request.login_token = None
+      request.user = user
+      return True
+  return False
+
+
 def requires_auth(func):
   ''' Decorator for view functions that require basic authentication. '''
 
   @functools.wraps(func)
   def wrapper(*args, **kwargs):
-    ip = request.remote_addr
-    token_string = session.get('flux_login_token')
-    token = models.LoginToken.select(lambda t: t.token == token_string).first()
-    if not token or token.ip != ip or token.expired():
-      if token and token.expired():
-        flash("Your login session has expired.")
-        token.delete()
+    if not authenticate():
       return redirect(url_for('login'))
+    return func(*args, **kwargs)
 
-    request.login_token = token
-    request.user = token.user
+  return wrapper
+
+
+def requires_api_auth(func):
+  ''' Decorator for API view functions. Unlike :func:`requires_auth`,
+  unauthenticated requests receive a 401 response that asks for HTTP
+  Basic credentials instead of a redirect to the login page. Only API
+  views accept HTTP Basic credentials. '''
+
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if not authenticate(allow_basic=True):
+      return basic_auth()
     return func(*args, **kwargs)
 
   return wrapper
@@ -127,7 +180,9 @@ def with_io_response(kwarg='stream', stream_type='text', **response_kwargs):
   ''' Decorator for View functions that create a :class:`io.StringIO` or
   :class:`io.BytesIO` (based on the *stream_type* parameter) and pass it
   as *kwarg* to the wrapped function. The contents of the buffer are
-  sent back to the client. '''
+  sent back to the client. The wrapped function returns the status
+  code, or a tuple of the status code and a dictionary of additional
+  response headers. '''
 
   if stream_type == 'text':
     factory = io.StringIO
@@ -143,7 +198,11 @@ def with_io_response(kwarg='stream', stream_type='text', **response_kwargs):
         raise RuntimeError('keyword argument {!r} already occupied'.format(kwarg))
       kwargs[kwarg] = stream = factory()
       status = func(*args, **kwargs)
-      return Response(stream.getvalue(), status=status, **response_kwargs)
+      headers = None
+      if isinstance(status, tuple):
+        status, headers = status
+      return Response(stream.getvalue(), status=status, headers=headers,
+        **response_kwargs)
     return wrapper
 
   return decorator
@@ -230,6 +289,22 @@ def makedirs(path):
     os.makedirs(path)
 
 
+@contextlib.contextmanager
+def locked(path):
+  ''' Serializes the access to the file or directory at *path* between the
+  threads of this process and, where supported, other processes. The lock
+  file is *path* with the suffix ``.lock``. '''
+
+  with _path_locks_lock:
+    lock = _path_locks.setdefault(path, Lock())
+  with lock:
+    makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'w') as fp:
+      if fcntl:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+      yield
+
+
 def rmtree(path, remove_write_protection=False):
   """
   A wrapper for #shutil.rmtree() that can try to remove write protection
@@ -246,6 +321,25 @@ def rmtree(path, remove_write_protection=False):
   shutil.rmtree(path, onerror=on_rm_error)
 
 
+def copy_workspace(src, dst):
+  """
+  Copies the directory *src* to *dst*, which must not exist. File data is
+  shared copy-on-write where the file system supports it (`cp --reflink`,
+  eg. on Btrfs and XFS), otherwise the files are copied. Symlinks are
+  copied as symlinks.
+  """
+
+  cp = shutil.which('cp')
+  if cp and sys.platform.startswith('linux'):
+    res = subprocess.run([cp, '-a', '--reflink=auto', src, dst],
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if res.returncode == 0:
+      return
+    if os.path.exists(dst):
+      rmtree(dst, remove_write_protection=True)
+  shutil.copytree(src, dst, symlinks=True)
+
+
 def zipdir(dirname, filename):
   dirname = os.path.abspath(dirname)
   zipf = zipfile.ZipFile(filename, 'w')
@@ -399,6 +493,21 @@ def get_bitbucket_signature(secret, payload_data):
   return hmac.new(secret.encode('utf8'), payload_data, hashlib.sha256).hexdigest()
 
 
+def parse_date(value):
+  ''' Parses an ISO 8601 date (``YYYY-MM-DD``) or date and time
+  (``YYYY-MM-DDTHH:MM[:SS]``). Returns None if *value* is empty.
+  Raises :class:`ValueError` if the value is invalid. '''
+
+  if not value:
+    return None
+  for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+    try:
+      return datetime.strptime(value, fmt)
+    except ValueError:
+      pass
+  raise ValueError('invalid date: {!r}'.format(value))
+
+
 def get_date_diff(date1, date2):
   if (not date1) or (not date2):
     if (not date1) and date2:
@@ -425,25 +534,156 @@ def is_page_active(page, user):
     return True
   elif page == 'integration' and path == '/integration':
     return True
+  elif page == 'workers' and path == '/workers':
+    return True
   return False
 
 
-def ping_repo(repo_url, repo = None):
-  if not repo_url or repo_url == '':
-    return 1
+def get_available_memory():
+  """
+  Returns the number of bytes of memory that are available for new
+  processes without swapping, or #None if the system does not report it.
+  """
+
+  try:
+    with open('/proc/meminfo') as fp:
+      for line in fp:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+def get_git_ssh_env(repo=None):
+  """
+  Returns the environment variables required for Git to connect with the
+  SSH identity of *repo* (if it has its own keypair) or the configured
+  `ssh_identity_file`. On build agents, *repo* has the path of the key
+  that has been downloaded for the build as `private_key_path`.
+  """
 
-  if repo and os.path.isfile(get_repo_private_key_path(repo)):
+  if repo and getattr(repo, 'private_key_path', None):
+    identity_file = repo.private_key_path
+  elif repo and os.path.isfile(get_repo_private_key_path(repo)):
     identity_file = get_repo_private_key_path(repo)
   else:
     identity_file = config.ssh_identity_file
 
-  ssh_cmd = ssh_command(None, identity_file=identity_file)
-  env = {'GIT_SSH_COMMAND': ' '.join(map(quote, ssh_cmd))}
+  options = {'BatchMode': 'yes'}
+  options.update(ssh_control_options(identity_file))
+  ssh_cmd = ssh_command(None, identity_file=identity_file, options=options)
+  return {'GIT_SSH_COMMAND': ' '.join(map(quote, ssh_cmd))}
+
+
+def ssh_control_options(identity_file=None):
+  """
+  Returns the SSH options that share one connection (a master, see
+  `ControlMaster` in ssh_config(5)) between the SSH sessions to the same
+  host and user with the same *identity_file*, if `ssh_control_dir` is
+  set. The master is kept open for `ssh_control_persist` seconds after
+  the last session ended.
+
+  Every process has a subdirectory of `ssh_control_dir` (named by its pid)
+  with a subdirectory for every identity file, in which SSH names the
+  socket of a master by a hash of the host, port and user.
+  """
+
+  if not config.ssh_control_dir:
+    return {}
+  key = os.path.abspath(identity_file) if identity_file else ''
+  path = os.path.join(config.ssh_control_dir, str(os.getpid()),
+    hashlib.sha1(key.encode('utf8')).hexdigest()[:12])
+  if not os.path.isdir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+  return {
+    'ControlMaster': 'auto',
+    'ControlPath': os.path.join(path, '%C').replace('\\', '/'),
+    'ControlPersist': str(config.ssh_control_persist),
+  }
+
+
+def close_ssh_masters():
+  """
+  Closes the SSH masters that this process opened in `ssh_control_dir`
+  and removes their sockets, eg. when Flux CI shuts down. The masters of
+  processes that no longer exist (eg. web workers) are closed as well,
+  those of other running processes are left alone. Returns the number of
+  masters.
+  """
+
+  if not config.ssh_control_dir or not os.path.isdir(config.ssh_control_dir):
+    return 0
+  count = 0
+  for name in os.listdir(config.ssh_control_dir):
+    if not name.isdigit() or (int(name) != os.getpid() and pid_exists(int(name))):
+      continue
+    directory = os.path.join(config.ssh_control_dir, name)
+    for root, dirs, files in os.walk(directory):
+      for fname in files:
+        path = os.path.join(root, fname)
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+          continue
+        command = ssh_command('flux-ci', options={'ControlPath': path}, verbose=False)
+        command[2:2] = ['-O', 'exit']
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+          count += 1
+        if os.path.exists(path):
+          os.remove(path)
+    shutil.rmtree(directory, ignore_errors=True)
+  return count
+
+
+def pid_exists(pid):
+  ''' Returns True if a process with the specified *pid* exists. '''
+
+  if os.name == 'nt':
+    return True  # Can not be checked without additional modules
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+def ping_repo(repo_url, repo = None):
+  if not repo_url or repo_url == '':
+    return 1
+
+  env = get_git_ssh_env(repo)
   ls_remote = ['git', 'ls-remote', '--exit-code', repo_url]
   res = run(ls_remote, app.logger, env=env)
   return res
 
 
+def ls_remote(repo_url, repo=None, logger=None):
+  """
+  Lists the branches and tags of the remote repository at *repo_url*. For
+  annotated tags, the SHA of the commit that the tag points to is returned.
+
+  # Return
+  tuple of (int, dict): The return code of `git ls-remote` and a dictionary
+      that maps ref names to commit SHAs.
+  """
+
+  env = get_git_ssh_env(repo)
+  command = ['git', 'ls-remote', '--heads', '--tags', repo_url]
+  res, stdout = run(command, logger, env=env, return_stdout=True)
+  refs = {}
+  if res == 0:
+    for line in stdout.splitlines():
+      sha, _, ref = line.strip().partition('\t')
+      if not ref:
+        continue
+      if ref.endswith('^{}'):
+        refs[ref[:-3]] = sha
+      else:
+        refs.setdefault(ref, sha)
+  return res, refs
+
+
 def get_customs_path(repo):
   return os.path.join(config.customs_dir, repo.name.replace('/', os.sep))
 
@@ -493,16 +733,26 @@ def get_public_key():
   return None
 
 
-def generate_ssh_keypair(public_key_comment):
+def generate_ssh_keypair(public_key_comment, key_type=None):
   """
-  Generates new RSA ssh keypair.
+  Generates new ssh keypair of the specified *key_type* ("ed25519" or
+  "rsa", defaults to `ssh_key_type`). Ed25519 keys are generated almost
+  instantly, 4096-bit RSA keys can take seconds.
 
   Return:
   tuple(str, str): generated private and public keys
   """
 
-  key = rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=4096)
-  private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode('ascii')
+  key_type = key_type or config.ssh_key_type
+  if key_type == 'ed25519':
+    key = ed25519.Ed25519PrivateKey.generate()
+    private_format = serialization.PrivateFormat.OpenSSH
+  elif key_type == 'rsa':
+    key = rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=4096)
+    private_format = serialization.PrivateFormat.PKCS8
+  else:
+    raise ValueError('unsupported SSH key type: {!r}'.format(key_type))
+  private_key = key.private_bytes(serialization.Encoding.PEM, private_format, serialization.NoEncryption()).decode('ascii')
   public_key = key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH).decode('ascii')
 
   if public_key_comment:
@@ -511,18 +761,26 @@ def generate_ssh_keypair(public_key_comment):
   return private_key, public_key
 
 
-def get_repo_private_key_path(repo):
+def get_repo_private_key_path(repo, key_type=None):
   """
-  Returns path of private key for repository from Customs folder.
+  Returns path of private key for repository from Customs folder. Without
+  *key_type*, this is the path of the existing key, or of a new key of
+  the configured `ssh_key_type`.
 
   Return:
   str: path to custom private SSH key
   """
 
-  return os.path.join(get_customs_path(repo), 'id_rsa')
+  if key_type is None:
+    for name in SSH_KEY_FILES.values():
+      path = os.path.join(get_customs_path(repo), name)
+      if os.path.isfile(path):
+        return path
+    key_type = config.ssh_key_type
+  return os.path.join(get_customs_path(repo), SSH_KEY_FILES[key_type])
 
 
-def get_repo_public_key_path(repo):
+def get_repo_public_key_path(repo, key_type=None):
   """
   Returns path of public key for repository from Customs folder.
 
@@ -530,4 +788,4 @@ def get_repo_public_key_path(repo):
   str: path to custom public SSH key
   """
 
-  return os.path.join(get_customs_path(repo), 'id_rsa.pub')
+  return get_repo_private_key_path(repo, key_type) + '.pub'
@@ -18,12 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from flux import app, config, file_utils, models, utils
-from flux.build import enqueue, terminate_build
-from flux.models import User, LoginToken, Repository, Build, get_target_for, select, desc
+from flux import app, config, file_utils, health, keygen, models, overrides, tokens, uploads, utils
+from flux.build import enqueue, terminate_build, queue_is_full
+from flux.models import User, LoginToken, Repository, Build, Worker, get_target_for, select, desc, paginate_builds
+from flux.ratelimit import RateLimiter
 from flux.utils import secure_filename
-from flask import request, session, redirect, url_for, render_template, abort
-from datetime import datetime
+from flask import request, session, redirect, url_for, render_template, abort, jsonify
+from datetime import datetime, timedelta
 
 import json
 import os
@@ -38,6 +39,18 @@ API_BITBUCKET_CLOUD = 'bitbucket-cloud'
 API_GITLAB = 'gitlab'
 API_BARE = 'bare'
 
+#: The number of builds per page in the build lists.
+PAGE_SIZE = 10
+
+#: The maximum number of builds per page for the build history API.
+API_MAX_PAGE_SIZE = 100
+
+#: The number of files per page in the override browser.
+OVERRIDES_PAGE_SIZE = 100
+
+hook_ip_limiter = RateLimiter(config.hook_rate_limit_per_ip)
+hook_repo_limiter = RateLimiter(config.hook_rate_limit_per_repo)
+
 @app.route('/hook/push', methods=['POST'])
 @utils.with_io_response(mimetype='text/plain')
 @utils.with_logger()
@@ -57,7 +70,18 @@ def hook_push(logger):
   * ``bare``
 
   If no or an invalid value is specified for this parameter, a 400
-  Invalid Request response is generator. '''
+  Invalid Request response is generator.
+
+  Deliveries that exceed the ``hook_rate_limit_per_ip`` or
+  ``hook_rate_limit_per_repo`` are answered with 429 Too Many Requests,
+  and if the build queue reached ``max_queued_builds``, with 503 Service
+  Unavailable. Both carry a ``Retry-After`` header. The rate limits are
+  counted by each web server process. '''
+
+  retry_after = hook_ip_limiter.hit(request.remote_addr)
+  if retry_after:
+    logger.error('PUSH event rejected (rate limit exceeded for {})'.format(request.remote_addr))
+    return 429, {'Retry-After': str(retry_after)}
 
   api = request.args.get('api')
   if api not in (API_GOGS, API_GITHUB, API_GITEA, API_GITBUCKET, API_BITBUCKET, API_BITBUCKET_CLOUD, API_GITLAB, API_BARE):
@@ -185,7 +209,7 @@ def hook_push(logger):
 
   name = owner + '/' + name
 
-  repo = Repository.get(name=name)
+  repo = models.get_repository(name)
   if not repo:
     logger.error('PUSH event rejected (unknown repository)')
     return 400
@@ -195,17 +219,15 @@ def hook_push(logger):
   if not repo.check_accept_ref(ref):
     logger.info('Git ref {!r} not whitelisted. No build dispatched'.format(ref))
     return 200
+  retry_after = hook_repo_limiter.hit(repo.id)
+  if retry_after:
+    logger.error('PUSH event rejected (rate limit exceeded for repository)')
+    return 429, {'Retry-After': str(retry_after)}
+  if queue_is_full():
+    logger.error('PUSH event rejected (build queue is full)')
+    return 503, {'Retry-After': '60'}
 
-  build = Build(
-    repo=repo,
-    commit_sha=commit,
-    num=repo.build_count,
-    ref=ref,
-    status=Build.Status_Queued,
-    date_queued=datetime.now(),
-    date_started=None,
-    date_finished=None)
-  repo.build_count += 1
+  build = Build.create(repo, ref, commit)
 
   models.commit()
   enqueue(build)
@@ -214,12 +236,27 @@ def hook_push(logger):
   return 200
 
 
+def paginate_request(query, limit):
+  ''' Paginates a query of builds with the ``before`` and ``after``
+  cursors from the request's URL parameters, see
+  :func:`models.paginate_builds`. Invalid cursors result in a 400
+  response. '''
+
+  try:
+    return paginate_builds(query, limit,
+      before=request.args.get('before'), after=request.args.get('after'))
+  except ValueError:
+    return abort(400)
+
+
 @app.route('/')
 @models.session
 @utils.requires_auth
 def dashboard():
   context = {}
-  context['builds'] = select(x for x in Build).order_by(desc(Build.date_queued)).limit(10)
+  query = select(x for x in Build).prefetch(Build.repo)
+  context['page'] = paginate_request(query, PAGE_SIZE)
+  context['builds'] = context['page'].items
   context['user'] = request.user
   return render_template('dashboard.html', **context)
 
@@ -229,7 +266,57 @@ def dashboard():
 @utils.requires_auth
 def repositories():
   repositories = select(x for x in Repository).order_by(Repository.name)
-  return render_template('repositories.html', user=request.user, repositories=repositories)
+  context = {}
+  if request.user.can_manage:
+    repositories = repositories.prefetch(Repository.health)
+    if request.args.get('health') == 'failed':
+      repositories = repositories.filter(lambda x: x.health and not x.health.ok)
+    context['health_filter'] = request.args.get('health')
+    context['health_running'] = health.is_checking()
+  return render_template('repositories.html', user=request.user, repositories=repositories, **context)
+
+
+@app.route('/repositories/health')
+@models.session
+@utils.requires_auth
+def check_health():
+  ''' Starts a health check of the repositories whose result expired, or
+  of all repositories with the ``force`` URL parameter. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  if health.run_check(force=bool(request.args.get('force'))):
+    utils.flash('The health check has been started, reload the page to see the results.')
+  else:
+    utils.flash('A health check is already running.')
+  return redirect(url_for('repositories'))
+
+
+@app.route('/api/repositories/health', methods=['GET', 'POST'])
+@models.session
+@utils.requires_api_auth
+def api_health():
+  ''' Returns the results of the last health check of every repository
+  (``ok`` is None if it has not been checked yet) and whether a check is
+  ``running``. ``POST`` starts a check like :func:`check_health`, with
+  ``{force}``. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  if request.method == 'POST':
+    data = request.get_json(force=True, silent=True) or {}
+    started = health.run_check(force=bool(data.get('force')))
+    return jsonify({'started': started}), 202 if started else 409
+  result = []
+  for repo in select(x for x in Repository).order_by(Repository.name).prefetch(Repository.health):
+    result.append({
+      'name': repo.name,
+      'ok': repo.health.ok if repo.health else None,
+      'message': repo.health.message if repo.health else None,
+      'date_checked': repo.health.date_checked.isoformat() if repo.health else None,
+      'fresh': repo.health.is_fresh() if repo.health else False,
+    })
+  return jsonify({'running': health.is_checking(), 'repositories': result})
 
 
 @app.route('/users')
@@ -251,6 +338,62 @@ def integration():
   return render_template('integration.html', user=request.user, public_key=utils.get_public_key())
 
 
+@app.route('/workers', methods=['GET', 'POST'])
+@models.session
+@utils.requires_auth
+def workers():
+  if not request.user.can_manage:
+    return abort(403)
+  if request.method == 'POST':
+    worker = Worker.get(name=request.form.get('worker_name', ''))
+    if not worker:
+      return abort(404)
+    try:
+      threads = int(request.form.get('worker_threads', ''))
+    except ValueError:
+      threads = 0
+    if threads < 1:
+      utils.flash('The number of threads must be a positive integer.')
+    else:
+      worker.threads = threads
+      utils.flash('{} will run {} build thread(s)'.format(worker.name, threads))
+    return redirect(url_for('workers'))
+  workers = select(x for x in Worker).order_by(Worker.name)
+  return render_template('workers.html', user=request.user, workers=workers)
+
+
+@app.route('/api/workers')
+@models.session
+@utils.requires_api_auth
+def api_workers():
+  ''' Lists the build consumer processes. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  workers = select(x for x in Worker).order_by(Worker.name)
+  return jsonify({'workers': [x.to_json() for x in workers]})
+
+
+@app.route('/api/workers/<path:name>', methods=['POST'])
+@models.session
+@utils.requires_api_auth
+def api_resize_worker(name):
+  ''' Changes the number of build threads of a worker, which it applies
+  within ``build_sync_interval`` seconds. Expects ``{threads}``. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  worker = Worker.get(name=name)
+  if not worker:
+    return abort(404)
+  data = request.get_json(force=True, silent=True) or {}
+  threads = data.get('threads')
+  if not isinstance(threads, int) or isinstance(threads, bool) or threads < 1:
+    return abort(400)
+  worker.threads = threads
+  return jsonify(worker.to_json())
+
+
 @app.route('/login', methods=['GET', 'POST'])
 @models.session
 def login():
@@ -262,7 +405,7 @@ def login():
       user = User.get(name=user_name, passhash=utils.hash_pw(user_password))
       if user:
         token = LoginToken.create(request.remote_addr, user)
-        session['flux_login_token'] = token.token
+        session['flux_login_token'] = tokens.sign(token)
         return redirect(url_for('dashboard'))
     errors.append('Username or password invalid.')
   return render_template('login.html', errors=errors)
@@ -273,8 +416,8 @@ def login():
 @utils.requires_auth
 def logout():
   if request.login_token:
-    request.login_token.delete()
-  session.pop('flux_login_token')
+    tokens.revoke(request.login_token.token_id)
+  session.pop('flux_login_token', None)
   return redirect(url_for('dashboard'))
 
 
@@ -287,20 +430,87 @@ def view_repo(path):
     return abort(404)
 
   context = {}
-  page_size = 10
+  context['page'] = paginate_request(repo.builds.select(), PAGE_SIZE)
+  context['builds'] = context['page'].items
+  return render_template('view_repo.html', user=request.user, repo=repo, **context)
+
+
+@app.route('/api/builds')
+@models.session
+@utils.requires_api_auth
+def api_builds():
+  ''' Build history API. Returns a page of builds, newest first, as JSON.
+  The following URL parameters are supported:
+
+  * ``repo``: Only builds of the repository with this name.
+  * ``status``: Comma separated list of build statuses.
+  * ``ref``: Only builds of this Git ref.
+  * ``since``, ``until``: Only builds queued in this date range (ISO 8601).
+  * ``limit``: The number of builds per page (at most 100).
+  * ``before``, ``after``: Cursors returned in ``older`` and ``newer`` of
+    the previous response, to retrieve the adjacent pages. '''
+
+  query = select(x for x in Build)
+
+  repo_name = request.args.get('repo')
+  if repo_name:
+    repo = models.get_repository(repo_name)
+    if not repo:
+      return abort(404)
+    query = query.filter(lambda x: x.repo == repo)
+
+  statuses = [x for x in request.args.get('status', '').split(',') if x]
+  if any(x not in Build.Status for x in statuses):
+    return abort(400)
+  if statuses:
+    query = query.filter(lambda x: x.status in statuses)
+
+  ref = request.args.get('ref')
+  if ref:
+    query = query.filter(lambda x: x.ref == ref)
 
   try:
-    context['page_number'] = int(request.args.get('page', 1))
+    since = utils.parse_date(request.args.get('since'))
+    until = utils.parse_date(request.args.get('until'))
+    limit = int(request.args.get('limit', PAGE_SIZE))
   except ValueError:
-    context['page_number'] = 1
+    return abort(400)
+  if since:
+    query = query.filter(lambda x: x.date_queued >= since)
+  if until:
+    query = query.filter(lambda x: x.date_queued < until)
 
-  page_from = (context['page_number'] - 1) * page_size
-  page_to = page_from + page_size
+  limit = max(1, min(limit, API_MAX_PAGE_SIZE))
+  page = paginate_request(query.prefetch(Build.repo), limit)
+  return jsonify({
+    'builds': [x.to_json() for x in page.items],
+    'older': page.older,
+    'newer': page.newer,
+  })
 
-  context['next_page'] = None if context['page_number'] <= 1 else context['page_number'] - 1
-  context['previous_page'] = None if len(repo.builds) <= page_to else context['page_number'] + 1
-  context['builds'] = repo.builds.select().order_by(desc(Build.date_queued))[page_from:page_to]
-  return render_template('view_repo.html', user=request.user, repo=repo, **context)
+
+@app.route('/api/stats')
+@models.session
+@utils.requires_api_auth
+def api_stats():
+  ''' Runtime statistics for monitoring. The affinity scheduling stats
+  cover the builds of the last ``days`` (URL parameter, default 7). '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  try:
+    days = float(request.args.get('days', 7))
+  except ValueError:
+    return abort(400)
+  since = datetime.now() - timedelta(days=days)
+  return jsonify({
+    'lookup_cache': {
+      'repositories': models.repository_ids.stats(),
+      'builds': models.build_ids.stats(),
+      'override_listings': file_utils.listings.stats(),
+    },
+    'affinity': models.get_affinity_stats(since),
+  })
 
 
 @app.route('/repo/generate-keypair/<path:path>')
@@ -316,36 +526,38 @@ def generate_keypair(path):
 
   session['errors'] = []
 
-  utils.makedirs(utils.get_customs_path(repo))
-
-  try:
-    private_key, public_key = utils.generate_ssh_keypair(repo.name + '@FluxCI')
-    private_key_path = utils.get_repo_private_key_path(repo)
-    public_key_path = utils.get_repo_public_key_path(repo)
-
+  if keygen.status(repo) == 'none':
+    if repo.health:
+      repo.health.delete()
     try:
-      file_utils.create_file_path(private_key_path)
-      file_utils.create_file_path(public_key_path)
-
-      file_utils.write_file(private_key_path, private_key)
-      file_utils.write_file(public_key_path, public_key)
-
-      try:
-        os.chmod(private_key_path, 0o600)
+      if keygen.generate(repo):
         utils.flash('SSH keypair generated.')
-      except BaseException as exc:
-        app.logger.info(exc)
-        session['errors'].append('Could not set permissions to newly generated private key.')
     except BaseException as exc:
       app.logger.info(exc)
-      session['errors'].append('Could not save generated SSH keypair.')
-  except BaseException as exc:
-    app.logger.info(exc)
-    session['errors'].append('Could not generate new SSH keypair.')
+      session['errors'].append('Could not generate new SSH keypair.')
 
   return redirect(url_for('edit_repo', repo_id = repo.id))
 
 
+@app.route('/api/repo/keypair/<path:path>')
+@models.session
+@utils.requires_api_auth
+def api_keypair(path):
+  ''' Returns the ``status`` of the SSH keypair of a repository (see
+  :func:`keygen.status`) and the ``public_key`` once it is ready. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  repo = get_target_for(path)
+  if not isinstance(repo, Repository):
+    return abort(404)
+  status = keygen.status(repo)
+  public_key = None
+  if status == 'ready':
+    public_key = file_utils.read_file(utils.get_repo_public_key_path(repo))
+  return jsonify({'status': status, 'public_key': public_key})
+
+
 @app.route('/repo/remove-keypair/<path:path>')
 @models.session
 @utils.requires_auth
@@ -359,12 +571,12 @@ def remove_keypair(path):
 
   session['errors'] = []
 
-  private_key_path = utils.get_repo_private_key_path(repo)
-  public_key_path = utils.get_repo_public_key_path(repo)
-
   try:
-    file_utils.delete(private_key_path)
-    file_utils.delete(public_key_path)
+    for key_type in utils.SSH_KEY_FILES:
+      file_utils.delete(utils.get_repo_private_key_path(repo, key_type))
+      file_utils.delete(utils.get_repo_public_key_path(repo, key_type))
+    if repo.health:
+      repo.health.delete()
     utils.flash('SSH keypair removed.')
   except BaseException as exc:
     app.logger.info(exc)
@@ -385,6 +597,7 @@ def view_build(path):
   if restart:
     if build.status != Build.Status_Building:
       build.delete_build()
+      build.jobs.select().delete(bulk=True)
       build.status = Build.Status_Queued
       build.date_started = None
       build.date_finished = None
@@ -425,6 +638,9 @@ def edit_repo(repo_id):
       except BaseException as exc:
         app.logger.info(exc)
         errors.append('Could not read public key for this repository.')
+    else:
+      context['keygen_status'] = keygen.status(repo)
+      keygen.fill_pool()
 
   if request.method == 'POST':
     secret = request.form.get('repo_secret', '')
@@ -432,6 +648,27 @@ def edit_repo(repo_id):
     repo_name = request.form.get('repo_name', '').strip()
     ref_whitelist = request.form.get('repo_ref_whitelist', '')
     build_script = request.form.get('repo_build_script', '')
+    polled = request.form.get('repo_polled') == 'on'
+    agent_labels = request.form.get('repo_agent_labels', '')
+    limits = {}
+    for name in ['cpu', 'memory', 'pids']:
+      value = request.form.get('repo_limit_' + name, '').strip()
+      if not value:
+        limits['limit_' + name] = None
+      elif value.isdigit() and int(value) > 0:
+        limits['limit_' + name] = int(value)
+      else:
+        errors.append('The {} limit must be a positive integer'.format(name))
+    # The field is only shown if RAM workspaces are configured.
+    ram_workspace = request.form.get('repo_ram_workspace')
+    if ram_workspace is not None:
+      ram_workspace = ram_workspace.strip()
+      if not ram_workspace:
+        limits['ram_workspace'] = None
+      elif ram_workspace.isdigit() and int(ram_workspace) > 0:
+        limits['ram_workspace'] = int(ram_workspace)
+      else:
+        errors.append('The RAM workspace size must be a positive integer')
     if len(repo_name) < 3 or repo_name.count('/') != 1:
       errors.append('Invalid repository name. Format must be owner/repo')
     if not clone_url:
@@ -448,12 +685,18 @@ def edit_repo(repo_id):
           build_count=0,
           ref_whitelist=ref_whitelist)
       else:
+        if repo.clone_url != clone_url and repo.health:
+          repo.health.delete()
         repo.name = repo_name
         repo.clone_url = clone_url
         repo.secret = secret
         repo.ref_whitelist = ref_whitelist
+      repo.set_polled(polled)
+      repo.set_agent_labels(agent_labels)
+      repo.set(**limits)
       try:
         utils.write_override_build_script(repo, build_script)
+        overrides_changed(repo, utils.get_override_path(repo))
       except BaseException as exc:
         app.logger.info(exc)
         errors.append('Could not make change on build script')
@@ -590,16 +833,12 @@ def build():
 
   commit = '0' * 32
   repo = Repository.get(id=repo_id)
-  build = Build(
-    repo=repo,
-    commit_sha=commit,
-    num=repo.build_count,
-    ref=ref_name,
-    status=Build.Status_Queued,
-    date_queued=datetime.now(),
-    date_started=None,
-    date_finished=None)
-  repo.build_count += 1
+  if not repo:
+    return abort(404)
+  if queue_is_full():
+    utils.flash('The build queue is full, try again later.')
+    return redirect(repo.url())
+  build = Build.create(repo, ref_name, commit)
 
   models.commit()
   enqueue(build)
@@ -621,6 +860,20 @@ def ping_repo():
     return 'fail', 404
 
 
+def overrides_changed(repo, cwd):
+  ''' Updates the override manifest of *repo* after the files in its
+  override directory *cwd* have been changed (see
+  :func:`overrides.update_manifest`) and drops the cached listing of the
+  directory. Failures are only logged, the next build updates the
+  manifest again. '''
+
+  try:
+    file_utils.invalidate_listing(cwd)
+    overrides.update_manifest(utils.get_override_path(repo))
+  except BaseException as exc:
+    app.logger.exception(exc)
+
+
 @app.route('/overrides/list/<path:path>')
 @models.session
 @utils.requires_auth
@@ -647,10 +900,24 @@ def overrides_list(path):
   if not isinstance(context['repo'], Repository):
     return abort(404)
 
+  sort = request.args.get('sort', 'name')
+  order = request.args.get('order', 'asc')
+  try:
+    page = int(request.args.get('page', 1))
+  except ValueError:
+    page = 1
+  if sort not in file_utils.SORT_KEYS or order not in ('asc', 'desc'):
+    return abort(400)
+  context['sort'], context['order'] = sort, order
+
   try:
     cwd = os.path.join(utils.get_override_path(context['repo']), context['overrides_path'].replace('/', os.sep))
     utils.makedirs(os.path.dirname(cwd))
-    context['files'] = file_utils.list_folder(cwd)
+    files = file_utils.list_folder(cwd, sort, order == 'desc')
+    context['num_pages'] = max(1, (len(files) + OVERRIDES_PAGE_SIZE - 1) // OVERRIDES_PAGE_SIZE)
+    context['page'] = page = max(1, min(page, context['num_pages']))
+    context['files'] = files[(page - 1) * OVERRIDES_PAGE_SIZE:page * OVERRIDES_PAGE_SIZE]
+    context['num_files'] = len(files)
   except BaseException as exc:
     app.logger.info(exc)
     errors.append('Could not read overrides for this repository.')
@@ -680,6 +947,7 @@ def overrides_edit(path):
     override_content = request.form.get('override_content')
     try:
       file_utils.write_file(file_path, override_content)
+      overrides_changed(context['repo'], os.path.dirname(file_path))
       utils.flash('Changes in file was saved.')
     except BaseException as exc:
       app.logger.info(exc)
@@ -723,6 +991,7 @@ def overrides_delete(path):
   session['errors'] = []
   try:
     file_utils.delete(cwd)
+    overrides_changed(repo, os.path.dirname(cwd))
     utils.flash('Object was deleted.')
   except BaseException as exc:
     app.logger.info(exc)
@@ -764,6 +1033,7 @@ def overrides_upload(path):
     return abort(404)
 
   context['list_path'] = url_for('overrides_list', path = path)
+  context['upload_path'] = path
   cwd = os.path.join(utils.get_override_path(repo), context['overrides_path'].replace('/', os.sep))
 
   if request.method == 'POST':
@@ -773,14 +1043,21 @@ def overrides_upload(path):
       utils.flash('No file was uploaded.')
     else:
       file_uploads = []
+      extract = bool(request.form.get('extract'))
       for file in files:
-        filepath = os.path.join(cwd, secure_filename(file.filename))
+        filename = secure_filename(file.filename)
+        filepath = os.path.join(cwd, filename)
         try:
-          file.save(filepath)
-          file_uploads.append("File '{}' was uploaded.".format(file.filename))
+          if extract and uploads.is_archive(filename):
+            uploads.extract_stream(utils.get_override_path(repo), file.stream, filename, cwd)
+            file_uploads.append("Archive '{}' was extracted.".format(file.filename))
+          else:
+            file.save(filepath)
+            file_uploads.append("File '{}' was uploaded.".format(file.filename))
         except BaseException as exc:
           app.logger.info(exc)
           session['errors'].append("Could not upload '{}'.".format(file.filename))
+      overrides_changed(repo, cwd)
       utils.flash(" ".join(file_uploads))
       if not session['errors']:
         return redirect(url_for('overrides_list', path = path))
@@ -791,6 +1068,80 @@ def overrides_upload(path):
   return render_template('overrides_upload.html', user=request.user, **context, errors=errors)
 
 
+@app.route('/api/overrides/upload/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+@models.session
+@utils.requires_api_auth
+def api_overrides_upload(path):
+  ''' Resumable upload of an override file in chunks, see :mod:`flux.uploads`.
+  *path* is the repository name followed by the target directory.
+
+  * ``POST`` with ``{name, size, sha256, extract}`` creates an upload and
+    returns its ``id`` and ``offset`` (201). ``sha256`` is optional, with
+    ``extract`` the file must be an archive that is extracted into the
+    target directory.
+  * ``PUT ?id=<id>&offset=<n>`` writes the request body at the offset
+    and returns the new ``offset``. Responds with 409 and the expected
+    ``offset`` if the offset is past the data received so far.
+  * ``GET ?id=<id>`` returns the ``offset`` to resume an upload from.
+  * ``POST ?id=<id>`` finishes the upload once all data arrived.
+  * ``DELETE ?id=<id>`` cancels the upload. '''
+
+  if not request.user.can_manage:
+    return abort(403)
+  repo_path, target = file_utils.split_url_path(path)
+  repo = get_target_for(repo_path)
+  if not isinstance(repo, Repository):
+    return abort(404)
+  override_path = utils.get_override_path(repo)
+  upload_id = request.args.get('id')
+
+  if request.method == 'POST' and not upload_id:
+    data = request.get_json(force=True, silent=True) or {}
+    name = secure_filename(data.get('name') or '')
+    size = data.get('size')
+    if not name or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+      return abort(400)
+    if '..' in target.split('/'):
+      return abort(400)
+    try:
+      state = uploads.create(override_path, target.strip('/'), name, size,
+        data.get('sha256') or None, bool(data.get('extract')))
+    except ValueError as exc:
+      return jsonify({'error': str(exc)}), 400
+    return jsonify(state), 201
+
+  state = uploads.load(override_path, upload_id or '')
+  if not state:
+    return abort(404)
+  if request.method == 'GET':
+    return jsonify(state)
+  elif request.method == 'DELETE':
+    uploads.remove(override_path, upload_id)
+    return jsonify({})
+  elif request.method == 'PUT':
+    try:
+      offset = int(request.args.get('offset', ''))
+    except ValueError:
+      return abort(400)
+    try:
+      state['offset'] = uploads.write_chunk(override_path, upload_id, offset, request.stream)
+    except KeyError:
+      return abort(404)
+    except ValueError as exc:
+      return jsonify({'error': str(exc), 'offset': state['offset']}), 409
+    return jsonify({'offset': state['offset']})
+
+  try:
+    cwd = uploads.finish(override_path, upload_id)
+  except KeyError:
+    return abort(404)
+  except ValueError as exc:
+    return jsonify({'error': str(exc)}), 409
+  overrides_changed(repo, cwd)
+  app.logger.info('Override upload {!r} of {} finished'.format(state['name'], repo.name))
+  return jsonify({})
+
+
 @app.route('/overrides/<string:action>')
 @models.session
 @utils.requires_auth
@@ -810,7 +1161,9 @@ def overrides_actions(action):
   if action == OVERRIDES_ACTION_CREATEFOLDER:
     name = secure_filename(request.args.get('name', ''))
     try:
-      file_utils.create_folder(os.path.join(utils.get_override_path(repo), path.replace('/', os.sep)), name)
+      cwd = os.path.join(utils.get_override_path(repo), path.replace('/', os.sep))
+      file_utils.create_folder(cwd, name)
+      overrides_changed(repo, cwd)
       utils.flash('Folder was created.')
       return redirect(url_for('overrides_list', path = separator.join([repo.name, path, name]).replace('//', '/')))
     except BaseException as exc:
@@ -820,7 +1173,9 @@ def overrides_actions(action):
   elif action == OVERRIDES_ACTION_CREATEFILE:
     name = secure_filename(request.args.get('name', ''))
     try:
-      file_utils.create_file(os.path.join(utils.get_override_path(repo), path.replace('/', os.sep)), name)
+      cwd = os.path.join(utils.get_override_path(repo), path.replace('/', os.sep))
+      file_utils.create_file(cwd, name)
+      overrides_changed(repo, cwd)
       utils.flash('File was created.')
       return redirect(url_for('overrides_edit', path = separator.join([repo.name, path, name]).replace('//', '/')))
     except BaseException as exc:
@@ -835,6 +1190,7 @@ def overrides_actions(action):
 
     try:
       file_utils.rename(original_path, new_path)
+      overrides_changed(repo, os.path.dirname(new_path))
       utils.flash('Object was renamed.')
     except BaseException as exc:
       app.logger.info(exc)
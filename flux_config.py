@@ -46,6 +46,76 @@ app_url = os.environ.get('FLUX_APP_URL', 'http://{}:{}'.format(host, port))
 ## "localhost:4042".
 server_name = os.environ.get('FLUX_SERVER_NAME', app_url.replace('http://', '').replace('https://', ''))
 
+## The web server that `flux-ci --web` runs. "development" is Werkzeug's
+## development server (with the debugger if `debug` is enabled), do not
+## use it in production. "threaded" serves every connection in its own
+## thread. "gunicorn" runs `web_workers` processes with `web_threads`
+## threads each and requires the gunicorn package. The builds run in the
+## main process (see `build_in_web`), use PostgreSQL or MySQL with
+## multiple workers.
+## `web_timeout` is the number of seconds after which a stalled request
+## is aborted. With gunicorn, `web_keepalive` is the number of seconds
+## that idle connections are kept open.
+web_server = 'development'
+web_workers = 4
+web_threads = 8
+web_keepalive = 5
+web_timeout = 60
+
+## The number of proxy servers in front of Flux CI that set the
+## "X-Forwarded-For" and "X-Forwarded-Proto" headers. Without this, all
+## requests appear to come from the proxy, which affects the IP address
+## that login tokens are bound to and `hook_rate_limit_per_ip`. Only
+## enable it if the proxies are the only way to reach Flux CI, clients
+## could fake their address otherwise.
+trusted_proxies = 0
+
+## The number of seconds after which idle build threads check the database
+## for builds that have been queued, and running builds are checked for
+## whether they have been stopped, by other processes.
+build_sync_interval = 5
+
+## Run the builds in the `flux-ci --web` process. Set this to False if
+## you run the builds with one or more `flux-ci worker` processes, which
+## claim the queued builds from the shared database. Workers can then be
+## restarted independently from the web server and vice versa.
+build_in_web = True
+
+## Build agents run builds on other hosts with `flux-ci agent`. They need
+## no access to the database, but must send the `agent_secret` (which
+## enables the agent API on the server) with every request. Agents that
+## did not contact the server for `agent_timeout` seconds are considered
+## dead and their builds are queued again. Agents send a heartbeat every
+## `agent_heartbeat_interval` seconds and wait for a build at most
+## `agent_poll_timeout` seconds per request.
+agent_secret = None
+agent_timeout = 60
+agent_heartbeat_interval = 10
+agent_poll_timeout = 30
+
+## Settings for `flux-ci agent`. The agent connects to `agent_server_url`
+## (defaults to `app_url`) and runs builds of repositories whose agent
+## labels are a subset of `agent_labels`, up to `agent_capacity` builds
+## in parallel. The builds run in `agent_work_dir` (defaults to the
+## "agent" directory in `root_dir`). The secret may also be passed in
+## the FLUX_AGENT_SECRET environment variable. `agent_name` defaults to
+## "<hostname>:<pid>"; the server rejects an agent whose name is used by
+## another agent process that is still alive.
+agent_server_url = None
+agent_name = None
+agent_labels = []
+agent_capacity = 1
+agent_work_dir = None
+
+## Builds prefer the worker or agent that last built the same repository
+## and ref, as its caches are warm. Other workers leave a build to that
+## worker for up to `affinity_wait` seconds after it has been queued (0
+## disables the preference). Only the `affinity_candidates` oldest queued
+## builds are considered when a worker looks for a build. The hit rate is
+## reported at "/api/stats".
+affinity_wait = 15
+affinity_candidates = 20
+
 ## Secret key required for HTTP session. Use your own random key
 ## for deployment! Here's a useful link to quickly get a bunch of
 ## such random secret strings:
@@ -70,6 +140,55 @@ root_password = 'alpine'
 ## build system) are usually multiprocessed already.
 parallel_builds = 1
 
+## Build threads only start a new build while the host is below these
+## thresholds: the 1-minute load average per CPU, and the free memory and
+## the free disk space in `build_dir` in MiB. None disables a check. The
+## number of build threads of every worker can be changed at runtime on
+## the "Workers" page.
+admission_max_load = None
+admission_min_free_memory = None
+admission_min_free_disk = None
+
+## Every build script runs in its own cgroup below `cgroup_root`, which
+## must be a cgroup v2 directory that is writable by the Flux CI user and
+## has the cpu, memory, pids (and io, for the I/O accounting) controllers
+## enabled in its cgroup.subtree_control, eg. a systemd unit with
+## Delegate=yes. The peak memory, CPU time and I/O of every build are
+## recorded. Without cgroups, the memory limit is applied to each process
+## with setrlimit() and the usage is less accurate.
+## The default limits are overridden by the repository settings. The CPU
+## limit is in percent of one CPU and the memory limit in MiB.
+cgroup_root = None
+build_limit_cpu = None
+build_limit_memory = None
+build_limit_pids = None
+
+## A directory on a tmpfs (eg. '/dev/shm/flux-ci') in which the builds of
+## repositories with a RAM workspace size run, instead of in `build_dir`.
+## Only the artifact and the log are written to `build_dir`. A build runs
+## on disk if its size does not fit into the free space of the directory,
+## or into what is left of `ram_workspace_size` (MiB, default: the size of
+## the file system) after the sizes of the running builds in memory. The
+## size is not enforced for a single build, a build that fills the tmpfs
+## fails.
+ram_workspace_dir = None
+ram_workspace_size = None
+
+## With `build_cpu_pinning`, the CPUs are split between the parallel
+## build slots and each build script only runs on the CPUs of its slot.
+## The first `build_reserved_cpus` CPUs are not used by builds, which keeps
+## the web server responsive during heavy builds. `build_nice` is added to
+## the nice value of the build scripts (eg. 10), and `build_ionice` sets
+## their I/O scheduling class: 'idle', 'best-effort' or 'realtime',
+## optionally with a level like 'best-effort:7', which requires ionice.
+## The CPUs and priorities are set with taskset, nice and ionice when the
+## build script is started, so that every process of the build inherits
+## them.
+build_cpu_pinning = False
+build_reserved_cpus = 1
+build_nice = None
+build_ionice = None
+
 ## Filenames of build scripts in a repository. The first matching
 ## filename will be used.
 if os.name == 'nt':
@@ -77,11 +196,49 @@ if os.name == 'nt':
 else:
   build_scripts = ['.flux-build.sh']
 
+## The filename of the build definition, a JSON file in the repository
+## (or the overrides) that can select the build script and define a
+## matrix of jobs. Every combination of the matrix values is a job that
+## runs the build script in its own copy of the checkout, with the values
+## in the FLUX_MATRIX_<NAME> environment variables. The jobs run on the
+## free build threads of the process that runs the build, and their logs
+## and statuses are collected in the build.
+##
+##   {"script": "ci/build.sh",
+##    "matrix": {"python": ["3.8", "3.9"], "mode": ["debug", "release"]},
+##    "exclude": [{"python": "3.8", "mode": "release"}]}
+##
+## Instead of a matrix, the definition can split the build into named
+## stages that run as a pipeline. A stage runs its script after the stages
+## that it needs, stages that do not depend on each other run at the same
+## time. The outputs of a stage are copied into the checkout of the stages
+## that depend on it and, when all stages succeeded, into the build
+## directory. If a stage fails, the checkout and the outputs of the stages
+## that succeeded are kept, and restarting the build resumes the pipeline
+## without cloning the repository again.
+##
+##   {"stages": {
+##      "build": {"script": "ci/build.sh", "outputs": ["dist"]},
+##      "test": {"script": "ci/test.sh", "needs": ["build"]},
+##      "package": {"script": "ci/package.sh", "needs": ["test"]}}}
+##
+## `build_max_jobs` limits the number of jobs or stages of a build.
+build_definition = '.flux-build.json'
+build_max_jobs = 64
+
 ## The directory in which all repositories are cloned to
 ## and the builds are executed in. The directory structure that
 ## is created by flux is <owner>/<repo>/<build_num> .
 build_dir = os.path.join(root_dir, 'builds')
 
+## The directory in which bare mirrors of the repositories are kept.
+## Builds clone from the mirror after fetching the new commits into it,
+## and the commits of queued builds are fetched by up to `prefetch_threads`
+## threads (0 disables the prefetching) before a build thread is free.
+## Set to None to clone every build from the remote repository.
+mirror_dir = os.path.join(root_dir, 'mirrors')
+prefetch_threads = 2
+
 ## The directory which contain file overrides for repositories.
 ## Anything in the corresponding repository folder
 ## will overwrite repository contents after clone.
@@ -94,6 +251,23 @@ build_dir = os.path.join(root_dir, 'builds')
 ## build_dir/<owner>/<repo>/<build_num>/icon.png
 override_dir = os.path.join(root_dir, 'overrides')
 
+## The override files are applied to the checkout of a build as reflinks
+## where the file system supports them, otherwise they are copied. With
+## `override_hardlinks`, they are hardlinked to a read-only copy instead,
+## which is instant on any file system but requires `override_dir` and
+## `build_dir` to be on the same file system. A build script that runs as
+## root can still change a hardlinked file for all later builds.
+override_hardlinks = False
+
+## Override files can be uploaded in chunks of at most `upload_chunk_size`
+## bytes through the "/api/overrides/upload" API, which the upload page
+## uses as well. The chunks are written to disk as they arrive, thus large
+## files (eg. toolchain archives) do not have to fit into memory, and an
+## interrupted upload can be resumed. Uploads that were not finished
+## within `upload_expiry` seconds are deleted.
+upload_chunk_size = 8 * 1024 * 1024
+upload_expiry = 86400
+
 ## The directory which contains custom files for each repository.
 ## Usage of files could be variable.
 customs_dir = os.path.join(root_dir, 'customs')
@@ -104,12 +278,91 @@ ssh_identity_file = None
 ## True if SSH verbose mode should be used.
 ssh_verbose = False
 
+## The type of the SSH keypairs that are generated for repositories,
+## "ed25519" or "rsa" (4096 bits). Keys are generated in the background
+## while the repository page waits for them. With a `ssh_key_pool_size`,
+## every web server process keeps as many keys generated in advance, so
+## that adding many repositories does not wait for key generation.
+ssh_key_type = 'ed25519'
+ssh_key_pool_size = 0
+
+## A directory for the sockets of shared SSH connections (eg.
+## '/tmp/flux-ssh'), or None to connect for every Git command. Git
+## commands that connect to the same host with the same SSH key (clones,
+## submodules, polling) reuse one connection, which is kept open for
+## `ssh_control_persist` seconds after the last command. Every process
+## has its own subdirectory and closes its connections when it stops. The
+## sockets are named by a 40 character hash, keep the path short (the
+## length of a socket path is limited to about 100 characters).
+ssh_control_dir = None
+ssh_control_persist = 60
+
+## The health check on the repositories page verifies with `git ls-remote`
+## that every repository can still be reached with its SSH key. It runs
+## `health_check_workers` checks at a time, at most `health_check_per_host`
+## of them against the same Git server, and gives up on a repository after
+## `health_check_timeout` seconds. Results are reused for
+## `health_check_ttl` seconds, unless the check is forced.
+health_check_workers = 16
+health_check_per_host = 4
+health_check_timeout = 30
+health_check_ttl = 3600
+
 ## The time that a login token should be valid for. Specify "None" to
 ## prevent login tokens from expiring.
 login_token_duration = timedelta(hours=6)
 
+## Login tokens are signed and verified without a database query. Tokens
+## revoked by logging out are remembered by every Flux CI process, which
+## reloads the list of revoked tokens every `login_revocation_refresh`
+## seconds. Expired tokens are deleted every `login_token_sweep_interval`
+## seconds. The name and privileges of a logged in user are cached for
+## `login_user_cache_ttl` seconds; changes made in another process take
+## effect after that time.
+login_revocation_refresh = 10
+login_token_sweep_interval = 3600
+login_user_cache_ttl = 10
+
+## The number of repository and build IDs that are kept in memory to
+## resolve URLs like "/repo/owner/name/42" without searching by name.
+## Hit and miss counters are available at "/api/stats".
+lookup_cache_size = 1024
+
 ## Defines, how .git folder should be handled during build process, it uses values from GitFolderHandling enum:
 ## * DELETE_BEFORE_BUILD - Native behaviour, that deletes .git folder before .flux-build runs.
 ## * DELETE_AFTER_BUILD - Deletes .git folder after .flux-build successfully runs, before artifact is zipped.
 ## * DISABLE_DELETE - .git folder is never deleted, it will be part of artifact ZIP.
 git_folder_handling = GitFolderHandling.DELETE_BEFORE_BUILD
+
+## Rate limits for the push webhook, given as a tuple of (count, seconds).
+## Each repository and each source IP may deliver a burst of `count`
+## events, after which further deliveries are answered with
+## "429 Too Many Requests" until the budget refilled over `seconds`.
+## Specify "None" to disable a limit. The limits are kept in memory by
+## every web server process, thus gunicorn accepts up to `web_workers`
+## times as many events. The source IP is the proxy's address unless
+## `trusted_proxies` is set.
+hook_rate_limit_per_repo = (30, 60)
+hook_rate_limit_per_ip = (120, 60)
+
+## The maximum number of builds that may wait in the queue. Webhook
+## deliveries that would exceed it are answered with "503 Service
+## Unavailable". Specify "None" for an unbounded queue.
+max_queued_builds = 500
+
+## Repositories that can not send webhooks to Flux can be polled for
+## changes instead (enable "poll for changes" in the repository settings).
+## `poll_workers` is the number of repositories that are checked with
+## `git ls-remote` concurrently, 0 disables polling. Every repository
+## is polled every `poll_interval` seconds. The interval grows up to
+## `poll_max_interval` while the repository does not change or can not
+## be reached, and is randomized by +/- `poll_jitter` (a fraction).
+poll_workers = 4
+poll_interval = 60
+poll_max_interval = 900
+poll_jitter = 0.2
+
+## Apply pending database migrations when Flux CI starts. If you disable
+## this, run `flux-ci --migrate` after upgrading Flux CI. Use
+## `flux-ci --check-db` to report pending migrations and missing indexes.
+auto_migrate = True